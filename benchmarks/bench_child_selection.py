@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+""" Child selection benchmark
+
+Compares scanning the children of a node against rounding to the children's lattice, level by level, on a depth 24
+tree grown from points on the unit sphere.
+
+    python benchmarks/bench_child_selection.py [samples]
+"""
+import math
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from msptree.msptree import MSPTree, _quantized_child
+
+
+def sphere_point():
+    z = 2*random.random() - 1
+    theta = 2*math.pi*random.random() - math.pi
+    return math.sin(theta)*math.sqrt(1-z*z), math.cos(theta)*math.sqrt(1-z*z), z
+
+
+def main(samples=2000, depth=24):
+    random.seed(0)
+    points = [sphere_point() for _ in range(samples)]
+    tree = MSPTree(depth)
+    tree.expand_to_many(points)
+
+    # The (node, query) pairs met at each level while descending towards the points
+    levels = [[] for _ in range(depth)]
+    for p in points:
+        node = tree.find_closest_node(p, 0)
+        for level in range(depth):
+            levels[level].append((node, p))
+            node = node._closest_child(p)
+
+    print('level lattice  children  scan (us)  rounded (us)  speedup  fallback')
+    for level, pairs in enumerate(levels):
+        scan = min(timeit.repeat(lambda: [n._scan_children(p) for n, p in pairs], number=1, repeat=3))
+        rounded = min(timeit.repeat(lambda: [n._closest_child(p) for n, p in pairs], number=1, repeat=3))
+        fallback = sum(1 for n, p in pairs if _quantized_child(n.lattice, n.color, n.position, n.scale, p) is None)
+        print('%5d %7s %9.1f %10.2f %13.2f %8.1fx %8.2f%%' % (
+            level, ('CC', 'BCC', 'FCC')[pairs[0][0].lattice], sum(len(n.children) for n, _ in pairs)/float(len(pairs)),
+            1e6*scan/len(pairs), 1e6*rounded/len(pairs), scan/rounded, 100.0*fallback/len(pairs)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+""" Construction, query and memory benchmarks
+
+Grows trees from synthetic point sets (points on a sphere shell, uniform in a cube, or in gaussian clusters) for a
+sweep of point counts and depths, for every storage type, and measures
+    - expand_to throughput, in points per second, and the time of expand_to_many on the same points
+    - find_closest_node latency, in microseconds per query
+    - the time to expand every node of the first levels of a tree
+    - the number of nodes and bytes at each depth
+The results are written as JSON, to stdout or to the given file. Given the results of an earlier run with --compare,
+the construction runs and the full level expansions are compared and the exit status is 1 if anything got slower by
+more than --tolerance. The exit status is also 1 if expand_to_many is slower than a loop of expand_to by more than
+--tolerance, on any storage.
+
+    python benchmarks/bench_suite.py [--quick] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from msptree.msptree import MSPTree, MSPStorageType
+
+STORAGES = {'objects': MSPStorageType.Objects, 'compact': MSPStorageType.Compact, 'integer': MSPStorageType.Integer}
+
+
+def sphere_shell(n, rng):
+    z = rng.uniform(-1, 1, n)
+    theta = rng.uniform(-math.pi, math.pi, n)
+    r = np.sqrt(1 - z*z)
+    return np.stack([r*np.sin(theta), r*np.cos(theta), z], 1)
+
+
+def uniform_cube(n, rng):
+    return rng.uniform(-1, 1, (n, 3))
+
+
+def clustered(n, rng, clusters=8):
+    centers = rng.uniform(-0.8, 0.8, (clusters, 3))
+    return np.clip(centers[rng.randint(clusters, size=n)] + rng.normal(0, 0.05, (n, 3)), -1, 1)
+
+
+POINT_SETS = {'sphere': sphere_shell, 'cube': uniform_cube, 'clustered': clustered}
+
+# The shortest loop of expand_to that batch_regressions compares expand_to_many against
+MIN_SECONDS = 0.1
+
+
+def best_of(f, repeat):
+    """ The shortest of repeat timings of f, and the result of its last call. Garbage left by earlier runs is
+    collected before each timing, so it isn't charged to f.
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def nodes_per_level(tree):
+    """ The number of nodes and of bytes of node data at each level of a tree
+    """
+    if tree._store is not None:
+        store = tree._store
+        levels = np.frombuffer(store.level, dtype=np.uint16)[np.frombuffer(store.parent, dtype=np.int32) != -2]
+        counts = np.bincount(levels, minlength=tree.max_depth + 1).tolist()
+    else:
+        counts, stack = [0]*(tree.max_depth + 1), list(tree.roots)
+        while stack:
+            node = stack.pop()
+            counts[node.level] += 1
+            stack.extend(MSPTree._materialized(node))
+    size = tree._node_bytes()
+    return [{'level': level, 'nodes': count, 'bytes': count*size} for level, count in enumerate(counts)]
+
+
+def bench_construction(points, depth, storage, repeat):
+    def build():
+        tree = MSPTree(depth, storage=storage)
+        for p in points:
+            tree.expand_to(p)
+        return tree
+
+    def build_many():
+        tree = MSPTree(depth, storage=storage)
+        tree.expand_to_many(points)
+        return tree
+
+    # The tree built with expand_to_many is dropped before the other is built, so both start from the same heap
+    many, _ = best_of(build_many, repeat)
+    elapsed, tree = best_of(build, repeat)
+    return {'seconds': elapsed, 'points_per_second': len(points)/elapsed, 'expand_to_many_seconds': many,
+            'nodes': tree.node_count(), 'bytes': tree.node_count()*tree._node_bytes(),
+            'levels': nodes_per_level(tree)}, tree
+
+
+def bench_queries(tree, queries, repeat):
+    elapsed, _ = best_of(lambda: [tree.find_closest_node(q) for q in queries], repeat)
+    return {'queries': len(queries), 'seconds': elapsed, 'us_per_query': 1e6*elapsed/len(queries)}
+
+
+def bench_full_levels(storage, levels, repeat):
+    """ Times expanding every node of a tree one level at a time
+    """
+    def expand():
+        tree = MSPTree(levels, storage=storage)
+        nodes, times = list(tree.roots), []
+        for _ in range(levels):
+            start = time.time()
+            children = []
+            for node in nodes:
+                node.expand_node()
+                children.extend(node.children)
+            times.append(time.time() - start)
+            nodes = children
+        return times, tree.node_count()
+
+    elapsed, (times, count) = best_of(expand, repeat)
+    return {'seconds': elapsed, 'nodes': count, 'level_seconds': times}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 16000])
+    parser.add_argument('--depths', type=int, nargs='+', default=[6, 9, 12])
+    parser.add_argument('--sets', nargs='+', default=sorted(POINT_SETS), choices=sorted(POINT_SETS))
+    parser.add_argument('--storages', nargs='+', default=sorted(STORAGES), choices=sorted(STORAGES))
+    parser.add_argument('--full-levels', type=int, default=5, help='levels expanded completely')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='a small sweep for a quick check')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed by --compare, 0.2 is 20%%')
+    args = parser.parse_args(args)
+    if args.quick:
+        args.sizes, args.depths, args.full_levels, args.queries, args.repeat = [500], [6], 3, 200, 1
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {'sizes': args.sizes, 'depths': args.depths, 'sets': args.sets, 'storages': args.storages,
+                       'queries': args.queries, 'repeat': args.repeat, 'seed': args.seed},
+        'construction': [],
+        'full_levels': [],
+    }
+    for name in args.sets:
+        for n in args.sizes:
+            rng = np.random.RandomState(args.seed)
+            points = POINT_SETS[name](n, rng).tolist()
+            queries = uniform_cube(args.queries, rng).tolist()
+            for depth in args.depths:
+                for storage in args.storages:
+                    construction, tree = bench_construction(points, depth, STORAGES[storage], args.repeat)
+                    construction.update({'set': name, 'points': n, 'depth': depth, 'storage': storage,
+                                         'find_closest_node': bench_queries(tree, queries, args.repeat)})
+                    results['construction'].append(construction)
+                    sys.stderr.write('%-9s %7d points depth %2d %-8s %10.0f points/s %8.1f us/query\n' % (
+                        name, n, depth, storage, construction['points_per_second'],
+                        construction['find_closest_node']['us_per_query']))
+
+    for storage in args.storages:
+        full = bench_full_levels(STORAGES[storage], args.full_levels, args.repeat)
+        full.update({'storage': storage, 'levels': args.full_levels})
+        results['full_levels'].append(full)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    slower = batch_regressions(results, args.tolerance)
+    if args.compare:
+        with open(args.compare) as f:
+            slower += regressions(json.load(f), results, args.tolerance)
+    return 1 if slower else 0
+
+
+def batch_regressions(results, tolerance):
+    """ Reports the runs of results where expand_to_many took longer than the loop of expand_to on the same points by
+    more than tolerance, as a fraction of the loop time, and returns them. Runs shorter than MIN_SECONDS are too
+    noisy to compare and are left out.
+    """
+    slower = []
+    for run in results['construction']:
+        ratio = run['expand_to_many_seconds']/run['seconds']
+        if run['seconds'] >= MIN_SECONDS and ratio > 1 + tolerance:
+            key = run['set'], run['points'], run['depth'], run['storage']
+            slower.append((key, 'expand_to_many', ratio))
+            sys.stderr.write('%-9s %7d points depth %2d %-8s expand_to_many is %.2fx slower than expand_to\n' % (
+                key + (ratio,)))
+    return slower
+
+
+def regressions(baseline, results, tolerance):
+    """ Reports the runs of results that are slower than the matching runs of baseline by more than tolerance, as a
+    fraction of the baseline time, and returns them
+    """
+    def key(run):
+        return run['set'], run['points'], run['depth'], run['storage']
+
+    before = dict((key(run), run) for run in baseline['construction'])
+    slower = []
+    for run in results['construction']:
+        if key(run) not in before:
+            continue
+        old = before[key(run)]
+        for metric, was, now in (('expand_to', 1/old['points_per_second'], 1/run['points_per_second']),
+                                 ('find_closest_node', old['find_closest_node']['us_per_query'],
+                                  run['find_closest_node']['us_per_query'])):
+            if now > was*(1 + tolerance):
+                slower.append((key(run), metric, now/was))
+                sys.stderr.write('%-9s %7d points depth %2d %-8s %s is %.2fx slower\n' % (key(run) + (metric, now/was)))
+
+    # Expanding whole levels times expand_node alone, which the descent towards the points hides
+    before = dict(((run['storage'], run['levels']), run) for run in baseline.get('full_levels', []))
+    for run in results['full_levels']:
+        old = before.get((run['storage'], run['levels']))
+        if old is not None and run['seconds'] > old['seconds']*(1 + tolerance):
+            slower.append(((run['storage'], run['levels']), 'full_levels', run['seconds']/old['seconds']))
+            sys.stderr.write('%-8s %d full levels are %.2fx slower\n' % (run['storage'], run['levels'],
+                                                                        run['seconds']/old['seconds']))
+    return slower
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+""" Point exporters
+
+The leaves of a tree are gathered into arrays with MSPTree.extract_level and written out in large blocks, formatting a
+whole block of lines with a single string operation for the text formats.
+"""
+import numpy as np
+
+from .msptree import _NodeColor
+
+_BLOCK_ROWS = 1 << 16
+
+
+def leaf_points(tree, normals=False, lo=None, hi=None):
+    """ The positions of the leaves of a tree, ghosts left out, as an (N,3) array. With lo and hi only the leaves in
+    the axis aligned box [lo, hi] are kept, such as (-1, -1, -1) and (1, 1, 1) for the unit cube of a tree on the unit
+    grid. With normals only the leaves whose value is a vector of three numbers are kept, and their values are
+    returned as an (N,3) array as well, None otherwise.
+    """
+    fill = (np.nan,)*3
+    positions, colors, values = tree.extract_level(tree.max_depth, lo, hi, fill, values=normals)
+    keep = colors != _NodeColor.Node_Ghost
+    if not normals:
+        return positions[keep], None
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim != 2 or values.shape[1] != 3:
+        raise ValueError("Normals need leaf values that are vectors of three numbers")
+    keep &= np.isfinite(values).all(1)
+    return positions[keep], values[keep]
+
+
+def _write_rows(f, line, rows):
+    for start in range(0, len(rows), _BLOCK_ROWS):
+        block = rows[start:start + _BLOCK_ROWS]
+        f.write((line*len(block)) % tuple(block.ravel().tolist()))
+
+
+def export_obj(tree, path, normals=False, lo=None, hi=None):
+    """ Writes the leaves of a tree, see leaf_points, as the vertices of a Wavefront OBJ file, followed by their
+    normals if normals is set. lo and hi limit the leaves to a box as in leaf_points.
+    """
+    positions, values = leaf_points(tree, normals, lo, hi)
+    with open(path, 'w') as f:
+        _write_rows(f, 'v %f %f %f\n', positions)
+        if normals:
+            _write_rows(f, 'vn %f %f %f\n', values)
+
+
+def export_xyz(tree, path, normals=False, lo=None, hi=None):
+    """ Writes the leaves of a tree, see leaf_points, to an XYZ file, one per line with its normal after its position
+    if normals is set. lo and hi limit the leaves to a box as in leaf_points.
+    """
+    positions, values = leaf_points(tree, normals, lo, hi)
+    with open(path, 'w') as f:
+        if normals:
+            _write_rows(f, '%f %f %f %f %f %f\n', np.concatenate([positions, values], 1))
+        else:
+            _write_rows(f, '%f %f %f\n', positions)
+
+
+def export_ply(tree, path, normals=False, binary=True, lo=None, hi=None):
+    """ Writes the leaves of a tree, see leaf_points, as the vertices of a PLY file, with their normals if normals is
+    set. Binary files store the vertices as little endian 32 bit floats written straight from an array. lo and hi
+    limit the leaves to a box as in leaf_points.
+    """
+    positions, values = leaf_points(tree, normals, lo, hi)
+    names = ('x', 'y', 'z', 'nx', 'ny', 'nz') if normals else ('x', 'y', 'z')
+    rows = np.concatenate([positions, values], 1) if normals else positions
+    header = ['ply', 'format %s 1.0' % ('binary_little_endian' if binary else 'ascii'),
+              'element vertex %d' % len(rows)] + ['property float %s' % name for name in names] + ['end_header']
+
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        if binary:
+            f.write(np.ascontiguousarray(rows, dtype='<f4').tobytes())
+        else:
+            line = ' '.join(['%g']*len(names)) + '\n'
+            for start in range(0, len(rows), _BLOCK_ROWS):
+                block = rows[start:start + _BLOCK_ROWS]
+                f.write(((line*len(block)) % tuple(block.ravel().tolist())).encode('ascii'))
@@ -0,0 +1,125 @@
+""" Point file importers
+
+Point files are read in chunks of whole lines, each parsed into a NumPy array in one call, so files larger than memory
+can be fed to a tree batch by batch.
+"""
+import os
+
+import numpy as np
+
+
+def read_xyz(path, chunk_size=1 << 22):
+    """ Generator of the points of an XYZ file, a text file with one point per line and its coordinates separated by
+    white space, as (N,C) arrays of about chunk_size bytes of text each. C is the number of columns of the first line,
+    the columns after the first three hold extra data such as normals. Blank lines and everything after a # are
+    skipped, so files may carry comments and headers that start with #. Raises a ValueError naming the first line that
+    doesn't hold C numbers.
+    """
+    columns = None
+    line = 1
+    with open(path, 'r') as f:
+        rest = ''
+        while True:
+            block = f.read(chunk_size)
+            text = rest + block
+            if not block:
+                rest = ''
+            else:
+                end = text.rfind('\n') + 1
+                text, rest = text[:end], text[end:]
+            if text.strip():
+                values, columns = _parse_lines(text, path, line, columns)
+                if len(values):
+                    yield values
+            line += text.count('\n')
+            if not block:
+                return
+
+
+def _parse_lines(text, path, line, columns):
+    """ Parses a chunk of whole lines of an XYZ file starting at the given line number into an (N,C) array, C is
+    columns or the number of columns of the first line holding a point if it is None. Returns the array and C.
+    """
+    lines = text.split('\n')
+    if '#' in text and not any(row.split('#', 1)[0].strip() for row in lines):
+        return np.zeros((0, columns or 3)), columns
+    try:
+        values = np.loadtxt(lines, comments='#', ndmin=2)
+    except ValueError:
+        values = None
+    if values is None or (columns is not None and values.shape[1] != columns):
+        _bad_line(lines, path, line, columns)
+    return values, values.shape[1]
+
+
+def _bad_line(lines, path, line, columns):
+    """ Raises a ValueError naming the first of the lines of an XYZ file, numbered from line on, that doesn't hold
+    columns numbers, or as many as the first line holding a point if columns is None
+    """
+    for number, row in enumerate(lines, line):
+        fields = row.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if columns is None:
+            columns = len(fields)
+        if len(fields) != columns:
+            raise ValueError("%s, line %d: expected %d columns, got %d" % (path, number, columns, len(fields)))
+        try:
+            [float(field) for field in fields]
+        except ValueError:
+            raise ValueError("%s, line %d: not a number in %r" % (path, number, row))
+    raise ValueError("%s: can't read lines %d to %d" % (path, line, line + len(lines) - 1))
+
+
+def normalization(chunks):
+    """ The center and scale that fit a point set into the unit ball, the centroid of the points and the largest
+    distance from it. chunks is a function returning a fresh iterable of (N,C) arrays, such as
+    lambda: read_xyz(path), which is gone through twice. The sums are accumulated per chunk, so the points never
+    have to be in memory together.
+    """
+    total, count = np.zeros(3), 0
+    for chunk in chunks():
+        total += chunk[:, :3].sum(0)
+        count += len(chunk)
+    if count == 0:
+        raise ValueError("There are no points to normalize")
+    center = total/count
+
+    scale = 0.
+    for chunk in chunks():
+        d = chunk[:, :3] - center
+        scale = max(scale, np.sqrt((d*d).sum(1).max()))
+    return center, scale if scale > 0 else 1.
+
+
+def load_xyz(tree, path, normalize=True, values=None, chunk_size=1 << 22):
+    """ Expands tree towards every point of an XYZ file, see read_xyz, one chunk at a time with expand_to_many. With
+    normalize the points are first moved into the unit ball with normalization, which takes two passes over the
+    points, so a file larger than chunk_size is read three times in all. A file that fits in a single chunk is only
+    read once. normalize may also be the (center, scale) pair returned by an earlier load of the same points, which
+    are then loaded in a single pass, as they are with normalize off, which suits a tree with a sparse root grid that
+    takes points anywhere. values sets what is stored in the leaves, nothing by default, 'points' for the normalized
+    points or 'columns' for the columns after the first three. Returns the center and scale the points were
+    normalized with.
+    """
+    if values not in (None, 'points', 'columns'):
+        raise ValueError("Unknown values %s, use None, 'points' or 'columns'" % values)
+    center, scale = np.zeros(3), 1.
+    chunks = lambda: read_xyz(path, chunk_size)
+    if isinstance(normalize, (tuple, list)):
+        center, scale = np.asarray(normalize[0], dtype=np.float64), normalize[1]
+    elif normalize:
+        if os.path.getsize(path) <= chunk_size:
+            points = list(chunks())
+            chunks = lambda: points
+        center, scale = normalization(chunks)
+
+    for chunk in chunks():
+        points = (chunk[:, :3] - center)/scale
+        if values == 'points':
+            tree.expand_to_many(points, values=[tuple(p) for p in points.tolist()])
+        elif values == 'columns':
+            tree.expand_to_many(points, values=[tuple(v) for v in chunk[:, 3:].tolist()])
+        else:
+            tree.expand_to_many(points)
+    return center, scale
@@ -10,6 +10,27 @@ This file contains an implementation of
  @author Joshua Horacsek, Simon Fraser University, Burnaby, Canada
  @version 0.1
 """
+import functools
+import heapq
+import itertools
+import math
+import os
+import pickle
+import struct
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from mmap import ACCESS_READ, mmap as _memory_map
+from timeit import default_timer
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory as _shared_memory
+except ImportError:
+    # Not available on every platform, only share and attach need it
+    _shared_memory = None
 
 
 class MSPTreeType:
@@ -21,6 +42,18 @@ class MSPTreeType:
 
     def __init__(self):
         pass
+
+
+class MSPStorageType:
+    """ Defines how the nodes of the tree are stored. Object storage keeps one Python object per node, compact storage
+    keeps the nodes in flat typed arrays and hands out lightweight handles, which uses a fraction of the memory.
+    Integer storage is compact storage with node positions kept as exact integer lattice keys, positions are only
+    converted to floats when read, so trees can grow far deeper than float positions allow.
+    """
+    Objects, Compact, Integer = range(3)
+
+    def __init__(self):
+        pass
    
     
 class _NodeType:
@@ -47,13 +80,569 @@ class MSPNodeException(Exception):
         return "(%s,%s) %s (%s)" % (self.node.color, self.node.lattice, self.error, str(self.node))
 
 
+#
+# Expansion rules. Each (lattice, color) pair maps to the lattice of its children, the factor applied to the scale
+# of the children, and the list of (offset, color) pairs of the children. Offsets are in units of the parent's scale,
+# an offset of None marks the child sitting on the parent's own position. The order of the children matters, ties in
+# the nearest child search go to the first child in the list.
+#
+
+_CC_BLUE_OFFSETS = [
+    (-0.5, 0.5, 0.0), (-0.5, 0.0, 0.5), (-0.5, -0.5, 0.0), (-0.5, 0.0, -0.5),
+    (0.0, 0.5, 0.5), (0.0, 0.5, -0.5), (0.0, -0.5, 0.5), (0.0, -0.5, -0.5),
+    (0.5, 0.5, 0.0), (0.5, 0.0, 0.5), (0.5, -0.5, 0.0), (0.5, 0.0, -0.5),
+]
+
+_CC_GHOST_OFFSETS = [
+    (0.5, 0.5, 0.5), (0.5, 0.5, -0.5), (0.5, -0.5, 0.5), (0.5, -0.5, -0.5),
+    (-0.5, 0.5, 0.5), (-0.5, 0.5, -0.5), (-0.5, -0.5, 0.5), (-0.5, -0.5, -0.5),
+]
+
+# These cases are based on parity, check the paper
+_FCC_CORNER_CHILDREN = [
+    ((0.25, 0.25, 0.25), _NodeColor.Node_Yellow), ((0.25, 0.25, -0.25), _NodeColor.Node_Green),
+    ((0.25, -0.25, 0.25), _NodeColor.Node_Green), ((0.25, -0.25, -0.25), _NodeColor.Node_Yellow),
+    ((-0.25, 0.25, -0.25), _NodeColor.Node_Yellow), ((-0.25, 0.25, 0.25), _NodeColor.Node_Green),
+    ((-0.25, -0.25, -0.25), _NodeColor.Node_Green), ((-0.25, -0.25, 0.25), _NodeColor.Node_Yellow),
+]
+
+_FCC_AXIS_OFFSETS = [
+    (0.5, 0.0, 0.0), (0.0, 0.5, 0.0), (0.0, 0.0, 0.5),
+    (-0.5, 0.0, 0.0), (0.0, -0.5, 0.0), (0.0, 0.0, -0.5),
+]
+
+_BCC_AXIS_OFFSETS = [
+    (0.25, 0.0, 0.0), (0.0, 0.25, 0.0), (0.0, 0.0, 0.25),
+    (-0.25, 0.0, 0.0), (0.0, -0.25, 0.0), (0.0, 0.0, -0.25),
+]
+
+_EXPANSION_RULES = {
+    (_NodeType.CC_Node, _NodeColor.Node_Red): (_NodeType.FCC_Node, 1.0, tuple(
+        [(None, _NodeColor.Node_Red)] +
+        [(o, _NodeColor.Node_Blue) for o in _CC_BLUE_OFFSETS] +
+        [(o, _NodeColor.Node_Ghost) for o in _CC_GHOST_OFFSETS])),
+    (_NodeType.CC_Node, _NodeColor.Node_Green): (_NodeType.FCC_Node, 1.0, tuple(
+        [(None, _NodeColor.Node_Green)] +
+        [(o, _NodeColor.Node_Blue) for o in _CC_BLUE_OFFSETS] +
+        [(o, _NodeColor.Node_Ghost) for o in _CC_GHOST_OFFSETS])),
+    (_NodeType.CC_Node, _NodeColor.Node_Blue): (_NodeType.FCC_Node, 1.0, (
+        (None, _NodeColor.Node_Red),)),
+    (_NodeType.CC_Node, _NodeColor.Node_Yellow): (_NodeType.FCC_Node, 1.0, (
+        (None, _NodeColor.Node_Green),)),
+
+    (_NodeType.FCC_Node, _NodeColor.Node_Red): (_NodeType.BCC_Node, 1.0, tuple(
+        [(None, _NodeColor.Node_Red)] +
+        _FCC_CORNER_CHILDREN +
+        [(o, _NodeColor.Node_Blue) for o in _FCC_AXIS_OFFSETS])),
+    (_NodeType.FCC_Node, _NodeColor.Node_Green): (_NodeType.BCC_Node, 1.0, tuple(
+        [(None, _NodeColor.Node_Red)] +
+        _FCC_CORNER_CHILDREN)),
+    (_NodeType.FCC_Node, _NodeColor.Node_Blue): (_NodeType.BCC_Node, 1.0, (
+        (None, _NodeColor.Node_Red),)),
+    (_NodeType.FCC_Node, _NodeColor.Node_Ghost): (_NodeType.BCC_Node, 1.0, (
+        (None, _NodeColor.Node_Blue),)),
+
+    (_NodeType.BCC_Node, _NodeColor.Node_Red): (_NodeType.CC_Node, 0.5, tuple(
+        [(None, _NodeColor.Node_Red)] +
+        [(o, _NodeColor.Node_Blue) for o in _BCC_AXIS_OFFSETS])),
+    (_NodeType.BCC_Node, _NodeColor.Node_Green): (_NodeType.CC_Node, 0.5, tuple(
+        [(None, _NodeColor.Node_Green)] +
+        [(o, _NodeColor.Node_Blue) for o in _BCC_AXIS_OFFSETS])),
+    (_NodeType.BCC_Node, _NodeColor.Node_Blue): (_NodeType.CC_Node, 0.5, (
+        (None, _NodeColor.Node_Red),)),
+    (_NodeType.BCC_Node, _NodeColor.Node_Yellow): (_NodeType.CC_Node, 0.5, (
+        (None, _NodeColor.Node_Green),)),
+}
+
+
+def _expansion_rule(node):
+    """ Looks up the expansion rule of a node, raises an MSPNodeException if the node can't be expanded
+    """
+    rule = _EXPANSION_RULES.get((node.lattice, node.color))
+    if rule is None:
+        if node.lattice not in (_NodeType.CC_Node, _NodeType.FCC_Node, _NodeType.BCC_Node):
+            raise MSPNodeException("Tree node had an invalid lattice type.", node)
+        raise MSPNodeException("Attempted to expand an invalid node color: %s" % node.color, node)
+    return rule
+
+
+#
+# Closest child selection without scanning. In units of a quarter of the parent's scale, the children of a node are
+#     CC nodes: {-2,0,2}^3 without the six points on the axes, a cubic lattice clamped to a cube
+#     FCC nodes: 0, the first shell (+-1,+-1,+-1) of a BCC lattice and for red nodes its second shell 2*e_i
+#     BCC nodes: 0 and the first shell e_i of a cubic lattice
+# For a cubic lattice the closest point is found by rounding each coordinate, within a shell the closest point lies in
+# the direction of the query, so the closest child follows from comparing a handful of candidates in closed form. The
+# costs below are squared distances relative to that of the parent. When the two best candidates are too close to call
+# in floating point the children are scanned instead, so the result is always the one the scan would give.
+#
+
+_RULE_SLOTS = dict(
+    (key, dict((tuple(int(round(4*c)) for c in (offset or (0., 0., 0.))), slot)
+               for slot, (offset, _) in enumerate(template)))
+    for key, (_, _, template) in _EXPANSION_RULES.items())
+
+_AMBIGUITY = 1e-9
+
+
+def _best_candidate(candidates, tolerance):
+    """ The offset of the cheapest (cost, offset) candidate, None if the runner up is within tolerance
+    """
+    best, runner_up = candidates[0], candidates[1]
+    if runner_up[0] < best[0]:
+        best, runner_up = runner_up, best
+    for candidate in candidates[2:]:
+        if candidate[0] < best[0]:
+            best, runner_up = candidate, best
+        elif candidate[0] < runner_up[0]:
+            runner_up = candidate
+    if runner_up[0] - best[0] < tolerance:
+        return None
+    return best[1]
+
+
+def _closest_cc_child(u0, u1, u2, slots, tolerance):
+    # Rounding each coordinate to {-2,0,2}, moving a coordinate off its best value costs at least |4 - 4|c||
+    g0, g1, g2 = abs(4 - 4*abs(u0)), abs(4 - 4*abs(u1)), abs(4 - 4*abs(u2))
+    if g0 < tolerance or g1 < tolerance or g2 < tolerance:
+        return None
+    key = (0 if -1 < u0 < 1 else (2 if u0 > 0 else -2),
+           0 if -1 < u1 < 1 else (2 if u1 > 0 else -2),
+           0 if -1 < u2 < 1 else (2 if u2 > 0 else -2))
+    slot = slots.get(key)
+    if slot is not None:
+        return slot
+
+    # Rounded onto an axis, the closest child either moves back to the origin or leaves the axis
+    candidates = []
+    for i, c in enumerate((u0, u1, u2)):
+        if key[i]:
+            candidates.append((4*abs(c) - 4, (0, 0, 0)))
+        else:
+            candidates.append((4 - 4*c, key[:i] + (2,) + key[i+1:]))
+            candidates.append((4 + 4*c, key[:i] + (-2,) + key[i+1:]))
+    best = _best_candidate(candidates, tolerance)
+    return None if best is None else slots[best]
+
+
+def _closest_fcc_child(u0, u1, u2, slots, tolerance):
+    a0, a1, a2 = abs(u0), abs(u1), abs(u2)
+    smallest = min(a0, a1, a2)
+
+    # The origin, the closest corner and the corner across its smallest coordinate
+    corner = 3 - 2*(a0 + a1 + a2)
+    candidates = [(0.0, 0), (corner, 1), (corner + 4*smallest, 2)]
+    if len(slots) > 9:
+        # and the two points on the axes closest to the query
+        largest, middle = sorted((a0, a1, a2))[:0:-1]
+        candidates.append((4 - 4*largest, 3))
+        candidates.append((4 - 4*middle, 4))
+    best = _best_candidate(candidates, tolerance)
+    if best is None or best == 2:
+        return None
+    if best == 0:
+        return 0
+    if best == 1:
+        return slots[(1 if u0 > 0 else -1, 1 if u1 > 0 else -1, 1 if u2 > 0 else -1)]
+    if a0 >= a1 and a0 >= a2:
+        return slots[(2 if u0 > 0 else -2, 0, 0)]
+    if a1 >= a2:
+        return slots[(0, 2 if u1 > 0 else -2, 0)]
+    return slots[(0, 0, 2 if u2 > 0 else -2)]
+
+
+def _closest_bcc_child(u0, u1, u2, slots, tolerance):
+    a0, a1, a2 = abs(u0), abs(u1), abs(u2)
+    if a0 >= a1 and a0 >= a2:
+        key, largest, middle = (1 if u0 > 0 else -1, 0, 0), a0, max(a1, a2)
+    elif a1 >= a2:
+        key, largest, middle = (0, 1 if u1 > 0 else -1, 0), a1, max(a0, a2)
+    else:
+        key, largest, middle = (0, 0, 1 if u2 > 0 else -1), a2, max(a0, a1)
+
+    # The origin against the two points on the axes closest to the query
+    best = _best_candidate([(0.0, (0, 0, 0)), (1 - 2*largest, key), (1 - 2*middle, None)], tolerance)
+    return None if best is None else slots[best]
+
+
+_QUANTIZERS = {
+    _NodeType.CC_Node: _closest_cc_child,
+    _NodeType.FCC_Node: _closest_fcc_child,
+    _NodeType.BCC_Node: _closest_bcc_child,
+}
+
+
+def _quantized_child(lattice, color, position, scale, point):
+    """ Slot of the child of the node (lattice, color, position, scale) closest to point, or None if the children have
+    to be scanned
+    """
+    slots = _RULE_SLOTS[(lattice, color)]
+    if len(slots) == 1:
+        return 0
+
+    q = 4.0/scale
+    ox, oy, oz = position[0], position[1], position[2]
+    u0, u1, u2 = (point[0] - ox)*q, (point[1] - oy)*q, (point[2] - oz)*q
+    if not (-16 < u0 < 16 and -16 < u1 < 16 and -16 < u2 < 16):
+        return None
+    # The rounding error of u grows with the magnitude of the coordinates relative to the scale
+    tolerance = _AMBIGUITY + 1e-12*q*(abs(ox) + abs(oy) + abs(oz) + 12*scale)
+    return _QUANTIZERS[lattice](u0, u1, u2, slots, tolerance)
+
+
+def _key_offset(point, key, level):
+    """ Offset from the node with the given lattice key to point, in units of the lattice spacing at level. The integer
+    parts are subtracted exactly, so the offset is accurate at any depth.
+    """
+    f = float(1 << (2 + level//3))
+    offset = []
+    for p, k in zip(point, key):
+        s = p*f
+        m = math.floor(s)
+        offset.append((int(m) - k) + (s - m))
+    return offset
+
+
+def _quantized_key_child(lattice, color, key, level, point):
+    """ _quantized_child for a node given by its integer lattice key. In these units a quarter of the node's scale is
+    exactly one, so the only rounding is that of the query point.
+    """
+    slots = _RULE_SLOTS[(lattice, color)]
+    if len(slots) == 1:
+        return 0
+
+    u0, u1, u2 = _key_offset(point, key, level)
+    if not (-16 < u0 < 16 and -16 < u1 < 16 and -16 < u2 < 16):
+        return None
+    return _QUANTIZERS[lattice](u0, u1, u2, slots, _AMBIGUITY)
+
+
+#
+# The expansion rules in array form, for descending many points at once. Rules are numbered, for each rule we keep
+# the (K,3) array of child offsets, the rule number of each child and the scale factor of the children.
+#
+
+_RULE_KEYS = sorted(_EXPANSION_RULES)
+_RULE_IDS = dict((key, i) for i, key in enumerate(_RULE_KEYS))
+_RULE_OFFSETS = [np.array([(0., 0., 0.) if offset is None else offset for offset, _ in _EXPANSION_RULES[key][2]])
+                 for key in _RULE_KEYS]
+_RULE_CHILDREN = [np.array([_RULE_IDS[(_EXPANSION_RULES[key][0], color)] for _, color in _EXPANSION_RULES[key][2]])
+                  for key in _RULE_KEYS]
+_RULE_FACTORS = [_EXPANSION_RULES[key][1] for key in _RULE_KEYS]
+_RULE_TABLE = np.full((3, 5), -1, dtype=int)
+_RULE_TABLE[tuple(np.array(_RULE_KEYS).T)] = np.arange(len(_RULE_KEYS))
+
+#
+# The expansion rules for integer coordinates. A node at level L is stored as its lattice key, its position times
+# 2^(2 + L/3). The offsets of its children are then whole multiples of a quarter of its scale, so a child key is the
+# parent key plus four times the offset, doubled whenever the child level starts a new scale.
+#
+
+_INTEGER_RULES = dict(
+    (key, tuple((tuple(int(round(4*c)) for c in (offset or (0., 0., 0.))), color) for offset, color in template))
+    for key, (_, _, template) in _EXPANSION_RULES.items())
+_RULE_QUARTERS = [np.array([offset for offset, _ in _INTEGER_RULES[key]], dtype=np.int64) for key in _RULE_KEYS]
+
+try:
+    _INT64 = array('q').typecode
+except ValueError:
+    _INT64 = 'l'
+
+_STORE_ARRAYS = ('x', 'y', 'z', 'scale', 'color', 'lattice', 'parent', 'first_child', 'child_count', 'level', 'slots')
+
+#
+# The file format of MSPTree.save. A header, a directory with the name, type code, item size, length and file offset of
+# every node array, then the arrays themselves aligned to 8 bytes, in the byte order of the machine that wrote them,
+# then optionally the node values pickled as a dictionary from node index to value. Since version 2 the header is
+# followed by the cell size of the root grid and whether it is sparse.
+#
+
+_FILE_MAGIC = b'MSPTREE\0'
+_FILE_VERSION = 2
+_FILE_HEADER = struct.Struct('<8sIcBBBIQQ')
+_FILE_GRID = struct.Struct('<dB7x')
+_FILE_ENTRY = struct.Struct('<16scBQQ')
+_FILE_ARRAYS = _STORE_ARRAYS + ('roots',)
+
+# Nodes stay within 2 of the origin, so their keys fit in 64 bits as long as 2^(3 + level/3) does. Nodes of a sparse
+# root grid stay within 2 cells of their root, which leaves fewer bits for the levels the further out the root is.
+_MAX_INTEGER_DEPTH = 3*60 - 1
+
+# The colors of the roots, by the number of odd coordinates of their cell
+_ROOT_COLORS = (_NodeColor.Node_Red, _NodeColor.Node_Yellow, _NodeColor.Node_Blue, _NodeColor.Node_Green)
+
+# The cells of the 27 roots of the unit grid, red, green, blue then yellow
+_UNIT_ROOTS = [
+    (0, 0, 0),
+
+    (1, 1, 1), (1, 1, -1), (1, -1, 1), (1, -1, -1), (-1, 1, 1), (-1, 1, -1), (-1, -1, 1), (-1, -1, -1),
+
+    (-1, 1, 0), (-1, 0, 1), (-1, 0, -1), (-1, -1, 0),
+    (0, 1, 1), (0, 1, -1), (0, -1, 1), (0, -1, -1),
+    (1, 1, 0), (1, 0, 1), (1, 0, -1), (1, -1, 0),
+
+    (1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1),
+]
+
+#
+# Offsets from a node to its neighbours at the same level, in lattice key units, which are a quarter of the node's
+# scale. The levels of a tree cycle through a CC lattice of spacing scale, an FCC lattice of cube edge scale and a BCC
+# lattice of cube edge scale/2. The face neighbours of a node share a face of its Voronoi cell, 6 on CC, 12 on FCC and
+# 8 + 6 on BCC, all neighbours share at least a corner, 26 on CC, 12 + 6 on FCC and the same 14 on BCC.
+#
+
+_UNIT_OFFSETS = [o for o in itertools.product((-1, 0, 1), repeat=3) if any(o)]
+_AXIS_UNITS = [o for o in _UNIT_OFFSETS if sum(map(abs, o)) == 1]
+_EDGE_UNITS = [o for o in _UNIT_OFFSETS if sum(map(abs, o)) == 2]
+_CORNER_UNITS = [o for o in _UNIT_OFFSETS if sum(map(abs, o)) == 3]
+
+
+def _scaled(offsets, factor):
+    return [(factor*o[0], factor*o[1], factor*o[2]) for o in offsets]
+
+
+_NEIGHBOR_OFFSETS = {
+    (_NodeType.CC_Node, 'face'): _scaled(_AXIS_UNITS, 4),
+    (_NodeType.CC_Node, 'all'): _scaled(_AXIS_UNITS + _EDGE_UNITS + _CORNER_UNITS, 4),
+    (_NodeType.FCC_Node, 'face'): _scaled(_EDGE_UNITS, 2),
+    (_NodeType.FCC_Node, 'all'): _scaled(_EDGE_UNITS, 2) + _scaled(_AXIS_UNITS, 4),
+    (_NodeType.BCC_Node, 'face'): _CORNER_UNITS + _scaled(_AXIS_UNITS, 2),
+    (_NodeType.BCC_Node, 'all'): _CORNER_UNITS + _scaled(_AXIS_UNITS, 2),
+}
+
+# The lattice of the nodes of a level, by level modulo 3
+_LEVEL_LATTICES = (_NodeType.CC_Node, _NodeType.FCC_Node, _NodeType.BCC_Node)
+
+
+def _neighbor_offsets(level, kind):
+    offsets = _NEIGHBOR_OFFSETS.get((_LEVEL_LATTICES[level % 3], kind))
+    if offsets is None:
+        raise ValueError("Unknown neighbour kind %s, use 'face' or 'all'" % kind)
+    return offsets
+
+
+def _subtree_reach(norm):
+    """ How far the descendants of a node can lie from it, in units of its scale, for each lattice type. Going from
+    a CC node through an FCC and a BCC node the scale halves, so a CC node reaches twice the sum of the largest child
+    offsets of the three lattices.
+    """
+    largest = [0.0]*3
+    for (lattice, _), (_, _, template) in _EXPANSION_RULES.items():
+        for offset, _ in template:
+            if offset is not None:
+                largest[lattice] = max(largest[lattice], norm(offset))
+    reach = [0.0]*3
+    reach[_NodeType.CC_Node] = 2*sum(largest)
+    reach[_NodeType.BCC_Node] = largest[_NodeType.BCC_Node] + 0.5*reach[_NodeType.CC_Node]
+    reach[_NodeType.FCC_Node] = largest[_NodeType.FCC_Node] + reach[_NodeType.BCC_Node]
+    # A little slack for the rounding of the positions
+    return np.array(reach)*(1 + 1e-9)
+
+
+_REACH = _subtree_reach(lambda o: math.sqrt(o[0]*o[0] + o[1]*o[1] + o[2]*o[2]))
+_REACH_MAX = _subtree_reach(lambda o: max(abs(o[0]), abs(o[1]), abs(o[2])))
+
+# The number of valued nodes knn_many gathers before computing their distances to a group of points at once
+_KNN_BATCH = 64
+
+
+def _closest_rows(points, positions):
+    """ For each point in an (N,3) array, the index of the closest row of a (N,K,3) or (K,3) array of positions,
+    the first row wins ties
+    """
+    dx = points[:, 0, None] - positions[..., 0]
+    dy = points[:, 1, None] - positions[..., 1]
+    dz = points[:, 2, None] - positions[..., 2]
+    return np.argmin(dx*dx + dy*dy + dz*dz, axis=1)
+
+
+def _cell_rows(points, cell_size, root_cells):
+    """ For each point in an (N,3) array, the index of the root of its cell of a sparse root grid of the given cell
+    size, looked up in a dictionary from cells to root indices, -1 for the points whose cell has no root
+    """
+    if len(points) == 0:
+        return np.zeros(0, dtype=int)
+    cells = np.floor(points/cell_size + 0.5).astype(np.int64)
+    unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+    found = np.array([root_cells.get(tuple(cell), -1) for cell in unique.tolist()], dtype=int)
+    return found[inverse.reshape(-1)]
+
+
+def _query_groups(points, size):
+    """ Splits the rows of an (N,3) array of points into groups of at most size nearby points, splitting a group at
+    the median of its points along the longest side of their bounding box until it is small enough. Returns a list of
+    arrays of row indices.
+    """
+    groups, stack = [], [np.arange(len(points))]
+    while stack:
+        rows = stack.pop()
+        if len(rows) <= size:
+            if len(rows):
+                groups.append(rows)
+            continue
+        p = points[rows]
+        rows = rows[np.argsort(p[:, np.argmax(p.max(0) - p.min(0))], kind='stable')]
+        stack.extend([rows[len(rows)//2:], rows[:len(rows)//2]])
+    return groups
+
+
+def _descend_paths(points, origins, scales, rules, depth):
+    """ Descends every point of an (N,3) array depth levels down from the nodes described by origins, scales and
+    rule numbers, without touching the tree. Child positions are computed exactly as expand_node computes them, so the
+    returned (N,depth) array holds the child picked at each level by the equivalent sequence of expand_to calls.
+    """
+    slots = np.zeros((len(points), depth), dtype=np.int8)
+    for level in range(depth):
+        next_origins = np.empty_like(origins)
+        next_scales = np.empty_like(scales)
+        next_rules = np.empty_like(rules)
+        for rule in np.unique(rules).tolist():
+            rows = np.nonzero(rules == rule)[0]
+            children = origins[rows, None, :] + _RULE_OFFSETS[rule][None, :, :]*scales[rows, None, None]
+            closest = _closest_rows(points[rows], children)
+            slots[rows, level] = closest
+            next_origins[rows] = children[np.arange(len(rows)), closest]
+            next_scales[rows] = scales[rows]*_RULE_FACTORS[rule]
+            next_rules[rows] = _RULE_CHILDREN[rule][closest]
+        origins, scales, rules = next_origins, next_scales, next_rules
+    return slots
+
+
+def _key_offsets(points, keys, levels):
+    """ Vectorized _key_offset for an (N,3) array of points, an (N,K,3) or (N,3) array of keys and their levels
+    """
+    s = np.clip(points*np.ldexp(1.0, 2 + np.asarray(levels)//3)[:, None], -2.0**62, 2.0**62)
+    if keys.ndim == 3:
+        s = s[:, None, :]
+    m = np.floor(s)
+    return (m.astype(np.int64) - keys) + (s - m)
+
+
+def _descend_keys(points, keys, levels, rules, depth):
+    """ _descend_paths for nodes given by their integer lattice keys, the arithmetic is exact at any depth
+    """
+    slots = np.zeros((len(points), depth), dtype=np.int8)
+    for level in range(depth):
+        next_keys = np.empty_like(keys)
+        next_rules = np.empty_like(rules)
+        shifts = (levels + 1)//3 - levels//3
+        for rule in np.unique(rules).tolist():
+            rows = np.nonzero(rules == rule)[0]
+            children = np.left_shift(keys[rows, None, :] + _RULE_QUARTERS[rule][None, :, :], shifts[rows, None, None])
+            d = _key_offsets(points[rows], children, levels[rows] + 1)
+            closest = np.argmin((d*d).sum(-1), axis=1)
+            slots[rows, level] = closest
+            next_keys[rows] = children[np.arange(len(rows)), closest]
+            next_rules[rows] = _RULE_CHILDREN[rule][closest]
+        keys, levels, rules = next_keys, levels + 1, next_rules
+    return slots
+
+
+def _build_subtree(args):
+    """ Process pool worker of MSPTree.build_parallel. Bulk loads points, which share a root, into a fresh tree of
+    the given storage. Returns its node arrays, the index of the leaf of each point, the index of the root and the
+    number of roots.
+    """
+    max_depth, storage, lazy, cell_size, points = args
+    tree = MSPTree(max_depth, storage=storage, lazy=lazy, cell_size=cell_size)
+    leaves = tree.bulk_load(points)
+    root = tree.roots[tree._root_rows(points[:1])[0]].index
+    return tree._store.arrays(), np.array([leaf.index for leaf in leaves], dtype=int), root, len(tree.roots)
+
+
+def _lattice_key(position, level, unit=1.):
+    """ Integer key of a node position at the given level. Nodes at a level sit on a grid of spacing 2^-(2 + level/3)
+    times the root scale unit, so scaling their coordinates by the inverse of that spacing gives exact integers.
+    """
+    factor = float(1 << (2 + level//3))/unit
+    return int(round(position[0]*factor)), int(round(position[1]*factor)), int(round(position[2]*factor))
+
+
+def _typecode(values):
+    """ The type code of an array.array, or the format of a memoryview standing in for one
+    """
+    return getattr(values, 'typecode', None) or values.format
+
+
+def _gather(values, indices):
+    """ Reads values[indices] from an array.array without copying the whole array
+    """
+    return np.frombuffer(values, dtype=_typecode(values))[indices]
+
+
+def _scatter(values, indices, new_values):
+    """ Writes values[indices] = new_values into an array.array
+    """
+    np.frombuffer(values, dtype=_typecode(values))[indices] = new_values
+
+
+def _extend(values, new_values):
+    """ Appends the contents of a NumPy array to an array.array
+    """
+    values.frombytes(memoryview(np.ascontiguousarray(new_values, dtype=_typecode(values))).cast('B'))
+
+
+def _timed(method):
+    """ Reports the time taken by a method of MSPTree to the stats of the tree, if it collects them
+    """
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        stats = self._stats
+        if stats is None:
+            return method(self, *args, **kwargs)
+        start = default_timer()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.record(method.__name__, default_timer() - start)
+    return timed
+
+
+def _locked(method):
+    """ Runs a method of MSPTree holding the lock of the tree
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def box_kernel(offsets):
+    """ Basis kernel giving every coefficient on the path of a point a weight of one
+    """
+    return np.ones(len(offsets))
+
+
+def hat_kernel(offsets):
+    """ Basis kernel falling off linearly from one at the node to zero at a distance of the node's scale
+    """
+    return np.maximum(0.0, 1.0 - np.sqrt((offsets*offsets).sum(1)))
+
+
 class MSPTree(object):
     """ MSP Tree Implementation
+
+    Trees can be shared between threads. Each tree has a reentrant lock, and every change to its structure is made
+    holding it: expanding a node, creating a lazy child, the batch methods such as expand_to_many, bulk_load and
+    insert, and collapsing subtrees for a budget. A node is only expanded once however many threads race for it, its
+    children are complete before they are published, a single assignment for object nodes and the first child index
+    written last in a compact store. Readers don't take the lock, find_closest_node, get_node, knn and the node
+    attributes always see a consistent tree, though not necessarily the nodes being added while they run. So expand_to
+    can run on many threads at once, only the expansions themselves are serialized. The batch readers of compact
+    trees, find_closest_many, knn_many, evaluate, extract_level and the queries, hold the lock while they read the
+    node arrays, since the arrays can't grow while NumPy is looking at them. Values are plain attributes, the last
+    write wins. Stats counters may miss updates made by several threads at once. With a budget set, readers also mark
+    the subtrees they go through as used, still without the lock. Collapsing subtrees while other threads read them
+    isn't safe with compact storage, whose rows get reused.
     """
 
     class _Node:
 
-        def __init__(self, position, color, lattice_type, value=None, scale=1.):
+        # Each object tree makes its nodes from a subclass setting tree to itself, so nodes don't carry the reference
+        tree = None
+
+        def __init__(self, position, color, lattice_type, value=None, scale=1., parent=None):
             """
 
             """
@@ -64,6 +653,15 @@ class MSPTree(object):
             self.lattice = lattice_type
             self.children = []
             self.scale = scale
+            self.parent = parent
+
+        @property
+        def level(self):
+            """ The depth of the node below its root. The scale halves every three levels and the lattice of the node
+            tells which of the three it is on, so the level isn't stored.
+            """
+            unit = self.tree.cell_size if self.tree is not None else 1.
+            return 3*(math.frexp(unit/self.scale)[1] - 1) + _LEVEL_LATTICES.index(self.lattice)
 
         def __unicode__(self):
             return "Node at %s" % str(self.position)
@@ -71,27 +669,49 @@ class MSPTree(object):
         def __str__(self):
             return "Node at %s" % str(self.position)
 
-        def find_closest_node(self, point):
-            dot = lambda x, y: abs((x[0]-y[0])*(x[0] - y[0]) + (x[1]-y[1])*(x[1] - y[1]) + (x[2]-y[2])*(x[2]-y[2]))
-            if len(self.children) <= 0:
-                return self
-            node = min([(dot(point, n.position), n) for n in self.children], key=lambda x: x[0])[1]
-            return node.find_closest_node(point)
+        def find_closest_node(self, point, level=-1):
+            """
+            Finds the node closest to point in this subtree, descending
+            at most level levels if level is not negative
+            """
+            node = self
+            while len(node.children) > 0 and level != 0:
+                node = node._closest_child(point)
+                level -= 1
+            return node
 
         def expand_to(self, point, depth=0, max_depth=12):
             """
             Expands the MSP down to the closest lattice max_depth
             levels deep
             """
+            node = self
+            while depth < max_depth:
+                if len(node.children) <= 0:
+                    node.expand_node()
+                node = node._closest_child(point)
+                depth += 1
+            return node
+
+        def _closest_child(self, point):
+            slot = _quantized_child(self.lattice, self.color, self.position, self.scale, point)
+            stats = self.tree._stats if self.tree is not None else None
+            if stats is not None:
+                stats.picks += 1
+            if slot is not None:
+                return self.children[slot]
+            if stats is not None:
+                stats.scans += 1
+                stats.distance_evaluations += len(self.children)
+            return self._scan_children(point)
+
+        def _scan_children(self, point):
+            # Child positions are computed from the expansion rule, so a lazily expanded node isn't materialized
             dot = lambda x, y: abs((x[0]-y[0])*(x[0] - y[0]) + (x[1]-y[1])*(x[1] - y[1]) + (x[2]-y[2])*(x[2]-y[2]))
-            if depth >= max_depth:
-                return self
-
-            if len(self.children) <= 0:
-                self.expand_node()
-
-            node = min([(dot(point, n.position), n) for n in self.children], key=lambda x: x[0])[1]
-            return node.expand_to(point, depth+1, max_depth)
+            o, scale = self.position, self.scale
+            positions = [o if offset is None else self._aas(o, offset, scale)
+                         for offset, _ in _EXPANSION_RULES[(self.lattice, self.color)][2]]
+            return self.children[min(range(len(positions)), key=lambda i: dot(point, positions[i]))]
 
         def expand_node(self):
             """
@@ -99,327 +719,2686 @@ class MSPTree(object):
             """
             if len(self.children) > 0:
                 return
+            if self.tree is None:
+                return self._expand()
+            with self.tree._lock:
+                self._expand()
 
-            scale = self.scale
-            if self.lattice == _NodeType.CC_Node:
-                #print 'cc'
-                self._expand_cc_node(scale)
-            elif self.lattice == _NodeType.BCC_Node:
-                #print 'bcc'
-                self._expand_bcc_node(scale)
-            elif self.lattice == _NodeType.FCC_Node:
-                #print 'fcc'
-                self._expand_fcc_node(scale)
-            else:
-                raise MSPNodeException("Tree node had an invalid lattice type.", self)
+        def _expand(self):
+            # The children are published by a single assignment once they are all made
+            if len(self.children) > 0:
+                return
+            lattice, factor, template = _expansion_rule(self)
+            if self.tree is not None and self.tree._stats is not None:
+                self.tree._stats.expansions += 1
+            if self.tree is not None and self.tree.lazy:
+                self.children = MSPTree._LazyChildren(self, len(template))
+                return
+            # The whole template is built in one go, into a list of the exact size, a list comprehension would
+            # over-allocate the list of every node. The children share the scale object of the node, or a single new
+            # one where the scale halves
+            node, (x, y, z), scale = type(self), self.position, self.scale
+            child_scale = scale if factor == 1 else scale*factor
+            children = [None]*len(template)
+            for slot, (offset, color) in enumerate(template):
+                children[slot] = node(self.position if offset is None else
+                                      (x + offset[0]*scale, y + offset[1]*scale, z + offset[2]*scale),
+                                      color, lattice, None, child_scale, self)
+            tree = self.tree
+            if tree is not None:
+                tree._object_count += len(children)
+                tree._changes += 1
+                if tree._index is not None:
+                    for child in children:
+                        tree._index.add(child.level, _lattice_key(child.position, child.level, tree.cell_size), child)
+            self.children = children
+
+        def _make_child(self, slot):
+            """ Creates the child in the given slot of the expansion rule of this node, for lazy expansion
+            """
+            lattice, factor, template = _EXPANSION_RULES[(self.lattice, self.color)]
+            offset, color = template[slot]
+            o = self.position
+            child = type(self)(o if offset is None else self._aas(o, offset, self.scale), color, lattice, None,
+                               self.scale if factor == 1 else self.scale*factor, self)
+            if self.tree is not None:
+                self.tree._object_count += 1
+                self.tree._changes += 1
+                if self.tree._index is not None:
+                    self.tree._index.add(child.level, _lattice_key(child.position, child.level, self.tree.cell_size),
+                                         child)
+            return child
 
         @staticmethod
         def _aas(a, b, scale):
             return a[0] + (b[0]*scale), a[1]+(b[1]*scale), a[2]+(b[2]*scale)
 
-        def _expand_cc_node(self, scale):
-            o = self.position
-            ns = self.scale
-            if self.color == _NodeColor.Node_Red:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.FCC_Node, None, ns),
-
-                    # Add child blue nodes
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.0, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.0, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.0, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.0, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.0, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    # Add ghost nodes
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                ]
-            elif self.color == _NodeColor.Node_Green:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Green, _NodeType.FCC_Node, None, ns),
-
-                    # Add child blue nodes
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.0, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.0, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.0, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.0, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.0, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.FCC_Node, None, ns),
-
-                    # Add ghost nodes
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.5, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, 0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, 0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.5, -0.5, -0.5), scale),
-                                  _NodeColor.Node_Ghost, _NodeType.FCC_Node, None, ns),
-                ]
-            elif self.color == _NodeColor.Node_Blue:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.FCC_Node, None, ns),
-                ]
-            elif self.color == _NodeColor.Node_Yellow:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Green, _NodeType.FCC_Node, None, ns),
-                ]
+    class _LazyChildren(object):
+        """ The children of a lazily expanded node. It behaves like the list of children, but a child is only created
+        the first time it is accessed. A descent only touches the child it picks, so the siblings it passes over,
+        ghosts included, are never created.
+        """
+        __slots__ = ('node', 'nodes')
+
+        def __init__(self, node, count):
+            self.node = node
+            self.nodes = [None]*count
+
+        def __len__(self):
+            return len(self.nodes)
+
+        def __getitem__(self, slot):
+            if isinstance(slot, slice):
+                return [self[i] for i in range(*slot.indices(len(self.nodes)))]
+            child = self.nodes[slot]
+            if child is None:
+                with self.node.tree._lock:
+                    child = self.nodes[slot]
+                    if child is None:
+                        child = self.nodes[slot] = self.node._make_child(slot % len(self.nodes))
+            return child
+
+        def __iter__(self):
+            for slot in range(len(self.nodes)):
+                yield self[slot]
+
+        def materialized(self):
+            """ The children created so far
+            """
+            return [child for child in self.nodes if child is not None]
+
+    @staticmethod
+    def _materialized(node):
+        """ The children of an object node that exist, without creating the missing children of a lazy node
+        """
+        if isinstance(node.children, MSPTree._LazyChildren):
+            return node.children.materialized()
+        return node.children
+
+    class _LatticeIndex(object):
+        """ Maps a level and an integer lattice key to the nodes sitting on that lattice point. Nodes of neighbouring
+        subtrees overlap, a ghost node for instance sits on top of a node of the next subtree over, so a lattice point
+        can hold several nodes. The first node added is kept in a plain dictionary, the others in a second one.
+        """
+
+        def __init__(self):
+            self.first = {}
+            self.others = {}
+
+        def __len__(self):
+            return len(self.first) + sum(len(nodes) for nodes in self.others.values())
+
+        def add(self, level, key, node):
+            key = (level, key[0], key[1], key[2])
+            if key in self.first:
+                self.others.setdefault(key, []).append(node)
             else:
-                raise MSPNodeException("Attempted to expand an invalid node color", self)
+                self.first[key] = node
+
+        def get(self, level, key):
+            return self.first.get((level, key[0], key[1], key[2]))
+
+        def get_all(self, level, key):
+            key = (level, key[0], key[1], key[2])
+            if key not in self.first:
+                return []
+            return [self.first[key]] + self.others.get(key, [])
+
+        def remove(self, level, key, node):
+            key = (level, key[0], key[1], key[2])
+            others = self.others.get(key)
+            if self.first.get(key) == node:
+                if others:
+                    self.first[key] = others.pop(0)
+                else:
+                    del self.first[key]
+            elif others and node in others:
+                others.remove(node)
+            if others is not None and not others:
+                del self.others[key]
+
+    class _NodeStore(object):
+        """ Compact node storage, every node is a row in a set of flat typed arrays. The children of a node are
+        allocated next to each other, so a node only needs to know where its first child is and how many it has.
+        Values are kept in a dictionary since only a few nodes ever carry one. With integer coordinates the position
+        arrays hold the lattice keys of the nodes as 64 bit integers, in units of the root scale unit.
+
+        A lazy store doesn't create the children of a node when it is expanded. The first child of an expanded node
+        points to a block in the slots array instead, which holds the index of each child once it has been created and
+        -1 until then.
+
+        A store opened from a file with MSPTree.load can be backed by read-only memoryviews of the memory mapped file,
+        which are copied into arrays the first time the store has to change.
+
+        Collapsing a node removes its descendants. Their rows are marked with a parent of -2 and their child blocks
+        (slot blocks in a lazy store) are put on free lists by size, which later expansions take from before growing
+        the arrays.
+        """
 
-        def _expand_fcc_node(self, scale):
-            o = self.position
-            ns = self.scale
-            if self.color == _NodeColor.Node_Red:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.BCC_Node, None, ns),
-
-                    # These cases are based on parity, check the paper
-                    MSPTree._Node(self._aas(o, (0.25, 0.25, 0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, 0.25, -0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, -0.25, 0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, -0.25, -0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.25, 0.25, -0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, 0.25, 0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, -0.25, -0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, -0.25, 0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.5, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, 0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.5, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.5, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, -0.5), scale),
-                                  _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns),
-
-                ]
-            elif self.color == _NodeColor.Node_Green:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.BCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.25, 0.25, 0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, 0.25, -0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, -0.25, 0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.25, -0.25, -0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.25, 0.25, -0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, 0.25, 0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, -0.25, -0.25), scale),
-                                  _NodeColor.Node_Green, _NodeType.BCC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (-0.25, -0.25, 0.25), scale),
-                                  _NodeColor.Node_Yellow, _NodeType.BCC_Node, None, ns),
-                ]
-            elif self.color == _NodeColor.Node_Blue:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.BCC_Node, None, ns)
-                ]
-            elif self.color == _NodeColor.Node_Ghost:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Blue, _NodeType.BCC_Node, None, ns)
-                ]
+        def __init__(self, integer=False, lazy=False):
+            self.integer = integer
+            self.lazy = lazy
+            self.unit = 1.
+            self.slots = array('i')
+            self.x = array(_INT64 if integer else 'd')
+            self.y = array(_INT64 if integer else 'd')
+            self.z = array(_INT64 if integer else 'd')
+            self.scale = array('d')
+            self.color = array('b')
+            self.lattice = array('b')
+            self.parent = array('i')
+            self.first_child = array('i')
+            self.child_count = array('B')
+            self.level = array('H')
+            self.values = {}
+            self.index = None
+            self.stats = None
+            self.lock = threading.RLock()
+            self.mapped = None
+            self.free = {}
+            self.free_slots = {}
+            self.dead = 0
+            # Counts the compactions, which move the rows, see MSPTree.evaluate
+            self.changes = 0
+
+        def __len__(self):
+            return len(self.x)
+
+        def live(self):
+            """ Number of nodes in the store, not counting the rows of collapsed nodes
+            """
+            return len(self.x) - self.dead
+
+        def recycle(self, count):
+            """ The first row of a free block of count rows, or None if there is none
+            """
+            blocks = self.free.get(count)
+            if not blocks:
+                return None
+            self.dead -= count
+            return blocks.pop()
+
+        def nbytes(self):
+            """ Number of bytes used by the node arrays, not counting stored values
+            """
+            arrays = (self.x, self.y, self.z, self.scale, self.color, self.lattice,
+                      self.parent, self.first_child, self.child_count, self.level, self.slots)
+            return sum(a.itemsize*len(a) for a in arrays)
+
+        def position(self, index):
+            if self.integer:
+                f = self.unit/(1 << (2 + self.level[index]//3))
+                return self.x[index]*f, self.y[index]*f, self.z[index]*f
+            return self.x[index], self.y[index], self.z[index]
+
+        def positions(self, indices):
+            """ The positions of an array of indices, as an array with an extra axis of length 3
+            """
+            positions = np.stack([_gather(self.x, indices), _gather(self.y, indices), _gather(self.z, indices)], -1)
+            if self.integer:
+                return positions*(self.unit/np.left_shift(1, 2 + _gather(self.level, indices)//3)[..., None])
+            return positions
+
+        def child_position(self, index, slot):
+            """ The position of the child in the given slot of the node at index, or its lattice key with integer
+            coordinates. The child doesn't have to exist.
+            """
+            key = (self.lattice[index], self.color[index])
+            if self.integer:
+                offset = _INTEGER_RULES[key][slot][0]
+                level = self.level[index] + 1
+                shift = level//3 - (level - 1)//3
+                return (self.x[index] + offset[0]) << shift, (self.y[index] + offset[1]) << shift, \
+                    (self.z[index] + offset[2]) << shift
+            offset = _EXPANSION_RULES[key][2][slot][0]
+            if offset is None:
+                return self.x[index], self.y[index], self.z[index]
+            scale = self.scale[index]
+            return self.x[index] + (offset[0]*scale), self.y[index] + (offset[1]*scale), \
+                self.z[index] + (offset[2]*scale)
+
+        def child_positions(self, parents, rule):
+            """ child_position for an array of parents sharing an expansion rule, as an (N,K,3) array
+            """
+            origins = np.stack([_gather(self.x, parents), _gather(self.y, parents), _gather(self.z, parents)], 1)
+            if self.integer:
+                levels = _gather(self.level, parents) + 1
+                shifts = (levels//3 - (levels - 1)//3)[:, None, None]
+                return np.left_shift(origins[:, None, :] + _RULE_QUARTERS[rule][None, :, :], shifts)
+            scales = _gather(self.scale, parents).astype(np.float64)
+            return origins[:, None, :] + _RULE_OFFSETS[rule][None, :, :]*scales[:, None, None]
+
+        def child_offsets(self, parents, rule, points):
+            """ The offsets from the children of an array of parents sharing an expansion rule to an (N,3) array of
+            points. With integer coordinates the offsets are in units of the lattice spacing of the children, which
+            keeps them exact at any depth.
+            """
+            children = self.child_positions(parents, rule)
+            if self.integer:
+                return _key_offsets(points/self.unit, children, _gather(self.level, parents) + 1)
+            return points[:, None, :] - children
+
+        def make_writable(self):
+            """ Copies the arrays of a memory mapped store into memory so the store can change
+            """
+            for name in _STORE_ARRAYS:
+                view = getattr(self, name)
+                values = array(view.format)
+                if len(view):
+                    values.frombytes(view.tobytes())
+                setattr(self, name, values)
+            # A shared memory block can only be closed once no view of it is left
+            view = None
+            self.mapped = None
+
+        def arrays(self):
+            """ Copies of the node arrays as NumPy arrays, by name
+            """
+            return dict((name, np.frombuffer(getattr(self, name), dtype=_typecode(getattr(self, name))).copy())
+                        for name in _STORE_ARRAYS)
+
+        def merge(self, arrays, root, other_root, start):
+            """ Appends the nodes of another store of the same kind below the unexpanded node root. arrays holds the
+            node arrays of the other store, its nodes from start on must all descend from its node other_root, which
+            takes the place of root. Returns the number added to the index of a node of the other store.
+            """
+            with self.lock:
+                return self._merge(arrays, root, other_root, start)
+
+        def _merge(self, arrays, root, other_root, start):
+            if self.mapped is not None:
+                self.make_writable()
+            offset = len(self) - start
+            slot_offset = len(self.slots)
+
+            def nodes(indices):
+                return np.where(indices == other_root, root, np.where(indices < 0, -1, indices + offset))
+
+            first_child = arrays['first_child']
+            if self.lazy:
+                first_child = np.where(first_child < 0, -1, first_child + slot_offset)
             else:
-                raise MSPNodeException("Attempted to expand an invalid node color", self)
+                first_child = nodes(first_child)
+            for name in _STORE_ARRAYS:
+                if name == 'slots':
+                    _extend(self.slots, nodes(arrays['slots']))
+                elif name == 'parent':
+                    _extend(self.parent, nodes(arrays['parent'][start:]))
+                elif name == 'first_child':
+                    _extend(self.first_child, first_child[start:])
+                else:
+                    _extend(getattr(self, name), arrays[name][start:])
+            self.first_child[root] = int(first_child[other_root])
+            self.child_count[root] = int(arrays['child_count'][other_root])
+            if self.index is not None:
+                self.index_range(start + offset, len(self))
+            return offset
+
+        def key(self, index):
+            """ The lattice key of the node at index
+            """
+            if self.integer:
+                return self.x[index], self.y[index], self.z[index]
+            return _lattice_key((self.x[index], self.y[index], self.z[index]), self.level[index], self.unit)
 
-        def _expand_bcc_node(self, scale):
-            o = self.position
-            ns = self.scale*0.5
-            if self.color == _NodeColor.Node_Red:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.CC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.25, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.25, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, 0.25), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.25, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.25, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, -0.25), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-
-                ]
-            elif self.color == _NodeColor.Node_Green:
-                self.children = [
-
-                    MSPTree._Node(o, _NodeColor.Node_Green, _NodeType.CC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (0.25, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.25, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, 0.25), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-
-                    MSPTree._Node(self._aas(o, (-0.25, 0.0, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, -0.25, 0.0), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-                    MSPTree._Node(self._aas(o, (0.0, 0.0, -0.25), scale),
-                                  _NodeColor.Node_Blue, _NodeType.CC_Node, None, ns),
-
-                ]
-            elif self.color == _NodeColor.Node_Blue:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Red, _NodeType.CC_Node, None, ns)
-                ]
-            elif self.color == _NodeColor.Node_Yellow:
-                self.children = [
-                    MSPTree._Node(o, _NodeColor.Node_Green, _NodeType.CC_Node, None, ns)
-                ]
+        def add_node(self, position, color, lattice_type, scale=1., parent=-1, level=0, index=None):
+            """ Appends a node, or writes it over the free row at index. position is the lattice key of the node when
+            the store uses integer coordinates.
+            """
+            if self.mapped is not None:
+                self.make_writable()
+            if index is None:
+                index = len(self.x)
+                for name in ('x', 'y', 'z', 'scale', 'color', 'lattice', 'parent', 'first_child', 'child_count',
+                             'level'):
+                    getattr(self, name).append(0)
+            self.x[index], self.y[index], self.z[index] = position[0], position[1], position[2]
+            self.scale[index] = scale
+            self.color[index] = color
+            self.lattice[index] = lattice_type
+            self.parent[index] = parent
+            self.first_child[index] = -1
+            self.child_count[index] = 0
+            self.level[index] = level
+            if self.index is not None:
+                self.index.add(level, self.key(index), index)
+            return index
+
+        def expand(self, index):
+            """ Expands the node at index, the children are appended to the end of the store. The first child of the
+            node is written last, so readers see either no children or all of them.
+            """
+            if self.first_child[index] >= 0:
+                return
+
+            with self.lock:
+                if self.first_child[index] >= 0:
+                    return
+                lattice, factor, template = _expansion_rule(MSPTree._NodeHandle(self, index))
+                if self.mapped is not None:
+                    self.make_writable()
+                if self.stats is not None:
+                    self.stats.expansions += 1
+                if self.lazy:
+                    blocks = self.free_slots.get(len(template))
+                    if blocks:
+                        first = blocks.pop()
+                        for i in range(first, first + len(template)):
+                            self.slots[i] = -1
+                    else:
+                        first = len(self.slots)
+                        self.slots.extend([-1]*len(template))
+                else:
+                    ns = self.scale[index]*factor
+                    level = self.level[index] + 1
+                    reused = self.recycle(len(template))
+                    first = len(self.x) if reused is None else reused
+                    for slot, (_, color) in enumerate(template):
+                        self.add_node(self.child_position(index, slot), color, lattice, ns, index, level,
+                                      None if reused is None else reused + slot)
+                self.child_count[index] = len(template)
+                self.first_child[index] = first
+
+        def collapse(self, index):
+            """ Removes the descendants of the node at index, which becomes a leaf again. Their values are dropped,
+            returns their indices.
+            """
+            with self.lock:
+                return self._collapse(index)
+
+        def drop(self, index):
+            """ Removes the unexpanded node at index from a lazy store, its slot is emptied so its parent creates it
+            again when it is next accessed
+            """
+            with self.lock:
+                if self.mapped is not None:
+                    self.make_writable()
+                parent = self.parent[index]
+                first = self.first_child[parent]
+                for slot in range(first, first + self.child_count[parent]):
+                    if self.slots[slot] == index:
+                        self.slots[slot] = -1
+                if self.index is not None:
+                    self.index.remove(self.level[index], self.key(index), index)
+                self.values.pop(index, None)
+                self.parent[index] = -2
+                self.free.setdefault(1, []).append(index)
+                self.dead += 1
+
+        def _collapse(self, index):
+            if self.mapped is not None:
+                self.make_writable()
+            removed = []
+            stack = [index]
+            while stack:
+                node = stack.pop()
+                first, count = self.first_child[node], self.child_count[node]
+                if first < 0:
+                    continue
+                children = list(self.child_list(node))
+                if self.lazy:
+                    self.free_slots.setdefault(count, []).append(first)
+                    self.free.setdefault(1, []).extend(children)
+                else:
+                    self.free.setdefault(count, []).append(first)
+                self.first_child[node] = -1
+                self.child_count[node] = 0
+                stack.extend(children)
+                removed.extend(children)
+            for node in removed:
+                if self.index is not None:
+                    self.index.remove(self.level[node], self.key(node), node)
+                self.values.pop(node, None)
+                self.parent[node] = -2
+            self.dead += len(removed)
+            return removed
+
+        def compact(self):
+            """ Drops the rows of collapsed nodes and the free slot blocks, keeping the order of the other rows and
+            their child blocks together. Returns an array with the new index of every old row, -1 for dropped rows.
+            """
+            with self.lock:
+                if self.mapped is not None:
+                    self.make_writable()
+                arrays = dict((name, np.frombuffer(getattr(self, name), dtype=_typecode(getattr(self, name))).copy())
+                              for name in _STORE_ARRAYS)
+                live = arrays['parent'] != -2
+                moved = np.where(live, np.cumsum(live) - 1, -1)
+
+                def remap(indices):
+                    return np.where(indices >= 0, moved[np.maximum(indices, 0)], indices)
+
+                first_child = arrays['first_child'][live]
+                if self.lazy:
+                    # The slot blocks of the remaining expanded nodes are packed in the order of the nodes
+                    counts = np.where(first_child >= 0, arrays['child_count'][live], 0).astype(int)
+                    starts = np.cumsum(counts) - counts
+                    old = np.repeat(first_child - starts, counts) + np.arange(counts.sum())
+                    arrays['slots'] = remap(arrays['slots'][old])
+                    first_child = np.where(first_child >= 0, starts, -1)
+                else:
+                    first_child = remap(first_child)
+                for name in _STORE_ARRAYS:
+                    if name == 'first_child':
+                        values = first_child
+                    elif name == 'parent':
+                        values = remap(arrays['parent'][live])
+                    elif name == 'slots':
+                        values = arrays['slots']
+                    else:
+                        values = arrays[name][live]
+                    setattr(self, name, array(_typecode(getattr(self, name))))
+                    _extend(getattr(self, name), values)
+
+                self.values = dict((int(moved[i]), value) for i, value in self.values.items())
+                self.free, self.free_slots, self.dead = {}, {}, 0
+                self.changes += 1
+                if self.index is not None:
+                    self.index.first, self.index.others = {}, {}
+                    self.index_range(0, len(self))
+                return moved
+
+        def child_list(self, index):
+            """ The existing children of the node at index
+            """
+            first = self.first_child[index]
+            if first < 0:
+                return []
+            if self.lazy:
+                return [c for c in self.slots[first:first + self.child_count[index]] if c >= 0]
+            return range(first, first + self.child_count[index])
+
+        def children_of(self, indices):
+            """ The existing children of every node in an array of indices, as one array
+            """
+            first = _gather(self.first_child, indices)
+            indices, first = indices[first >= 0], first[first >= 0]
+            counts = _gather(self.child_count, indices).astype(int)
+            starts = np.repeat(first - (np.cumsum(counts) - counts), counts)
+            children = starts + np.arange(counts.sum())
+            if self.lazy:
+                children = _gather(self.slots, children)
+                return children[children >= 0]
+            return children
+
+        def closest_children(self, parents, points, create=True):
+            """ The closest child of each expanded node in an array of parents to each point of an (N,3) array. Without
+            create a lazy store returns -1 where the closest child doesn't exist yet.
+            """
+            closest = np.empty(len(parents), dtype=int)
+            rules = _RULE_TABLE[_gather(self.lattice, parents), _gather(self.color, parents)]
+            for rule in np.unique(rules).tolist():
+                rows = rules == rule
+                d = self.child_offsets(parents[rows], rule, points[rows])
+                slots = np.argmin((d*d).sum(-1), axis=1)
+                if self.stats is not None:
+                    self.stats.picks += len(d)
+                    self.stats.distance_evaluations += d.shape[0]*d.shape[1]
+                if self.lazy and not create:
+                    closest[rows] = _gather(self.slots, _gather(self.first_child, parents[rows]) + slots)
+                else:
+                    closest[rows] = self.children_at(parents[rows], slots)
+            return closest
+
+        def child(self, index, slot):
+            """ Index of the child in the given slot of the expanded node at index, a lazy store creates it if needed
+            """
+            if not self.lazy:
+                return self.first_child[index] + slot
+            i = self.first_child[index] + slot
+            child = self.slots[i]
+            if child >= 0:
+                return child
+            with self.lock:
+                child = self.slots[i]
+                if child < 0:
+                    if self.mapped is not None:
+                        self.make_writable()
+                    lattice, factor, template = _EXPANSION_RULES[(self.lattice[index], self.color[index])]
+                    child = self.slots[i] = self.add_node(self.child_position(index, slot), template[slot][1],
+                                                          lattice, self.scale[index]*factor, index,
+                                                          self.level[index] + 1, self.recycle(1))
+            return child
+
+        def children_at(self, parents, slots):
+            """ child for an array of parents and an array of slots
+            """
+            first = _gather(self.first_child, parents) + slots
+            if not self.lazy:
+                return first
+            children = _gather(self.slots, first)
+            for row in np.nonzero(children < 0)[0].tolist():
+                children[row] = self.child(int(parents[row]), int(slots[row]))
+            return children
+
+        def expand_many(self, indices):
+            """ Expands every node in an array of indices, all nodes sharing an expansion rule are expanded at once.
+            The children are laid out in the order of the indices of their parents.
+            """
+            with self.lock:
+                self._expand_many(indices)
+
+        def _expand_many(self, indices):
+            indices = np.unique(indices)
+            indices = indices[_gather(self.first_child, indices) < 0]
+            if len(indices) == 0:
+                return
+
+            keys = list(zip(_gather(self.lattice, indices).tolist(), _gather(self.color, indices).tolist()))
+            for index, key in zip(indices.tolist(), keys):
+                if key not in _RULE_IDS:
+                    self.expand(index)
+            rules = np.array([_RULE_IDS[key] for key in keys], dtype=int)
+            if self.mapped is not None:
+                self.make_writable()
+
+            counts = np.array([len(_EXPANSION_RULES[key][2]) for key in keys], dtype=int)
+            free = self.free_slots if self.lazy else self.free
+            if any(free.values()):
+                # Nodes whose child block can take the place of a collapsed one are expanded one at a time
+                reuse = np.array([bool(free.get(count)) for count in counts.tolist()])
+                for index in indices[reuse].tolist():
+                    self.expand(index)
+                keep = ~reuse
+                indices, rules, counts = indices[keep], rules[keep], counts[keep]
+                if len(indices) == 0:
+                    return
+            if self.stats is not None:
+                self.stats.expansions += len(indices)
+            offsets = np.cumsum(counts) - counts
+            _scatter(self.child_count, indices, counts)
+            if self.lazy:
+                first = len(self.slots)
+                _extend(self.slots, np.full(counts.sum(), -1))
+                _scatter(self.first_child, indices, first + offsets)
+                return
+
+            # The children of all rules are gathered in one block, each parent's children at its offset in the block
+            positions = np.empty((counts.sum(), 3), dtype=np.int64 if self.integer else np.float64)
+            scales = np.empty(counts.sum())
+            colors = np.empty(counts.sum(), dtype=int)
+            lattices = np.empty(counts.sum(), dtype=int)
+            for rule in np.unique(rules).tolist():
+                select = rules == rule
+                parents = indices[select]
+                lattice, factor, template = _EXPANSION_RULES[_RULE_KEYS[rule]]
+                rows = (offsets[select, None] + np.arange(len(template))).ravel()
+                positions[rows] = self.child_positions(parents, rule).reshape(-1, 3)
+                scales[rows] = np.repeat(_gather(self.scale, parents).astype(np.float64)*factor, len(template))
+                colors[rows] = np.tile([color for _, color in template], len(parents))
+                lattices[rows] = lattice
+
+            first = len(self.x)
+            _extend(self.x, positions[:, 0])
+            _extend(self.y, positions[:, 1])
+            _extend(self.z, positions[:, 2])
+            _extend(self.scale, scales)
+            _extend(self.color, colors)
+            _extend(self.lattice, lattices)
+            _extend(self.parent, np.repeat(indices, counts))
+            _extend(self.first_child, np.full(len(positions), -1))
+            _extend(self.child_count, np.zeros(len(positions)))
+            _extend(self.level, np.repeat(_gather(self.level, indices) + 1, counts))
+            _scatter(self.first_child, indices, first + offsets)
+            if self.index is not None:
+                self.index_range(first, len(self.x))
+
+        def index_range(self, start, stop):
+            """ Adds the nodes in [start, stop) to the lattice index
+            """
+            indices = np.arange(start, stop)
+            if self.dead:
+                indices = indices[_gather(self.parent, indices) != -2]
+            levels = _gather(self.level, indices)
+            for i, level, key in zip(indices.tolist(), levels.tolist(), self.keys(indices).tolist()):
+                self.index.add(level, key, i)
+
+        def keys(self, indices):
+            """ key for an array of indices, as an (N,3) array
+            """
+            keys = np.stack([_gather(self.x, indices), _gather(self.y, indices), _gather(self.z, indices)], 1)
+            if self.integer:
+                return keys
+            levels = _gather(self.level, indices)
+            return np.rint(keys*(np.left_shift(1, 2 + levels//3)[:, None]/self.unit)).astype(np.int64)
+
+        def closest_child(self, index, point):
+            """ Index of the child of index closest to point, the first child wins ties
+            """
+            if self.integer:
+                point = (point[0]/self.unit, point[1]/self.unit, point[2]/self.unit)
+                slot = _quantized_key_child(self.lattice[index], self.color[index], self.key(index), self.level[index],
+                                            point)
             else:
-                raise MSPNodeException("Attempted to expand an invalid node color: %s" % self.color, self)
+                slot = _quantized_child(self.lattice[index], self.color[index], self.position(index),
+                                        self.scale[index], point)
+            if self.stats is not None:
+                self.stats.picks += 1
+                if slot is None:
+                    self.stats.scans += 1
+                    self.stats.distance_evaluations += self.child_count[index]
+            if slot is None:
+                slot = self.scan_children(index, point)
+            return self.child(index, slot)
+
+        def scan_children(self, index, point):
+            """ Slot of the child of index closest to point, found by comparing against every child position. With
+            integer coordinates point is in units of the root scale unit.
+            """
+            px, py, pz = point[0], point[1], point[2]
+            level = self.level[index] + 1
+            best, best_d = 0, None
+            for slot in range(self.child_count[index]):
+                if self.integer:
+                    # All children share a level, so distances in units of its spacing compare the same way
+                    x, y, z = _key_offset(point, self.child_position(index, slot), level)
+                    d = x*x + y*y + z*z
+                else:
+                    x, y, z = self.child_position(index, slot)
+                    d = abs((px-x)*(px-x) + (py-y)*(py-y) + (pz-z)*(pz-z))
+                if best_d is None or d < best_d:
+                    best, best_d = slot, d
+            return best
+
+        def find_closest(self, index, point, level=-1):
+            while self.first_child[index] >= 0 and level != 0:
+                index = self.closest_child(index, point)
+                level -= 1
+            return index
+
+        def expand_to(self, index, point, depth, max_depth):
+            while depth < max_depth:
+                self.expand(index)
+                index = self.closest_child(index, point)
+                depth += 1
+            return index
+
+    class _NodeHandle(object):
+        """ A lightweight reference to a node in a _NodeStore, it exposes the same interface as _Node
+        """
+        __slots__ = ('store', 'index')
+
+        def __init__(self, store, index):
+            self.store = store
+            self.index = index
+
+        def __eq__(self, other):
+            return isinstance(other, MSPTree._NodeHandle) and self.store is other.store and self.index == other.index
+
+        def __ne__(self, other):
+            return not self == other
+
+        def __hash__(self):
+            return hash((id(self.store), self.index))
+
+        def __unicode__(self):
+            return "Node at %s" % str(self.position)
+
+        def __str__(self):
+            return "Node at %s" % str(self.position)
+
+        @property
+        def position(self):
+            return self.store.position(self.index)
+
+        @property
+        def color(self):
+            return self.store.color[self.index]
+
+        @property
+        def lattice(self):
+            return self.store.lattice[self.index]
+
+        @property
+        def scale(self):
+            return self.store.scale[self.index]
+
+        @property
+        def level(self):
+            return self.store.level[self.index]
+
+        @property
+        def children(self):
+            store = self.store
+            if store.first_child[self.index] < 0:
+                return []
+            return [MSPTree._NodeHandle(store, store.child(self.index, slot))
+                    for slot in range(store.child_count[self.index])]
+
+        @property
+        def value(self):
+            try:
+                return self.store.values[self.index]
+            except KeyError:
+                raise AttributeError('value')
+
+        @value.setter
+        def value(self, value):
+            self.store.values[self.index] = value
+
+        @value.deleter
+        def value(self):
+            self.store.values.pop(self.index, None)
+
+        def find_closest_node(self, point, level=-1):
+            """
+            Finds the node closest to point in this subtree, descending
+            at most level levels if level is not negative
+            """
+            return MSPTree._NodeHandle(self.store, self.store.find_closest(self.index, point, level))
+
+        def expand_to(self, point, depth=0, max_depth=12):
+            """
+            Expands the MSP down to the closest lattice max_depth
+            levels deep
+            """
+            return MSPTree._NodeHandle(self.store, self.store.expand_to(self.index, point, depth, max_depth))
+
+        def expand_node(self):
+            self.store.expand(self.index)
 
     #
     #
     #
 
-    def __init__(self, max_depth, tree_type=MSPTreeType.FunctionSpace):
+    def __init__(self, max_depth, tree_type=MSPTreeType.FunctionSpace, storage=MSPStorageType.Objects,
+                 indexed=False, lazy=False, bucket_capacity=8, cell_size=None):
         """ Initializes the tree, whose default expansion is the unit CC
-        grid with the 27 points in {-1,0,1}^3
-        """
-        self.roots = [
-            self._Node((0, 0, 0), _NodeColor.Node_Red, _NodeType.CC_Node),
-
-            # Green nodes
-            self._Node((1, 1, 1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((1, 1, -1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((1, -1, 1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((1, -1, -1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((-1, 1, 1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((-1, 1, -1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((-1, -1, 1), _NodeColor.Node_Green, _NodeType.CC_Node),
-            self._Node((-1, -1, -1), _NodeColor.Node_Green, _NodeType.CC_Node),
-
-            # Blue nodes
-            self._Node((-1, 1, 0), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((-1, 0, 1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((-1, 0, -1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((-1, -1, 0), _NodeColor.Node_Blue, _NodeType.CC_Node),
-
-            self._Node((0, 1, 1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((0, 1, -1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((0, -1, 1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((0, -1, -1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-
-            self._Node((1, 1, 0), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((1, 0, 1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((1, 0, -1), _NodeColor.Node_Blue, _NodeType.CC_Node),
-            self._Node((1, -1, 0), _NodeColor.Node_Blue, _NodeType.CC_Node),
-
-            # Yellow nodes
-            self._Node((1, 0, 0), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-            self._Node((-1, 0, 0), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-            self._Node((0, 1, 0), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-            self._Node((0, -1, 0), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-            self._Node((0, 0, 1), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-            self._Node((0, 0, -1), _NodeColor.Node_Yellow, _NodeType.CC_Node),
-        ]
+        grid with the 27 points in {-1,0,1}^3. Given a cell_size the tree
+        has a sparse root grid instead, a CC grid of that spacing covering
+        all of space whose roots are created the first time a point falls
+        in their cell, see roots. A lazy tree only creates the children of
+        an expanded node as they are accessed. The leaves of a space
+        partitioning tree hold up to bucket_capacity points before they
+        are split, see insert.
+        """
+        if cell_size is not None and not cell_size > 0:
+            raise ValueError("The cell size must be positive")
+        self.lazy = lazy
+        self.sparse = cell_size is not None
+        self.cell_size = float(cell_size) if self.sparse else 1.
+        self._index = MSPTree._LatticeIndex() if indexed else None
+        self._object_count = 0
+        # Counts the nodes added to and removed from an object tree, the evaluator kept by evaluate is made again once
+        # it moves
+        self._changes = 0
+        self._evaluator = None
+        self._stats = None
+        self._aggregator = None
+        self._aggregates = {}
+        self._budget = None
+        self._recent = OrderedDict()
+        if storage == MSPStorageType.Compact:
+            self._store = MSPTree._NodeStore(lazy=lazy)
+        elif storage == MSPStorageType.Integer:
+            if max_depth > _MAX_INTEGER_DEPTH:
+                raise ValueError("Integer storage supports a depth of at most %d" % _MAX_INTEGER_DEPTH)
+            self._store = MSPTree._NodeStore(integer=True, lazy=lazy)
+        elif storage == MSPStorageType.Objects:
+            self._store = None
+        else:
+            raise ValueError("Unknown storage type %s" % storage)
+        if self._store is not None:
+            self._store.index = self._index
+            self._store.unit = self.cell_size
 
         self.max_depth = max_depth
         self.tree_type = tree_type
+        self.storage = storage
+        self.bucket_capacity = bucket_capacity
+        self._lock = self._store.lock if self._store is not None else threading.RLock()
+        if self._store is None:
+            self._Node = type('_Node', (MSPTree._Node,), {'tree': self})
+
+        # The roots in the order they were made and the index in roots of the root of each cell
+        self.roots = []
+        self._root_cells = {}
+        if not self.sparse:
+            for cell in _UNIT_ROOTS:
+                self._add_root(cell)
+
+    def _add_root(self, cell):
+        """ Creates the root of an integer cell of the root grid, its color follows from the parity of the cell
+        """
+        with self._lock:
+            if cell in self._root_cells:
+                return self.roots[self._root_cells[cell]]
+            color = _ROOT_COLORS[(cell[0] & 1) + (cell[1] & 1) + (cell[2] & 1)]
+            position = (cell[0]*self.cell_size, cell[1]*self.cell_size, cell[2]*self.cell_size)
+            store = self._store
+            if store is None:
+                root = self._index_root(self._Node(position, color, _NodeType.CC_Node, None, self.cell_size))
+                self._object_count += 1
+                self._changes += 1
+            elif store.integer:
+                if (max(abs(c) for c in cell) + 2) << (2 + self.max_depth//3) >= 1 << 63:
+                    raise ValueError("Cell %s is too far out for integer storage at depth %d" % (cell, self.max_depth))
+                root = MSPTree._NodeHandle(store, store.add_node(_lattice_key(cell, 0), color, _NodeType.CC_Node,
+                                                                 self.cell_size))
+            else:
+                root = MSPTree._NodeHandle(store, store.add_node(position, color, _NodeType.CC_Node, self.cell_size))
+            self._root_cells[cell] = len(self.roots)
+            self.roots.append(root)
+            return root
 
-    def find_closest_node(self, point, level=-1):
+    def _root_cell(self, point):
+        """ The integer cell of the root grid closest to point, clamped to the unit grid if the tree isn't sparse
+        """
+        cell = tuple(int(math.floor(c/self.cell_size + 0.5)) for c in point[:3])
+        if not self.sparse:
+            cell = tuple(min(max(c, -1), 1) for c in cell)
+        return cell
+
+    def _root(self, point, create=False):
+        """ The root closest to point. A tree on the unit grid scans its roots and keeps the first one on ties, a
+        sparse tree finds the root by its cell, creates it if create is set and falls back to the closest existing
+        root otherwise, None if it has no roots at all.
+        """
+        if self.sparse:
+            row = self._root_cells.get(self._root_cell(point))
+            if row is not None:
+                return self.roots[row]
+            if create:
+                return self._add_root(self._root_cell(point))
+            if not self.roots:
+                return None
+        if self._stats is not None:
+            self._stats.distance_evaluations += len(self.roots)
         dot = lambda x, y: abs((x[0]-y[0])*(x[0] - y[0]) + (x[1]-y[1])*(x[1] - y[1]) + (x[2]-y[2])*(x[2]-y[2]))
-        node = min([(dot(point, n.position), n) for n in self.roots], key=lambda x: x[0])[1]
-        return node.find_closest_node(point)
+        return min([(dot(point, n.position), n) for n in self.roots], key=lambda x: x[0])[1]
+
+    def _root_rows(self, points, create=False):
+        """ _root for an (N,3) array of points, returns the index in roots of the root of each point, -1 for every
+        point if a sparse tree has no roots
+        """
+        if not self.sparse:
+            if self._stats is not None:
+                self._stats.distance_evaluations += len(points)*len(self.roots)
+            return _closest_rows(points, np.array([r.position for r in self.roots], dtype=np.float64))
+        if create and len(points):
+            for cell in np.unique(np.floor(points/self.cell_size + 0.5).astype(np.int64), axis=0).tolist():
+                self._add_root(tuple(cell))
+        rows = _cell_rows(points, self.cell_size, self._root_cells)
+        missing = np.nonzero(rows < 0)[0]
+        if len(missing) and self.roots:
+            if self._stats is not None:
+                self._stats.distance_evaluations += len(missing)*len(self.roots)
+            positions = np.array([r.position for r in self.roots], dtype=np.float64)
+            rows[missing] = _closest_rows(points[missing], positions)
+        return rows
+
+    def _index_root(self, node):
+        if self._index is not None:
+            self._index.add(0, _lattice_key(node.position, 0, self.cell_size), node)
+        return node
+
+    def _lattice_index(self):
+        """ The lattice index of the tree, built from the nodes in the tree on first use
+        """
+        if self._index is not None:
+            return self._index
+        with self._lock:
+            if self._index is None:
+                index = MSPTree._LatticeIndex()
+                if self._store is not None:
+                    self._store.index = index
+                    self._store.index_range(0, len(self._store))
+                else:
+                    stack = list(reversed(self.roots))
+                    while stack:
+                        node = stack.pop()
+                        index.add(node.level, _lattice_key(node.position, node.level, self.cell_size), node)
+                        stack.extend(reversed(MSPTree._materialized(node)))
+                self._index = index
+        return self._index
+
+    def lattice_key(self, position, level):
+        """ Integer key of a node position at the given level, see get_node
+        """
+        return _lattice_key(position, level, self.cell_size)
+
+    def node_key(self, node):
+        """ The lattice key of a node. Unlike lattice_key(node.position, node.level) this is exact at any depth with
+        integer storage.
+        """
+        if self._store is not None:
+            return self._store.key(node.index)
+        return _lattice_key(node.position, node.level, self.cell_size)
+
+    def get_node(self, level, key):
+        """ Returns the node at the given level whose lattice key is key, or None if there is no such node. The key of
+        a node is lattice_key(node.position, node.level). Where nodes of neighbouring subtrees overlap the first node
+        indexed is returned, get_nodes returns all of them. Lookups go through a hash index which is built on first
+        use, or up front if the tree was created with indexed=True, and then kept up to date by expand_node.
+        """
+        node = self._lattice_index().get(level, key)
+        if node is not None and self._store is not None:
+            return MSPTree._NodeHandle(self._store, node)
+        return node
 
+    def get_nodes(self, level, key):
+        """ Returns all nodes at the given level whose lattice key is key
+        """
+        nodes = self._lattice_index().get_all(level, key)
+        if self._store is not None:
+            return [MSPTree._NodeHandle(self._store, i) for i in nodes]
+        return nodes
+
+    def contains(self, level, key):
+        """ True if a node at the given level has the lattice key key
+        """
+        return self._lattice_index().get(level, key) is not None
+
+    def neighbor_offsets(self, level, kind='face'):
+        """ The offsets from a node at the given level to its neighbours of the given kind, as a (K,3) array in the
+        order used by neighbors and level_neighbors. With kind 'face' these are the neighbours sharing a face of the
+        Voronoi cell of the node on the lattice of the level, with 'all' those sharing at least a corner.
+        """
+        spacing = self.cell_size/(1 << (2 + level//3))
+        return np.array(_neighbor_offsets(level, kind), dtype=np.float64)*spacing
+
+    def neighbors(self, node, kind='face'):
+        """ The nodes at the level of node that sit on its neighbouring lattice points, see neighbor_offsets. Their
+        lattice keys follow from the key of node, so they are looked up in the lattice index, see get_node, instead of
+        being searched for from the roots. Where several nodes share a lattice point one that isn't a ghost is picked.
+        Lattice points without a node are left out, in a lazy tree that includes the nodes not created yet.
+        """
+        x, y, z = self.node_key(node)
+        found = []
+        for dx, dy, dz in _neighbor_offsets(node.level, kind):
+            nodes = self.get_nodes(node.level, (x + dx, y + dy, z + dz))
+            if nodes:
+                found.append(next((n for n in nodes if n.color != _NodeColor.Node_Ghost), nodes[0]))
+        return found
+
+    @_locked
+    def level_neighbors(self, level, kind='face'):
+        """ neighbors for every node of a level at once. Returns the list of the nodes of the level, in the order of
+        iter_level, and an (N,K) array whose row i holds the position in that list of the neighbour of node i at each
+        of the K offsets of neighbor_offsets, -1 where there is no node.
+        """
+        offsets = np.array(_neighbor_offsets(level, kind), dtype=np.int64).reshape(-1, 3)
+        nodes = list(self.iter_level(level))
+        if self._store is not None:
+            indices = np.array([n.index for n in nodes], dtype=int)
+            keys = self._store.keys(indices).reshape(-1, 3)
+            ghosts = _gather(self._store.color, indices) == _NodeColor.Node_Ghost
+        else:
+            keys = np.array([_lattice_key(n.position, level, self.cell_size) for n in nodes], dtype=np.int64)
+            keys = keys.reshape(-1, 3)
+            ghosts = np.array([n.color == _NodeColor.Node_Ghost for n in nodes], dtype=bool)
+
+        # Ghosts go last, so they only stand for a lattice point no other node sits on
+        rows, order = {}, np.argsort(ghosts, kind='stable')
+        for i, key in zip(order.tolist(), keys[order].tolist()):
+            rows.setdefault(tuple(key), i)
+        table = np.full((len(nodes), len(offsets)), -1, dtype=int)
+        for j, offset in enumerate(offsets):
+            table[:, j] = [rows.get(tuple(key), -1) for key in (keys + offset).tolist()]
+        return nodes, table
+
+    def apply_stencil(self, level, weights, kind='face', values=None, fill=0.):
+        """ Applies a linear stencil to the nodes of a level, see level_neighbors. weights holds the weight of a node
+        itself followed by a weight for each offset of neighbor_offsets, a missing neighbour counts with the value of
+        the node itself. values is an array with a row for each node in the order of iter_level, the values of the
+        nodes by default, with fill for the nodes without one. Returns the list of nodes and the array of results.
+        """
+        nodes, table = self.level_neighbors(level, kind)
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        if len(weights) != table.shape[1] + 1:
+            raise ValueError("The stencil needs %d weights, got %d" % (table.shape[1] + 1, len(weights)))
+        if values is None:
+            values = [getattr(n, 'value', fill) for n in nodes]
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != len(nodes):
+            raise ValueError("Got %d values for %d nodes" % (len(values), len(nodes)))
+
+        rows = np.arange(len(nodes))
+        result = weights[0]*values
+        for j in range(table.shape[1]):
+            result = result + weights[j + 1]*values[np.where(table[:, j] >= 0, table[:, j], rows)]
+        return nodes, result
+
+    def node_count(self):
+        """ Number of nodes in the tree, in a lazy tree only the nodes created so far
+        """
+        if self._store is not None:
+            return self._store.live()
+        return self._object_count
+
+    def enable_stats(self, callback=None):
+        """ Starts collecting stats, see stats. If given, callback is called with the name and the duration in seconds
+        of every call to the expansion and query methods of the tree. Returns the MSPStats collecting the counters.
+        """
+        if self._stats is None:
+            self._stats = MSPStats()
+            if self._store is not None:
+                self._store.stats = self._stats
+        if callback is not None:
+            self._stats.callbacks.append(callback)
+        return self._stats
+
+    def disable_stats(self):
+        """ Stops collecting stats and drops the counters
+        """
+        self._stats = None
+        if self._store is not None:
+            self._store.stats = None
+
+    @_locked
+    def stats(self):
+        """ A snapshot of the tree as a dictionary of plain numbers, lists and dictionaries. It holds the number of
+        nodes, their estimated size in bytes, the nodes at each level, of each lattice and of each color, ghosts
+        included, and the number of nodes with a value. While stats are enabled it also holds the counters of
+        MSPStats, see MSPStats.snapshot.
+        """
+        if self._store is not None:
+            store = self._store
+            live = np.frombuffer(store.parent, dtype=_typecode(store.parent)) != -2
+            levels, lattices, colors = [np.frombuffer(values, dtype=_typecode(values))[live].astype(int)
+                                        for values in (store.level, store.lattice, store.color)]
+            valued = len(store.values)
+        else:
+            levels, lattices, colors, valued = [], [], [], 0
+            stack = list(self.roots)
+            while stack:
+                node = stack.pop()
+                levels.append(node.level)
+                lattices.append(node.lattice)
+                colors.append(node.color)
+                valued += hasattr(node, 'value')
+                stack.extend(MSPTree._materialized(node))
+
+        lattices = np.bincount(lattices, minlength=3).tolist()
+        colors = np.bincount(colors, minlength=5).tolist()
+        snapshot = {
+            'nodes': self.node_count(),
+            'bytes': self.node_count()*self._node_bytes(),
+            'values': valued,
+            'levels': np.bincount(levels, minlength=self.max_depth + 1).tolist(),
+            'lattices': dict(zip(('cc', 'bcc', 'fcc'), lattices)),
+            'colors': dict(zip(('red', 'green', 'blue', 'yellow', 'ghost'), colors)),
+            'ghosts': colors[_NodeColor.Node_Ghost],
+        }
+        if self._stats is not None:
+            snapshot.update(self._stats.snapshot())
+        return snapshot
+
+    @_locked
+    def set_budget(self, nodes=None, nbytes=None, level=3, aggregate=None, spill=None):
+        """ Bounds the size of the tree to at most nodes nodes, or nbytes bytes of node data. Accesses are tracked for
+        the subtrees rooted at the given level, any expand_to, find_closest_node, insert or batch expansion going
+        through a node of that level marks its subtree as used. Whenever the tree has grown past its budget the least
+        recently used subtrees are collapsed, their root becomes a leaf again, until it fits. Nodes above the level
+        and the most recently used subtree are never removed, so the tree can stay above a budget that is too small.
+
+        Before a subtree is collapsed spill is called with its root, an (N,3) array of the positions of the nodes
+        below the root that carry a value and the list of their values, and aggregate is called with that list, led by
+        the value of the root if it has one, its result becomes the value of the root. Neither is called for a subtree
+        without values below its root. See MSPSpillDirectory
+        for a spill that writes the values to disk. Handles and references to collapsed nodes must not be used any
+        more. Calling set_budget without nodes or nbytes removes the budget.
+        """
+        if nodes is None and nbytes is None:
+            self._budget = None
+            self._recent = OrderedDict()
+            return
+        if level < 1 or level > self.max_depth:
+            raise ValueError("The budget level must be between 1 and %d" % self.max_depth)
+        self._recent = OrderedDict()
+        self._budget = (nodes, nbytes, level, aggregate, spill)
+        self._enforce_budget()
+
+    def _node_bytes(self):
+        """ Bytes used by a node, for the bytes budget
+        """
+        if self._store is not None:
+            store = self._store
+            return sum(getattr(store, name).itemsize for name in _STORE_ARRAYS if name != 'slots' or store.lazy)
+        node = self.roots[0] if self.roots else MSPTree._Node((0., 0., 0.), _NodeColor.Node_Red, _NodeType.CC_Node)
+        return sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.position) + \
+            sys.getsizeof(node.children)
+
+    def _touch(self, nodes):
+        """ Marks the subtrees rooted at a list of nodes of the budget level as the most recently used. Readers call
+        this too, so it doesn't take the lock, each step is a single operation on the dictionary. A subtree collapsed
+        by another thread in between is simply not marked.
+        """
+        recent = self._recent
+        for node in nodes:
+            key = node.index if self._store is not None else node
+            recent[key] = True
+            try:
+                recent.move_to_end(key)
+            except KeyError:
+                pass
+
+    def _touch_many(self, nodes, level):
+        """ _touch for the nodes reached by a batch expansion at level, an array of indices with compact storage
+        """
+        if self._budget is None or level != self._budget[2]:
+            return
+        if self._store is not None:
+            nodes = [MSPTree._NodeHandle(self._store, i) for i in np.unique(nodes).tolist()]
+        self._touch(nodes)
+
+    @_locked
+    def _enforce_budget(self):
+        if self._budget is None:
+            return
+        nodes, nbytes, level, aggregate, spill = self._budget
+        limit = nodes if nbytes is None else nbytes//self._node_bytes()
+        if nodes is not None:
+            limit = min(limit, nodes)
+        while self.node_count() > limit and len(self._recent) > 1:
+            key, _ = self._recent.popitem(last=False)
+            self._collapse(MSPTree._NodeHandle(self._store, key) if self._store is not None else key, aggregate,
+                           spill)
+
+    def _collapse(self, node, aggregate=None, spill=None):
+        """ Removes the nodes below node, handing their values to spill and aggregate first, see set_budget
+        """
+        store = self._store
+        below = []
+        stack = list(store.child_list(node.index)) if store is not None else list(MSPTree._materialized(node))
+        while stack:
+            n = stack.pop()
+            below.append(n)
+            stack.extend(store.child_list(n) if store is not None else MSPTree._materialized(n))
+        if self._recent:
+            # Subtree roots of the budget level can sit below a node collapsed by pruning
+            for n in below:
+                self._recent.pop(n, None)
+        if self._aggregates:
+            for n in below:
+                self._aggregates.pop(n, None)
+
+        if store is not None:
+            valued = [i for i in below if i in store.values]
+            positions = store.positions(np.array(valued, dtype=int)).reshape(-1, 3)
+            values = [store.values[i] for i in valued]
+        else:
+            valued = [n for n in below if hasattr(n, 'value')]
+            positions = np.array([n.position for n in valued], dtype=np.float64).reshape(-1, 3)
+            values = [n.value for n in valued]
+        if values:
+            if spill is not None:
+                spill(node, positions, values)
+            if aggregate is not None:
+                node.value = aggregate(([node.value] if hasattr(node, 'value') else []) + values)
+
+        if store is not None:
+            store.collapse(node.index)
+            return
+        if self._index is not None:
+            for n in below:
+                self._index.remove(n.level, _lattice_key(n.position, n.level, self.cell_size), n)
+        node.children = []
+        self._object_count -= len(below)
+        self._changes += 1
+
+    @_locked
+    def clear_value(self, node):
+        """ Removes the value of node, if it has one, and prunes the tree. The highest of node and its ancestors whose
+        subtree no longer holds any value is collapsed back into an unexpanded node, so a cleared sample doesn't leave
+        its chain of siblings behind. Handles and references to the removed nodes must not be used any more.
+        """
+        if self._has_value(node):
+            del node.value
+        path = self._path(node)
+        self._refresh_aggregates(path)
+        self._prune(path)
+
+    @_locked
+    def remove(self, point):
+        """ Removes the sample at point. In a space partitioning tree the entries for point are taken out of the bucket
+        of its leaf, otherwise the value of the node find_closest_node leads point to is cleared. The tree is then
+        pruned as in clear_value. Returns whether anything was removed.
+        """
+        node = self.find_closest_node(point)
+        if node is None or not self._has_value(node):
+            return False
+        if self.tree_type == MSPTreeType.SpacePartitioning:
+            point = (float(point[0]), float(point[1]), float(point[2]))
+            entries = [e for e in node.value if e[0] != point]
+            if len(entries) == len(node.value):
+                return False
+            if entries:
+                node.value = entries
+                self._refresh_aggregates(self._path(node))
+                return True
+        del node.value
+        path = self._path(node)
+        self._refresh_aggregates(path)
+        self._prune(path)
+        return True
+
+    def _has_value(self, node):
+        if self._store is not None:
+            return node.index in self._store.values
+        return hasattr(node, 'value')
+
+    def _path(self, node):
+        """ The nodes from the root of node down to node, found by following the parents of node
+        """
+        store = self._store
+        if store is not None:
+            path = [node]
+            while store.parent[path[-1].index] >= 0:
+                path.append(MSPTree._NodeHandle(store, store.parent[path[-1].index]))
+            return path[::-1]
+
+        path = [node]
+        while path[-1].parent is not None:
+            parent = path[-1].parent
+            # A removed node keeps its parent, but its parent no longer has it as a child
+            if not any(c is path[-1] for c in MSPTree._materialized(parent)):
+                raise MSPNodeException("The node is not in this tree", node)
+            path.append(parent)
+        if path[-1].tree is not self:
+            raise MSPNodeException("The node is not in this tree", node)
+        return path[::-1]
+
+    def _prune(self, path):
+        """ Collapses the highest node of a path from a root whose subtree holds no value. In a lazy tree that node is
+        removed too, unless it is a root, its parent creates it again when it is next accessed.
+        """
+        store = self._store
+        children = (lambda n: [MSPTree._NodeHandle(store, c) for c in store.child_list(n.index)]) \
+            if store is not None else MSPTree._materialized
+
+        def empty(n):
+            stack = [n]
+            while stack:
+                n = stack.pop()
+                if self._has_value(n):
+                    return False
+                stack.extend(children(n))
+            return True
+
+        if not empty(path[-1]):
+            return
+        i = len(path) - 1
+        while i > 0 and not self._has_value(path[i - 1]) and \
+                all(empty(c) for c in children(path[i - 1]) if c != path[i]):
+            i -= 1
+        if len(children(path[i])):
+            self._collapse(path[i])
+        if self.lazy and i > 0:
+            self._recent.pop(path[i].index if store is not None else path[i], None)
+            self._aggregates.pop(path[i].index if store is not None else path[i], None)
+            if store is not None:
+                store.drop(path[i].index)
+                return
+            nodes = path[i - 1].children.nodes
+            nodes[[slot for slot, c in enumerate(nodes) if c is path[i]][0]] = None
+            if self._index is not None:
+                self._index.remove(path[i].level, _lattice_key(path[i].position, path[i].level, self.cell_size),
+                                   path[i])
+            self._object_count -= 1
+            self._changes += 1
+
+    @_locked
+    def compact(self):
+        """ Reclaims the storage of removed nodes. The rows of collapsed nodes are recycled by later expansions, this
+        moves the remaining nodes of a compact tree together and shrinks its arrays in one pass. All handles except the
+        roots refer to other nodes afterwards and must be looked up again. Object trees return their memory as they go,
+        for them this does nothing. Returns the number of rows reclaimed.
+        """
+        store = self._store
+        if store is None or not store.dead:
+            return 0
+        dead = store.dead
+        moved = store.compact()
+        for root in self.roots:
+            root.index = int(moved[root.index])
+        self._recent = OrderedDict((int(moved[i]), True) for i in self._recent)
+        self._aggregates = dict((int(moved[i]), state) for i, state in self._aggregates.items())
+        return dead
+
+    @_locked
+    def set_aggregator(self, aggregator):
+        """ Makes every node maintain an aggregate of the samples in its subtree, see MSPAggregator. aggregator is an
+        MSPAggregator, a dictionary of them by name, whose aggregates are then dictionaries by name, or None to stop
+        aggregating. The samples of a node are its value in a function space tree and the values in its bucket in a
+        space partitioning tree. The aggregates are computed for the whole tree here, then kept up to date by
+        add_sample, set_value, insert, remove and clear_value along the path of the sample, and recomputed in bulk by
+        the batch builders given values. Values written straight to node.value aren't seen until update_aggregates.
+        """
+        if isinstance(aggregator, dict):
+            aggregator = _AggregatorSet(aggregator)
+        self._aggregator = aggregator
+        self._aggregates = {}
+        self._rebuild_aggregates()
+
+    @_locked
+    def update_aggregates(self):
+        """ Recomputes the aggregates of every node, after values were changed behind the tree's back
+        """
+        self._rebuild_aggregates()
+
+    def aggregate(self, node):
+        """ The aggregate of the samples in the subtree of node, None if it holds none or the tree has no aggregator
+        """
+        state = self._aggregates.get(node.index if self._store is not None else node)
+        return None if state is None else self._aggregator.result(state)
+
+    def aggregate_level(self, level, lo=None, hi=None):
+        """ The aggregates of the nodes at the given level, inside the axis aligned box [lo, hi] if given, read
+        straight from the nodes. Returns the list of nodes that hold any samples below them and the list of their
+        aggregates.
+        """
+        lo = (-np.inf,)*3 if lo is None else lo
+        hi = (np.inf,)*3 if hi is None else hi
+        nodes = [n for n in self.query_box(lo, hi, level) if self.aggregate(n) is not None]
+        return nodes, [self.aggregate(n) for n in nodes]
+
+    @_locked
+    def add_sample(self, point, value):
+        """ Expands the tree towards point and stores value in the leaf, updating the aggregates along the way.
+        Returns the leaf.
+        """
+        leaf = self.expand_to(point)
+        self.set_value(leaf, value)
+        return leaf
+
+    @_locked
+    def set_value(self, node, value):
+        """ Sets the value of node and updates the aggregates of node and its ancestors. A new value is merged into
+        them, one replacing another has them recomputed from their children.
+        """
+        replaced = self._has_value(node)
+        node.value = value
+        if self._aggregator is None:
+            return
+        if replaced or self.tree_type == MSPTreeType.SpacePartitioning:
+            self._refresh_aggregates(self._path(node))
+        else:
+            self._aggregate_path(self._path(node), value)
+
+    def _samples(self, node):
+        if not self._has_value(node):
+            return []
+        if self.tree_type == MSPTreeType.SpacePartitioning:
+            return [value for _, value in node.value]
+        return [node.value]
+
+    def _node_state(self, node, children):
+        """ The aggregate state of node from its own samples and the states of its children
+        """
+        aggregator, states = self._aggregator, self._aggregates
+        state = None
+        for value in self._samples(node):
+            lifted = aggregator.lift(value)
+            state = lifted if state is None else aggregator.merge(state, lifted)
+        for child in children:
+            child = states.get(child)
+            if child is not None:
+                state = child if state is None else aggregator.merge(state, child)
+        return state
+
+    def _aggregate_path(self, path, value):
+        """ Merges a new sample into the aggregates of a path of nodes
+        """
+        aggregator, states = self._aggregator, self._aggregates
+        lifted = aggregator.lift(value)
+        for node in path:
+            key = node.index if self._store is not None else node
+            states[key] = lifted if key not in states else aggregator.merge(states[key], lifted)
+
+    def _refresh_aggregates(self, path):
+        """ Recomputes the aggregates of a path from a root, bottom up from the children of its nodes
+        """
+        if self._aggregator is None:
+            return
+        store = self._store
+        for node in reversed(path):
+            if store is not None:
+                key, children = node.index, store.child_list(node.index)
+            else:
+                key, children = node, MSPTree._materialized(node)
+            state = self._node_state(node, children)
+            if state is None:
+                self._aggregates.pop(key, None)
+            else:
+                self._aggregates[key] = state
+
+    def _rebuild_aggregates(self, top=None):
+        """ Recomputes the aggregates of every node below top, or of the whole tree. The nodes are listed parents
+        first and their states computed in the reverse order, children first.
+        """
+        if self._aggregator is None:
+            return
+        store = self._store
+        if store is not None:
+            children = store.child_list
+            order = [r.index for r in self.roots] if top is None else [top.index]
+        else:
+            children = MSPTree._materialized
+            order = list(self.roots) if top is None else [top]
+        i = 0
+        while i < len(order):
+            order.extend(children(order[i]))
+            i += 1
+        for key in reversed(order):
+            node = MSPTree._NodeHandle(store, key) if store is not None else key
+            state = self._node_state(node, children(key))
+            if state is None:
+                self._aggregates.pop(key, None)
+            else:
+                self._aggregates[key] = state
+
+    @_timed
+    @_locked
+    def expand_to_many(self, points, values=None, chunk_size=65536):
+        """ Expands the tree down to max_depth towards every point of an (N,3) array. The points are descended together
+        one level at a time, returns the list of leaves in the order of the points. If values is given, the value of
+        each point is stored in its leaf. Only compact and integer trees are descended in batches, object trees descend
+        the points one by one like expand_to, their nodes are created one at a time either way.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if values is not None and len(values) != len(points):
+            raise ValueError("Got %d values for %d points" % (len(values), len(points)))
+
+        if self._store is None:
+            leaves = self._expand_points(points)
+        else:
+            leaves = []
+            for start in range(0, len(points), chunk_size):
+                leaves.extend(self._expand_chunk(points[start:start + chunk_size]))
+
+        if values is not None:
+            for leaf, value in zip(leaves, values):
+                leaf.value = value
+            self._rebuild_aggregates()
+        self._enforce_budget()
+        return leaves
+
+    def _paths(self, points):
+        """ The path of every point of an (N,3) array down to max_depth, an (N,1+max_depth) array holding the index of
+        the closest root followed by the slot of the child picked at each level. Only the roots of a sparse tree are
+        created, the rest of the tree isn't touched.
+        """
+        roots = self._root_rows(points, create=True)
+        origins = np.array([self.roots[r].position for r in roots.tolist()], dtype=np.float64).reshape(-1, 3)
+        scales = np.array([self.roots[r].scale for r in roots.tolist()], dtype=np.float64)
+        rules = np.array([_RULE_IDS[(self.roots[r].lattice, self.roots[r].color)] for r in roots.tolist()], dtype=int)
+        if self._store is not None and self._store.integer:
+            keys = np.array([self._store.key(self.roots[r].index) for r in roots.tolist()],
+                            dtype=np.int64).reshape(-1, 3)
+            slots = _descend_keys(points/self.cell_size, keys, np.zeros(len(points), dtype=int), rules, self.max_depth)
+        else:
+            slots = _descend_paths(points, origins, scales, rules, self.max_depth)
+        return np.concatenate([roots[:, None].astype(self._path_type()), slots], 1)
+
+    def _path_type(self):
+        # Root indices of the unit grid fit in a byte, a sparse grid can have any number of roots
+        return np.int64 if self.sparse else np.int8
+
+    def _all_paths(self, points, chunk_size):
+        paths = [self._paths(points[start:start + chunk_size]) for start in range(0, len(points), chunk_size)]
+        return np.concatenate(paths) if paths else np.zeros((0, 1 + self.max_depth), dtype=self._path_type())
+
+    def path_keys(self, points, chunk_size=65536):
+        """ Encodes the path from the roots down to max_depth of every point of an (N,3) array as an integer key. The
+        root index and the slot of the child picked at each level take 5 bits each, packed twelve to a 64 bit word
+        with the root in the most significant bits. In a sparse tree the root index takes the whole first word instead,
+        the slots follow in the next words. Returns an (N,W) array of words, sorting its rows lexicographically sorts
+        the points in the order of their paths.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        paths = self._all_paths(points, chunk_size).astype(np.uint64)
+        if self.sparse:
+            return np.concatenate([paths[:, :1], self._pack_slots(paths[:, 1:])], 1)
+        return self._pack_slots(paths)
+
+    @staticmethod
+    def _pack_slots(paths):
+        words = -(-paths.shape[1]//12)
+        paths = np.concatenate([paths, np.zeros((len(paths), 12*words - paths.shape[1]), dtype=np.uint64)], 1)
+        shifts = np.uint64(5)*np.arange(11, -1, -1, dtype=np.uint64)
+        return np.bitwise_or.reduce(paths.reshape(len(paths), words, 12) << shifts, axis=2)
+
+    @_timed
+    @_locked
+    def bulk_load(self, points, values=None, chunk_size=65536):
+        """ Expands the tree down to max_depth towards every point of an (N,3) array, like expand_to_many. The paths of
+        the points are computed and sorted first, the tree is then built level by level in a single pass over the
+        sorted paths, creating each node once no matter how many points go through it. On an empty tree the nodes of
+        each level end up in the order of their paths, whatever the order of the points. Returns the list of leaves
+        in the order of the points. If values is given, the value of each point is stored in its leaf. Only compact and
+        integer trees are built from the sorted paths, object trees descend the points one by one like expand_to, their
+        nodes are created one at a time either way.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if values is not None and len(values) != len(points):
+            raise ValueError("Got %d values for %d points" % (len(values), len(points)))
+        if len(points) == 0:
+            return []
+
+        leaves = self._expand_points(points) if self._store is None else self._bulk_load_store(points, chunk_size)
+        if values is not None:
+            for leaf, value in zip(leaves, values):
+                leaf.value = value
+            self._rebuild_aggregates()
+        self._enforce_budget()
+        return leaves
+
+    def _bulk_load_store(self, points, chunk_size):
+        paths = self._all_paths(points, chunk_size)
+        order = np.lexsort(paths.T[::-1])
+        paths = paths[order]
+
+        # The first level at which the path of each point leaves the path of the point before it
+        diff = paths[1:] != paths[:-1]
+        split = np.concatenate([[0], np.where(diff.any(1), diff.argmax(1), paths.shape[1])])
+
+        store = self._store
+        starts = np.nonzero(split == 0)[0]
+        nodes = np.array([r.index for r in self.roots])[paths[starts, 0]]
+        for level in range(1, paths.shape[1]):
+            # The node each point went through at the level above, and the points starting a new node at this one
+            parents = (np.cumsum(split < level) - 1)[split <= level]
+            starts = np.nonzero(split <= level)[0]
+            store.expand_many(nodes)
+            nodes = store.children_at(nodes[parents], paths[starts, level])
+            self._touch_many(nodes, level)
+
+        leaves = [None]*len(points)
+        for i, leaf in zip(order.tolist(), (np.cumsum(split < paths.shape[1]) - 1).tolist()):
+            leaves[i] = MSPTree._NodeHandle(store, int(nodes[leaf]))
+        return leaves
+
+    @_timed
+    def build_parallel(self, points, values=None, workers=None):
+        """ Expands the tree down to max_depth towards every point of an (N,3) array like bulk_load, building the
+        subtrees of the roots in parallel. The points are split up by their closest root, the subtree of each root is
+        bulk loaded in a pool of worker processes and then merged into this tree. workers sets the number of
+        processes, all CPUs by default. Roots that are already expanded are filled in by this process. Returns the list
+        of leaves in the order of the points. If values is given, the value of each point is stored in its leaf.
+        Only compact and integer trees can be built in parallel, merging the arrays of a subtree into an object tree
+        would create its nodes one by one in this process, which costs more than bulk loading them. The tree is only
+        locked while the points are split up and while each subtree is merged, not while the workers run.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self._store is None:
+            raise ValueError("build_parallel needs compact or integer storage, use bulk_load for object trees")
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if values is not None and len(values) != len(points):
+            raise ValueError("Got %d values for %d points" % (len(values), len(points)))
+
+        leaves = [None]*len(points)
+        tasks = []
+        with self._lock:
+            roots = self._root_rows(points, create=True)
+            for root in np.unique(roots).tolist():
+                rows = np.nonzero(roots == root)[0]
+                if len(self.roots[root].children) > 0:
+                    for i, leaf in zip(rows.tolist(), self.bulk_load(points[rows])):
+                        leaves[i] = leaf
+                else:
+                    tasks.append((root, rows))
+
+        # The biggest subtrees go first so that they don't end up running alone at the end
+        tasks.sort(key=lambda task: -len(task[1]))
+        cell_size = self.cell_size if self.sparse else None
+        args = [(self.max_depth, self.storage, self.lazy, cell_size, points[rows]) for _, rows in tasks]
+        if tasks:
+            with ProcessPoolExecutor(workers) as pool:
+                # Each subtree is merged as soon as it is done, while the workers build the others
+                for (root, rows), (arrays, local, other, start) in zip(tasks, pool.map(_build_subtree, args)):
+                    with self._lock:
+                        if len(self.roots[root].children) > 0:
+                            # Expanded by another thread in the meantime
+                            subtree = self.bulk_load(points[rows])
+                        else:
+                            subtree = self._merge_subtree(root, arrays, local, other, start)
+                    for i, leaf in zip(rows.tolist(), subtree):
+                        leaves[i] = leaf
+
+        with self._lock:
+            if values is not None:
+                for leaf, value in zip(leaves, values):
+                    leaf.value = value
+                self._rebuild_aggregates()
+            self._enforce_budget()
+        return leaves
+
+    def _merge_subtree(self, root, arrays, local, other, start):
+        """ Merges the node arrays built by _build_subtree for the given root into the store of the tree, other is the
+        index of the root in the arrays and start the number of roots they have. Returns the nodes with the local
+        indices in local.
+        """
+        offset = self._store.merge(arrays, self.roots[root].index, other, start)
+        return [MSPTree._NodeHandle(self._store, i)
+                for i in np.where(local == other, self.roots[root].index, local + offset).tolist()]
+
+    def _objects_from_arrays(self, arrays, nodes, start):
+        """ Creates object nodes for the rows of a set of node arrays from start on, and gives every row with children
+        its children. nodes holds a node for each row before start that has children, the new nodes are added to it.
+        """
+        columns = zip(arrays['x'].tolist(), arrays['y'].tolist(), arrays['z'].tolist(), arrays['color'].tolist(),
+                      arrays['lattice'].tolist(), arrays['scale'].tolist(), arrays['level'].tolist())
+        for i, (x, y, z, color, lattice, scale, level) in enumerate(columns):
+            if i >= start:
+                nodes[i] = self._Node((x, y, z), color, lattice, None, scale)
+                self._object_count += 1
+                self._changes += 1
+                if self._index is not None:
+                    self._index.add(level, _lattice_key(nodes[i].position, level, self.cell_size), nodes[i])
+
+        first_child, child_count, slots = arrays['first_child'], arrays['child_count'], arrays['slots'].tolist()
+        for i in np.nonzero(first_child >= 0)[0].tolist():
+            first, count = int(first_child[i]), int(child_count[i])
+            if self.lazy:
+                nodes[i].children = MSPTree._LazyChildren(nodes[i], count)
+                nodes[i].children.nodes = [nodes[c] if c >= 0 else None for c in slots[first:first + count]]
+            else:
+                nodes[i].children = nodes[first:first + count]
+            for child in MSPTree._materialized(nodes[i]):
+                child.parent = nodes[i]
+
+    def _object_arrays(self):
+        """ The object nodes of the tree as a set of node arrays in the layout of the compact store, the roots first and
+        the children of a node next to each other. Returns the arrays and the list of nodes in the order of the rows.
+        """
+        nodes = list(self.roots)
+        parent, first_child, child_count, slots = [-1]*len(nodes), [], [], []
+        # nodes grows as the children of each node are appended, so this visits the tree level by level
+        for i, node in enumerate(nodes):
+            children = node.children
+            child_count.append(len(children))
+            if isinstance(children, MSPTree._LazyChildren):
+                first_child.append(len(slots))
+                for child in children.nodes:
+                    slots.append(-1 if child is None else len(nodes))
+                    if child is not None:
+                        nodes.append(child)
+                        parent.append(i)
+            elif children:
+                first_child.append(len(nodes))
+                nodes.extend(children)
+                parent.extend([i]*len(children))
+            else:
+                first_child.append(-1)
+
+        columns = dict(
+            x=[n.position[0] for n in nodes], y=[n.position[1] for n in nodes], z=[n.position[2] for n in nodes],
+            scale=[n.scale for n in nodes], color=[n.color for n in nodes], lattice=[n.lattice for n in nodes],
+            parent=parent, first_child=first_child, child_count=child_count, level=[n.level for n in nodes],
+            slots=slots)
+        store = MSPTree._NodeStore()
+        return dict((name, array(_typecode(getattr(store, name)), columns[name])) for name in _STORE_ARRAYS), nodes
+
+    def _frozen(self, values, compact=False):
+        """ The tree in the file format of save. Returns the header with the directory of the arrays, the list of node
+        arrays and their offsets, the pickled values and their offset. With compact an object tree is laid out as a
+        compact tree, which it can then be opened as.
+        """
+        if self._store is not None:
+            arrays = dict((name, getattr(self._store, name)) for name in _STORE_ARRAYS)
+            payload = self._store.values
+            roots = [r.index for r in self.roots]
+        else:
+            arrays, nodes = self._object_arrays()
+            payload = dict((i, n.value) for i, n in enumerate(nodes) if hasattr(n, 'value'))
+            roots = range(len(self.roots))
+        arrays['roots'] = array('i', roots)
+        payload = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL) if values else b''
+
+        offset = _FILE_HEADER.size + _FILE_GRID.size + len(_FILE_ARRAYS)*_FILE_ENTRY.size
+        entries = []
+        for name in _FILE_ARRAYS:
+            offset = -(-offset//8)*8
+            entries.append((name, arrays[name], offset))
+            offset += arrays[name].itemsize*len(arrays[name])
+
+        if self._store is None:
+            storage = MSPStorageType.Compact if compact else MSPStorageType.Objects
+        else:
+            storage = MSPStorageType.Integer if self._store.integer else MSPStorageType.Compact
+        header = [_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, b'<' if sys.byteorder == 'little' else b'>',
+                                    storage, self.tree_type, self.lazy, self.max_depth, offset, len(payload)),
+                  _FILE_GRID.pack(self.cell_size, self.sparse)]
+        for name, values, start in entries:
+            header.append(_FILE_ENTRY.pack(name.encode('ascii'), _typecode(values).encode('ascii'), values.itemsize,
+                                           len(values), start))
+        return b''.join(header), [(values, start) for _, values, start in entries], payload, offset
+
+    @_locked
+    def save(self, path, values=True):
+        """ Saves the tree to path in a versioned binary format, the nodes as flat arrays in the layout of the compact
+        store. The values of the nodes are pickled along with them unless values is False.
+        """
+        header, entries, payload, _ = self._frozen(values)
+        with open(path, 'wb') as f:
+            f.write(header)
+            for values, start in entries:
+                f.write(b'\0'*(start - f.tell()))
+                f.write(memoryview(values).cast('B'))
+            f.write(payload)
+
+    @_locked
+    def share(self, values=True):
+        """ Freezes the tree into a block of shared memory, laid out like the files written by save, for worker
+        processes to open with attach. Returns the multiprocessing.shared_memory.SharedMemory block, its name is what
+        the workers need. The block outlives the processes using it until unlink is called on it, which the process
+        sharing the tree should do once the workers are done. Changes made to the tree afterwards aren't seen by the
+        workers. Object trees are shared as compact trees. Needs multiprocessing.shared_memory.
+        """
+        if _shared_memory is None:
+            raise NotImplementedError("multiprocessing.shared_memory is not available on this platform")
+        header, entries, payload, offset = self._frozen(values, compact=True)
+        block = _shared_memory.SharedMemory(create=True, size=offset + len(payload))
+        block.buf[:len(header)] = header
+        for values, start in entries:
+            data = memoryview(values).cast('B')
+            block.buf[start:start + len(data)] = data
+        block.buf[offset:offset + len(payload)] = payload
+        return block
+
+    @staticmethod
+    def attach(name):
+        """ Opens a tree shared with share by the name of its shared memory block. The node arrays are read-only views
+        of the block, so opening the tree copies nothing but the values, which each process unpickles, and all
+        processes attached to a block use a single copy of the nodes. The read-only methods work as on any compact
+        tree: find_closest_node, find_closest_many, knn and the other queries, get_node, neighbors, evaluate and the
+        traversals. Like a memory mapped tree, see load, the arrays are copied into the memory of the process the
+        first time it changes the tree, which includes creating the children of a lazy tree, other processes don't see
+        the change. The block must stay linked while the tree is in use.
+        """
+        if _shared_memory is None:
+            raise NotImplementedError("multiprocessing.shared_memory is not available on this platform")
+        try:
+            # The process sharing the tree decides when the block goes away, not the resource tracker of this one
+            block = _shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            block = _shared_memory.SharedMemory(name=name)
+        view = block.buf.toreadonly()
+        position = [0]
+
+        def read(size):
+            data = view[position[0]:position[0] + size].tobytes()
+            position[0] += size
+            return data
+
+        fields, entries = MSPTree._read_header(read, name)
+        arrays = dict((entry, view[start:start + itemsize*length].cast(typecode))
+                      for entry, (typecode, itemsize, length, start) in entries.items())
+        payload_start, payload_length = fields[-2:]
+        payload = pickle.loads(view[payload_start:payload_start + payload_length]) if payload_length else {}
+        return MSPTree._from_arrays(fields, arrays, payload, block)
+
+    @staticmethod
+    def _read_header(read, path):
+        """ Reads the header and the directory of a tree in the file format of save with read, a function returning
+        the given number of bytes that follow. Returns the header fields, storage, tree type, lazy, max depth, cell
+        size, sparse, payload start and payload length, and a dictionary with the type code, item size, length and
+        offset of every array.
+        """
+        header = read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size or not header.startswith(_FILE_MAGIC):
+            raise ValueError("%s is not an MSP tree file" % path)
+        _, version, byteorder, storage, tree_type, lazy, max_depth, payload_start, payload_length = \
+            _FILE_HEADER.unpack(header)
+        if version > _FILE_VERSION:
+            raise ValueError("%s has format version %d, at most %d is supported" % (path, version, _FILE_VERSION))
+        if byteorder != (b'<' if sys.byteorder == 'little' else b'>'):
+            raise ValueError("%s was written on a machine with a different byte order" % path)
+        cell_size, sparse = _FILE_GRID.unpack(read(_FILE_GRID.size)) if version >= 2 else (1., False)
+
+        entries = {}
+        for _ in _FILE_ARRAYS:
+            name, typecode, itemsize, length, start = _FILE_ENTRY.unpack(read(_FILE_ENTRY.size))
+            name, typecode = name.rstrip(b'\0').decode('ascii'), typecode.decode('ascii')
+            if array(typecode).itemsize != itemsize:
+                raise ValueError("%s stores %s with %d byte items, this platform uses %d" %
+                                 (path, name, itemsize, array(typecode).itemsize))
+            entries[name] = (typecode, itemsize, length, start)
+        return (storage, tree_type, lazy, max_depth, cell_size, sparse, payload_start, payload_length), entries
+
+    @staticmethod
+    def load(path, mmap=True):
+        """ Opens a tree saved with save. With mmap the node arrays of a compact tree are used straight from the memory
+        mapped file, so opening a tree is quick no matter its size, the pages are read as they are used and processes
+        opening the same file share them. The arrays are copied into memory the first time the tree is expanded.
+        Object trees are always read into memory.
+        """
+        with open(path, 'rb') as f:
+            fields, entries = MSPTree._read_header(f.read, path)
+            storage, payload_start, payload_length = fields[0], fields[-2], fields[-1]
+
+            mapped = None
+            if mmap and storage != MSPStorageType.Objects:
+                mapped = _memory_map(f.fileno(), 0, access=ACCESS_READ)
+                view = memoryview(mapped)
+                arrays = dict((name, view[start:start + itemsize*length].cast(typecode))
+                              for name, (typecode, itemsize, length, start) in entries.items())
+            else:
+                arrays = {}
+                for name, (typecode, itemsize, length, start) in entries.items():
+                    f.seek(start)
+                    arrays[name] = array(typecode)
+                    arrays[name].frombytes(f.read(itemsize*length))
+
+            f.seek(payload_start)
+            payload = pickle.loads(f.read(payload_length)) if payload_length else {}
+        return MSPTree._from_arrays(fields, arrays, payload, mapped)
+
+    @staticmethod
+    def _from_arrays(fields, arrays, payload, mapped):
+        """ Makes the tree described by the header fields of _read_header from its node arrays and values. The arrays
+        of a compact tree are used as they are, mapped is what backs them if they are views.
+        """
+        storage, tree_type, lazy, max_depth, cell_size, sparse = fields[:6]
+        tree = MSPTree(max_depth, tree_type, storage, lazy=bool(lazy), cell_size=cell_size if sparse else None)
+        roots = list(arrays['roots'])
+        if storage == MSPStorageType.Objects:
+            nodes = [None]*len(arrays['x'])
+            tree._object_count = 0
+            tree._objects_from_arrays(dict((name, np.frombuffer(arrays[name], dtype=_typecode(arrays[name])))
+                                           for name in _STORE_ARRAYS), nodes, 0)
+            tree.roots = [nodes[i] for i in roots]
+            for i, value in payload.items():
+                nodes[i].value = value
+        else:
+            store = tree._store
+            for name in _STORE_ARRAYS:
+                setattr(store, name, arrays[name])
+            store.values = payload
+            store.mapped = mapped
+            store.dead = int(np.count_nonzero(np.frombuffer(arrays['parent'], dtype=_typecode(arrays['parent'])) == -2))
+            tree.roots = [MSPTree._NodeHandle(store, i) for i in roots]
+        tree._root_cells = dict((tree._root_cell(r.position), i) for i, r in enumerate(tree.roots))
+        return tree
+
+    def _expand_chunk(self, points):
+        paths = self._paths(points)
+        roots, slots = paths[:, 0].astype(int), paths[:, 1:]
+        store = self._store
+        current = np.array([r.index for r in self.roots])[roots]
+        for level in range(self.max_depth):
+            store.expand_many(current)
+            current = store.children_at(current, slots[:, level])
+            self._touch_many(current, level + 1)
+        return [MSPTree._NodeHandle(store, i) for i in current.tolist()]
+
+    def _expand_points(self, points):
+        """ Descends every point of an (N,3) array like expand_to, one point at a time, leaving the budget to be
+        enforced once by the caller. Returns the list of leaves in the order of the points.
+        """
+        leaves, top = [], self.max_depth if self._budget is None else self._budget[2]
+        for point in points.tolist():
+            node = self._root(point, create=True).expand_to(point, 0, top)
+            if self._budget is not None:
+                self._touch([node])
+            leaves.append(node.expand_to(point, top, self.max_depth))
+        return leaves
+
+    def query_ball(self, center, r, level=None, arrays=False):
+        """ The nodes that carry a value within distance r of center, or with level given all nodes of that level
+        within distance r. Subtrees that can't reach the ball are skipped, using the scale of their root. Returns a
+        generator of nodes, or with arrays an (N,3) array of positions and the list of their values.
+        """
+        center = np.asarray(center, dtype=np.float64).reshape(3)
+
+        def inside(positions):
+            d = positions - center
+            return (d*d).sum(1) <= r*r
+
+        def reaches(positions, scales, lattices):
+            d = positions - center
+            return np.sqrt((d*d).sum(1)) <= r + _REACH[lattices]*scales
+
+        return self._query(inside, reaches, level, arrays)
+
+    def query_box(self, lo, hi, level=None, arrays=False):
+        """ The nodes that carry a value in the axis aligned box [lo, hi], or with level given all nodes of that level
+        in the box. Subtrees that can't reach the box are skipped, using the scale of their root. Returns a generator
+        of nodes, or with arrays an (N,3) array of positions and the list of their values.
+        """
+        lo = np.asarray(lo, dtype=np.float64).reshape(3)
+        hi = np.asarray(hi, dtype=np.float64).reshape(3)
+
+        def inside(positions):
+            return ((positions >= lo) & (positions <= hi)).all(1)
+
+        def reaches(positions, scales, lattices):
+            reach = (_REACH_MAX[lattices]*scales)[:, None]
+            return ((positions >= lo - reach) & (positions <= hi + reach)).all(1)
+
+        return self._query(inside, reaches, level, arrays)
+
+    def _query(self, inside, reaches, level, arrays):
+        batches = self._query_levels(inside, reaches, level)
+        if not arrays:
+            return (node for batch in batches for node in batch)
+
+        nodes = [node for batch in batches for node in batch]
+        positions = np.array([n.position for n in nodes], dtype=np.float64).reshape(-1, 3)
+        return positions, [getattr(n, 'value', None) for n in nodes]
+
+    def _query_levels(self, inside, reaches, level):
+        """ Walks the tree one level at a time, keeping only the subtrees that reach the region, yields the list of
+        matching nodes found at each level
+        """
+        store = self._store
+        if store is not None:
+            frontier = np.array([r.index for r in self.roots])
+        else:
+            frontier = list(self.roots)
+
+        depth = 0
+        while len(frontier):
+            # The lock isn't held while the caller consumes a batch, it may change the tree in between
+            batch = None
+            with self._lock:
+                if store is not None:
+                    positions = store.positions(frontier)
+                    scales = _gather(store.scale, frontier).astype(np.float64)
+                    lattices = _gather(store.lattice, frontier)
+                else:
+                    positions = np.array([n.position for n in frontier], dtype=np.float64)
+                    scales = np.array([n.scale for n in frontier], dtype=np.float64)
+                    lattices = np.array([n.lattice for n in frontier], dtype=int)
+
+                if level is None or depth == level:
+                    batch = [frontier[i] for i in np.nonzero(inside(positions))[0].tolist()]
+                    if store is not None:
+                        if level is None:
+                            batch = [i for i in batch if i in store.values]
+                        batch = [MSPTree._NodeHandle(store, i) for i in batch]
+                    elif level is None:
+                        batch = [n for n in batch if hasattr(n, 'value')]
+
+                if depth != level:
+                    keep = reaches(positions, scales, lattices)
+                    if store is not None:
+                        frontier = store.children_of(frontier[keep])
+                    else:
+                        frontier = [c for n, k in zip(frontier, keep.tolist()) if k
+                                    for c in MSPTree._materialized(n)]
+            if batch is not None:
+                yield batch
+            if depth == level:
+                return
+            depth += 1
+
+    def iter_leaves(self):
+        """ Generator of the leaves of the tree, the nodes without children, depth first with the children of a node
+        in the order of their expansion rule. In a lazy tree only created nodes are visited, an expanded node none of
+        whose children were created yet counts as a leaf. The tree is walked with an explicit stack, so the walk holds
+        a few nodes per level however deep and large the tree is.
+        """
+        for node in self._walk(-1):
+            if node is not None:
+                yield node
+
+    def iter_level(self, level):
+        """ Generator of the nodes at the given level, in the order of iter_leaves
+        """
+        for node in self._walk(level):
+            if node is not None and node.level == level:
+                yield node
+
+    def _walk(self, level):
+        """ Depth first walk down to level, or all the way with a negative level, yields the nodes with no children
+        to walk into and None for the others
+        """
+        store = self._store
+        if store is not None:
+            stack = [r.index for r in reversed(self.roots)]
+            while stack:
+                index = stack.pop()
+                children = store.child_list(index) if store.level[index] != level else []
+                if len(children):
+                    stack.extend(reversed(children))
+                    yield None
+                else:
+                    yield MSPTree._NodeHandle(store, index)
+            return
+
+        stack = list(reversed(self.roots))
+        while stack:
+            node = stack.pop()
+            children = MSPTree._materialized(node) if node.level != level else []
+            if len(children):
+                stack.extend(reversed(children))
+                yield None
+            else:
+                yield node
+
+    @_locked
+    def extract_level(self, level, lo=None, hi=None, fill=0., values=True):
+        """ Level of detail cut through the tree, the nodes of the given level along with the leaves above it, so
+        the cut covers every region the tree reaches, leaves are counted as in iter_leaves. With lo and hi only the
+        nodes inside the axis aligned box [lo, hi] are kept and subtrees that can't reach the box are skipped. The tree
+        is walked one level at a time, without making a node object or handle per node with compact storage. Returns
+        an (N,3) array of positions, an array of their colors and an array of their values, nodes without a value take
+        fill. Values must all have the same shape as fill. Without values None is returned in place of the values.
+        """
+        lo = np.full(3, -np.inf) if lo is None else np.asarray(lo, dtype=np.float64).reshape(3)
+        hi = np.full(3, np.inf) if hi is None else np.asarray(hi, dtype=np.float64).reshape(3)
+        store = self._store
+        frontier = np.array([r.index for r in self.roots], dtype=int) if store is not None else list(self.roots)
+        # A sparse tree may have no roots, so there is always something to concatenate
+        positions, colors, found = [np.zeros((0, 3))], [np.zeros(0, dtype=np.int8)], []
+
+        depth = 0
+        while len(frontier):
+            if store is not None:
+                p = store.positions(frontier)
+                scales = _gather(store.scale, frontier).astype(np.float64)
+                lattices = _gather(store.lattice, frontier)
+                expanded = _gather(store.first_child, frontier) >= 0
+                if store.lazy:
+                    expanded &= np.isin(frontier, _gather(store.parent, store.children_of(frontier[expanded])))
+                leaves = ~expanded | (depth == level)
+            else:
+                p = np.array([n.position for n in frontier], dtype=np.float64).reshape(-1, 3)
+                scales = np.array([n.scale for n in frontier], dtype=np.float64)
+                lattices = np.array([n.lattice for n in frontier], dtype=int)
+                leaves = np.array([depth == level or not len(MSPTree._materialized(n)) for n in frontier], dtype=bool)
+
+            cut = leaves & ((p >= lo) & (p <= hi)).all(1)
+            positions.append(p[cut])
+            if store is not None:
+                nodes = frontier[cut]
+                colors.append(_gather(store.color, nodes))
+                if values:
+                    found.extend(store.values.get(i, fill) for i in nodes.tolist())
+            else:
+                nodes = [n for n, c in zip(frontier, cut.tolist()) if c]
+                colors.append(np.array([n.color for n in nodes], dtype=np.int8))
+                if values:
+                    found.extend(getattr(n, 'value', fill) for n in nodes)
+
+            reach = (_REACH_MAX[lattices]*scales)[:, None]
+            keep = ~leaves & ((p >= lo - reach) & (p <= hi + reach)).all(1)
+            if store is not None:
+                frontier = store.children_of(frontier[keep])
+            else:
+                frontier = [c for n, k in zip(frontier, keep.tolist()) if k for c in MSPTree._materialized(n)]
+            depth += 1
+
+        if values:
+            values = np.array(found) if found else np.zeros((0,) + np.shape(fill))
+        else:
+            values = None
+        return np.concatenate(positions), np.concatenate(colors).astype(np.int8), values
+
+    @_locked
+    def evaluator(self, kernel=None):
+        """ An MSPEvaluator for the function the tree represents, see evaluate
+        """
+        return MSPEvaluator(self, kernel)
+
+    @_timed
+    @_locked
+    def evaluate(self, points, kernel=None, level=-1):
+        """ Evaluates the function represented by a function space tree at every point of an (N,3) array. The value of
+        each node is its coefficient, a number or a fixed length vector. Each point sums the coefficients of the nodes
+        on its path down the tree, the nodes find_closest_node passes through, weighted by the basis kernel, which
+        gets the offsets from the nodes to the points in units of the node scales. The default kernel is box_kernel,
+        which weights every coefficient by one. If level is not negative only the nodes of that level and above
+        contribute. The evaluator is kept by the tree, an object tree is only flattened again once nodes have been
+        added or removed, the coefficients are gathered again on every call.
+        """
+        kernel = box_kernel if kernel is None else kernel
+        changes = self._store, len(self.roots), self._changes if self._store is None else self._store.changes
+        if self._evaluator is None or self._evaluator[0] != changes or self._evaluator[1].kernel is not kernel:
+            self._evaluator = changes, self.evaluator(kernel)
+        else:
+            self._evaluator[1]._gather_values(self)
+        return self._evaluator[1].evaluate(points, level)
+
+    @_timed
+    def knn(self, point, k=1):
+        """ The k nodes carrying a value closest to point, nearest first, and the list of their distances. This is a
+        best first search over the tree, a subtree is only opened once no valued node found so far can be closer than
+        the bound on its distance given by the scale of its root, so the result is exact. Fewer than k nodes are
+        returned if the tree doesn't hold that many values.
+        """
+        px, py, pz = point[0], point[1], point[2]
+        store = self._store
+        if store is not None:
+            position, valued, children = store.position, store.values.__contains__, store.child_list
+            scale, lattice = store.scale.__getitem__, store.lattice.__getitem__
+            nodes = [r.index for r in self.roots]
+        else:
+            position, valued, children = (lambda n: n.position), (lambda n: hasattr(n, 'value')), MSPTree._materialized
+            scale, lattice = (lambda n: n.scale), (lambda n: n.lattice)
+            nodes = self.roots
+
+        # Entries are (bound, order, node, distance), a node whose distance is None stands for its whole subtree
+        heap, order = [], itertools.count()
+        found, distances = [], []
+        while True:
+            for node in nodes:
+                x, y, z = position(node)
+                d = math.sqrt((px-x)*(px-x) + (py-y)*(py-y) + (pz-z)*(pz-z))
+                heapq.heappush(heap, (max(0.0, d - _REACH[lattice(node)]*scale(node)), next(order), node, None))
+            if not heap or len(found) == k:
+                break
+
+            bound, _, node, d = heapq.heappop(heap)
+            nodes = []
+            if d is not None:
+                found.append(node)
+                distances.append(d)
+                continue
+            if valued(node):
+                x, y, z = position(node)
+                d = math.sqrt((px-x)*(px-x) + (py-y)*(py-y) + (pz-z)*(pz-z))
+                heapq.heappush(heap, (d, next(order), node, d))
+            nodes = children(node)
+
+        if store is not None:
+            found = [MSPTree._NodeHandle(store, i) for i in found]
+        return found, distances
+
+    @_timed
+    @_locked
+    def knn_many(self, points, k=1, group_size=32):
+        """ knn for an (N,3) array of points. Nearby points are searched together, the points are split into groups of
+        at most group_size and each group makes a single best first pass over the tree. A subtree is opened once no
+        point of the group has k valued nodes closer than the bound on its distance to the ball around the group, and
+        the distances from all points of the group to the valued nodes found are computed in one go. The result is
+        exact like that of knn, only nodes at the same distance from a point may come in another order. Returns a list
+        holding the list of nodes found for each point, and an (N,k) array of distances padded with inf where fewer
+        than k nodes were found.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        nodes = [[] for _ in range(len(points))]
+        distances = np.full((len(points), max(k, 0)), np.inf)
+        if k < 1:
+            return nodes, distances
+        for group in _query_groups(points, max(1, group_size)):
+            found, distances[group] = self._knn_group(points[group], k)
+            for i, group_nodes in zip(group.tolist(), found):
+                nodes[i] = group_nodes
+        return nodes, distances
+
+    def _knn_group(self, points, k):
+        """ The k nearest valued nodes of each point of an (N,3) array of nearby points, found in a single best first
+        search, as a list of lists of nodes and an (N,k) array of distances
+        """
+        store = self._store
+        if store is not None:
+            position, valued, children = store.position, store.values.__contains__, store.child_list
+            scale, lattice = store.scale.__getitem__, store.lattice.__getitem__
+            nodes = [r.index for r in self.roots]
+        else:
+            position, valued, children = (lambda n: n.position), (lambda n: hasattr(n, 'value')), MSPTree._materialized
+            scale, lattice = (lambda n: n.scale), (lambda n: n.lattice)
+            nodes = self.roots
+
+        center = (points.min(0) + points.max(0))/2
+        radius = np.sqrt(((points - center)**2).sum(1).max())
+        cx, cy, cz = center.tolist()
+
+        # The best distances of each point so far and the candidates they belong to, nearest first. Valued nodes are
+        # gathered in pending until their distances are worth computing, limit is the largest k-th best distance
+        best = np.full((len(points), k), np.inf)
+        best_rows = np.full((len(points), k), -1)
+        candidates, pending = [], []
+        limit = np.inf
+
+        # Entries are (bound, order, node), each standing for the subtree of node
+        heap, order = [], itertools.count()
+        while True:
+            for node in nodes:
+                x, y, z = position(node)
+                d = math.sqrt((cx-x)*(cx-x) + (cy-y)*(cy-y) + (cz-z)*(cz-z))
+                bound = max(0.0, d - radius - _REACH[lattice(node)]*scale(node))
+                if bound <= limit:
+                    heapq.heappush(heap, (bound, next(order), node))
+            if pending and (len(pending) >= _KNN_BATCH or not heap or heap[0][0] > limit):
+                if store is not None:
+                    found = store.positions(np.array(pending, dtype=int))
+                else:
+                    found = np.array([n.position for n in pending], dtype=np.float64)
+                # Same arithmetic as knn, so the distances match it exactly
+                dx = points[:, 0, None] - found[None, :, 0]
+                dy = points[:, 1, None] - found[None, :, 1]
+                dz = points[:, 2, None] - found[None, :, 2]
+                rows = np.arange(len(candidates), len(candidates) + len(pending))
+                candidates.extend(pending)
+                pending = []
+                merged = np.concatenate([best, np.sqrt(dx*dx + dy*dy + dz*dz)], 1)
+                merged_rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(points), len(rows)))], 1)
+                nearest = np.argsort(merged, axis=1, kind='stable')[:, :k]
+                best = np.take_along_axis(merged, nearest, 1)
+                best_rows = np.take_along_axis(merged_rows, nearest, 1)
+                limit = best[:, -1].max()
+            if not heap or heap[0][0] > limit:
+                break
+
+            _, _, node = heapq.heappop(heap)
+            if valued(node):
+                pending.append(node)
+            nodes = children(node)
+
+        if store is not None:
+            candidates = [MSPTree._NodeHandle(store, i) for i in candidates]
+        return [[candidates[i] for i in row if i >= 0] for row in best_rows.tolist()], best
+
+    @_timed
+    @_locked
+    def insert(self, point, value=None):
+        """ Adds a point to a space partitioning tree. The value of a leaf is its bucket, a list of (point, value)
+        pairs, and the point goes into the bucket of the leaf find_closest_node leads it to. A leaf whose bucket holds
+        more than bucket_capacity points is split, it is expanded and its points are moved into the buckets of its
+        children, unless it is at max_depth. Nodes are only added where the points are dense. Returns the leaf the
+        point ends up in.
+        """
+        if self.tree_type != MSPTreeType.SpacePartitioning:
+            raise ValueError("Points can only be inserted into space partitioning trees")
+        point = (float(point[0]), float(point[1]), float(point[2]))
+        self._root(point, create=True)
+        leaf = self.find_closest_node(point)
+        self._add_to_bucket(leaf, (point, value))
+        if self._aggregator is not None:
+            self._aggregate_path(self._path(leaf), value)
+
+        split = leaf
+        while len(leaf.value) > self.bucket_capacity and leaf.level < self.max_depth:
+            entries = leaf.value
+            del leaf.value
+            leaf.expand_node()
+            for entry in entries:
+                self._add_to_bucket(leaf.find_closest_node(entry[0], 1), entry)
+            leaf = leaf.find_closest_node(point, 1)
+        if self._aggregator is not None and leaf is not split:
+            self._rebuild_aggregates(split)
+        self._enforce_budget()
+        return leaf
+
+    @_timed
+    @_locked
+    def insert_many(self, points, values=None):
+        """ insert for every point of an (N,3) array, returns the list of leaves the points end up in
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3).tolist()
+        if values is not None and len(values) != len(points):
+            raise ValueError("Got %d values for %d points" % (len(values), len(points)))
+        for p, value in zip(points, [None]*len(points) if values is None else values):
+            self.insert(p, value)
+        # Points inserted early may have moved down since
+        return [self.find_closest_node(p) for p in points]
+
+    @staticmethod
+    def _add_to_bucket(node, entry):
+        if not hasattr(node, 'value'):
+            node.value = []
+        node.value.append(entry)
+
+    @_timed
+    def find_closest_node(self, point, level=-1):
+        """ Finds the node closest to point, stopping at the given level of the tree if level is not negative. Returns
+        None if a sparse tree has no roots yet.
+        """
+        node = self._root(point)
+        if node is None:
+            return None
+        if self._budget is not None and (level < 0 or level >= self._budget[2]):
+            top = self._budget[2]
+            node = node.find_closest_node(point, top)
+            if node.level == top:
+                self._touch([node])
+            return node.find_closest_node(point, level - top if level >= 0 else -1)
+        return node.find_closest_node(point, level)
+
+    @_timed
+    @_locked
+    def find_closest_many(self, points, level=-1):
+        """ Read only version of find_closest_node for an (N,3) array of points. All points are descended together,
+        returns the list of closest nodes, the depth at which each was found and the squared distance from each
+        point to its node. In a lazy tree the returned nodes are created if they don't exist yet, nothing is expanded.
+        Like find_closest_node, a sparse tree without roots returns None for every point, at depth 0 and an infinite
+        distance.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if not self.roots:
+            return [None]*len(points), np.zeros(len(points), dtype=int), np.full(len(points), np.inf)
+        current = self._root_rows(points)
+        depth = np.zeros(len(points), dtype=int)
+
+        if self._store is not None:
+            nodes = self._find_compact(points, current, depth, level)
+            positions = self._store.positions(nodes)
+            nodes = [MSPTree._NodeHandle(self._store, i) for i in nodes.tolist()]
+        else:
+            nodes = self._find_objects(points, current, depth, level)
+            positions = np.array([n.position for n in nodes], dtype=np.float64).reshape(-1, 3)
+
+        d = points - positions
+        return nodes, depth, d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1] + d[:, 2]*d[:, 2]
+
+    def _find_compact(self, points, current, depth, level):
+        store = self._store
+        current = np.array([r.index for r in self.roots])[current]
+        active = np.arange(len(points))
+        while len(active):
+            if level >= 0:
+                active = active[depth[active] < level]
+            active = active[_gather(store.first_child, current[active]) >= 0]
+            current[active] = store.closest_children(current[active], points[active])
+            depth[active] += 1
+        return current
+
+    def _find_objects(self, points, current, depth, level):
+        # Nodes reached so far, current indexes into this list
+        nodes = list(self.roots)
+        active = np.arange(len(points))
+        while len(active):
+            if level >= 0:
+                active = active[depth[active] < level]
+            parents, parent_of = np.unique(current[active], return_inverse=True)
+            parents = [nodes[i] for i in parents.tolist()]
+            parent_of = parent_of.reshape(-1)
+            expanded = np.array([len(n.children) > 0 for n in parents], dtype=bool)
+            active, parent_of = active[expanded[parent_of]], parent_of[expanded[parent_of]]
+
+            # Child positions follow from the expansion rules, so lazy nodes only create the children picked
+            rules = np.array([_RULE_IDS.get((n.lattice, n.color), -1) for n in parents], dtype=int)
+            origins = np.array([n.position for n in parents], dtype=np.float64).reshape(-1, 3)
+            scales = np.array([n.scale for n in parents], dtype=np.float64)
+            slots = np.zeros(len(active), dtype=int)
+            for rule in np.unique(rules[parent_of]).tolist():
+                select = rules[parent_of] == rule
+                p = parent_of[select]
+                children = origins[p, None, :] + _RULE_OFFSETS[rule][None, :, :]*scales[p, None, None]
+                slots[select] = _closest_rows(points[active[select]], children)
+                if self._stats is not None:
+                    self._stats.picks += len(p)
+                    self._stats.distance_evaluations += children.shape[0]*children.shape[1]
+
+            keys, picked = np.unique(parent_of*32 + slots, return_inverse=True)
+            current[active] = len(nodes) + picked.reshape(-1)
+            nodes.extend(parents[key >> 5].children[key & 31] for key in keys.tolist())
+            depth[active] += 1
+        return [nodes[i] for i in current.tolist()]
+
+    @_timed
     def expand_to(self, point):
-        dot = lambda x, y: abs((x[0]-y[0])*(x[0] - y[0]) + (x[1]-y[1])*(x[1] - y[1]) + (x[2]-y[2])*(x[2]-y[2]))
-        node = min([(dot(point, n.position), n) for n in self.roots], key=lambda x: x[0])[1]
-        return node.expand_to(point, 0, self.max_depth)
+        node = self._root(point, create=True)
+        if self._budget is None:
+            return node.expand_to(point, 0, self.max_depth)
+        top = self._budget[2]
+        node = node.expand_to(point, 0, top)
+        self._touch([node])
+        leaf = node.expand_to(point, top, self.max_depth)
+        self._enforce_budget()
+        return leaf
+
+
+class MSPEvaluator(object):
+    """ Evaluates the function represented by a function space tree, see MSPTree.evaluate. The coefficients and the
+    node data the descent needs are gathered once when the evaluator is made, so evaluating many batches of points
+    only pays for the descent and the kernel. Nodes added to the tree and values changed afterwards aren't seen,
+    make a new evaluator for those.
+    """
+
+    def __init__(self, tree, kernel=None):
+        if tree.tree_type != MSPTreeType.FunctionSpace:
+            raise ValueError("Only function space trees can be evaluated")
+        self.kernel = box_kernel if kernel is None else kernel
+        with tree._lock:
+            self._gather(tree)
+
+    def _gather(self, tree):
+        if tree._store is not None:
+            store, self.nodes = tree._store, None
+            self.roots = np.array([r.index for r in tree.roots], dtype=int)
+        else:
+            # Object trees are flattened into a store, which nothing will expand
+            arrays, self.nodes = tree._object_arrays()
+            store = MSPTree._NodeStore(lazy=tree.lazy)
+            for name in _STORE_ARRAYS:
+                setattr(store, name, arrays[name])
+            self.roots = np.arange(len(tree.roots))
+        self.store = store
+        self.root_positions = store.positions(self.roots)
+        # Sparse trees pick the root of the cell of a point, like the tree does
+        self.root_cells = dict(tree._root_cells) if tree.sparse else None
+        self.cell_size = tree.cell_size
+        self._gather_values(tree)
+
+    def _gather_values(self, tree):
+        # The coefficient of every node, zero for the nodes without a value
+        if self.nodes is None:
+            values = tree._store.values
+        else:
+            values = dict((i, n.value) for i, n in enumerate(self.nodes) if hasattr(n, 'value'))
+        indices = sorted(values)
+        coefficients = np.asarray([values[i] for i in indices], dtype=np.float64)
+        self.shape = coefficients.shape[1:]
+        self.coefficients = np.zeros((len(self.store),) + self.shape)
+        if indices:
+            self.coefficients[indices] = coefficients
+
+    def evaluate(self, points, level=-1):
+        """ Evaluates the function at every point of an (N,3) array, returns an array of N values, or of N vectors
+        if the coefficients are vectors
+        """
+        with self.store.lock:
+            return self._evaluate(np.asarray(points, dtype=np.float64).reshape(-1, 3), level)
+
+    def _evaluate(self, points, level):
+        store = self.store
+        if not len(self.roots):
+            return np.zeros((len(points),) + self.shape)
+        if self.root_cells is not None:
+            rows = _cell_rows(points, self.cell_size, self.root_cells)
+            missing = np.nonzero(rows < 0)[0]
+            rows[missing] = _closest_rows(points[missing], self.root_positions)
+            current = self.roots[rows]
+        else:
+            current = self.roots[_closest_rows(points, self.root_positions)]
+        result = np.zeros((len(points),) + self.shape)
+        active = np.arange(len(points))
+        depth = 0
+        while len(active):
+            self._add(result, active, current[active], points[active])
+            if depth == level:
+                break
+            active = active[_gather(store.first_child, current[active]) >= 0]
+            current[active] = store.closest_children(current[active], points[active], create=False)
+            # Nodes added after the evaluator was made have no coefficient and neither do missing lazy children
+            active = active[(current[active] >= 0) & (current[active] < len(self.coefficients))]
+            depth += 1
+        return result
+
+    def _add(self, result, rows, nodes, points):
+        coefficients = self.coefficients[nodes]
+        valued = np.nonzero(coefficients.reshape(len(nodes), -1).any(1))[0]
+        if len(valued):
+            offsets = (points[valued] - self.store.positions(nodes[valued])) / \
+                _gather(self.store.scale, nodes[valued]).astype(np.float64)[:, None]
+            weights = self.kernel(offsets).reshape((-1,) + (1,)*len(self.shape))
+            result[rows[valued]] += weights*coefficients[valued]
+
+
+class MSPStats(object):
+    """ Counters collected by a tree while stats are enabled, see MSPTree.enable_stats. They count the nodes expanded,
+    the children picked while descending towards points, the picks that had to compare the point against every child
+    instead of rounding to the lattice of the children, and the point to node distances computed, including those to
+    the roots. Calls to the expansion and query methods of the tree are timed, nested calls included, and handed to
+    the callbacks.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero
+        """
+        self.expansions = 0
+        self.picks = 0
+        self.scans = 0
+        self.distance_evaluations = 0
+        self.calls = {}
+        self.seconds = {}
+
+    def record(self, name, seconds):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        for callback in self.callbacks:
+            callback(name, seconds)
+
+    def snapshot(self):
+        """ The counters as a dictionary, with the number of calls and the total seconds spent in each timed method
+        """
+        return {
+            'expansions': self.expansions,
+            'picks': self.picks,
+            'scans': self.scans,
+            'distance_evaluations': self.distance_evaluations,
+            'timings': dict((name, {'calls': self.calls[name], 'seconds': self.seconds[name]}) for name in self.calls),
+        }
+
+
+class MSPAggregator(object):
+    """ Base class of the aggregates kept by MSPTree.set_aggregator. An aggregator turns a sample value into a state
+    with lift, combines two states with merge, which must be associative and commutative, and turns a state into the
+    aggregate with result.
+    """
+
+    def lift(self, value):
+        raise NotImplementedError
+
+    def merge(self, a, b):
+        raise NotImplementedError
+
+    def result(self, state):
+        return state
+
+
+class CountAggregator(MSPAggregator):
+    """ The number of samples
+    """
+
+    def lift(self, value):
+        return 1
+
+    def merge(self, a, b):
+        return a + b
+
+
+class SumAggregator(MSPAggregator):
+    """ The sum of the samples, numbers or vectors
+    """
+
+    def lift(self, value):
+        return np.asarray(value, dtype=np.float64)
+
+    def merge(self, a, b):
+        return a + b
+
+
+class MeanAggregator(MSPAggregator):
+    """ The mean of the samples, numbers or vectors
+    """
+
+    def lift(self, value):
+        return 1, np.asarray(value, dtype=np.float64)
+
+    def merge(self, a, b):
+        return a[0] + b[0], a[1] + b[1]
+
+    def result(self, state):
+        return state[1]/state[0]
+
+
+class MinAggregator(MSPAggregator):
+    """ The smallest sample, elementwise for vectors
+    """
+
+    def lift(self, value):
+        return np.asarray(value, dtype=np.float64)
+
+    def merge(self, a, b):
+        return np.minimum(a, b)
+
+
+class MaxAggregator(MSPAggregator):
+    """ The largest sample, elementwise for vectors
+    """
+
+    def lift(self, value):
+        return np.asarray(value, dtype=np.float64)
+
+    def merge(self, a, b):
+        return np.maximum(a, b)
+
+
+class MeanNormalAggregator(MSPAggregator):
+    """ The normalized mean of samples that are normal vectors, a zero vector if they cancel out
+    """
+
+    def lift(self, value):
+        return np.asarray(value, dtype=np.float64)
+
+    def merge(self, a, b):
+        return a + b
+
+    def result(self, state):
+        length = np.sqrt((state*state).sum())
+        return state/length if length > 0 else state
+
+
+class _AggregatorSet(MSPAggregator):
+    """ Several aggregators by name, with dictionaries of states and results
+    """
+
+    def __init__(self, aggregators):
+        self.aggregators = dict(aggregators)
+
+    def lift(self, value):
+        return dict((name, a.lift(value)) for name, a in self.aggregators.items())
+
+    def merge(self, a, b):
+        return dict((name, g.merge(a[name], b[name])) for name, g in self.aggregators.items())
+
+    def result(self, state):
+        return dict((name, a.result(state[name])) for name, a in self.aggregators.items())
+
+
+class MSPSpillDirectory(object):
+    """ A spill for MSPTree.set_budget that keeps the values of collapsed subtrees in a directory. Each subtree gets a
+    file named after the level and lattice key of its root, collapsing the same subtree again appends to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, node):
+        if hasattr(node, 'store'):
+            key = node.store.key(node.index)
+        else:
+            key = _lattice_key(node.position, node.level, node.tree.cell_size)
+        return os.path.join(self.path, 'node_%d_%d_%d_%d.pkl' % ((node.level,) + tuple(int(k) for k in key)))
+
+    def __call__(self, node, positions, values):
+        with open(self._file(node), 'ab') as f:
+            pickle.dump((positions, values), f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, node):
+        """ The positions and values spilled for the subtree rooted at node, as an (N,3) array and a list
+        """
+        positions, values = [np.zeros((0, 3))], []
+        if os.path.exists(self._file(node)):
+            with open(self._file(node), 'rb') as f:
+                while True:
+                    try:
+                        p, v = pickle.load(f)
+                    except EOFError:
+                        break
+                    positions.append(p)
+                    values.extend(v)
+        return np.concatenate(positions), values
@@ -0,0 +1,141 @@
+import unittest
+from .. msptree import MSPTree, MSPStorageType
+from .. importers import read_xyz, normalization, load_xyz
+from .. exporters import leaf_points, export_obj, export_xyz, export_ply
+from . test_msptree import export_obj as export_obj_nodes
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+class TestImportExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(19)
+        self.points = rng.normal(3, 2, (500, 3))
+        self.normals = rng.normal(0, 1, (500, 3))
+        self.xyz = os.path.join(self.directory, 'points.xyz')
+        np.savetxt(self.xyz, np.concatenate([self.points, self.normals], 1), fmt='%.9f')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_read_xyz(self):
+        chunks = list(read_xyz(self.xyz, chunk_size=1000))
+        self.assertTrue(len(chunks) > 10)
+        self.assertTrue(np.allclose(np.concatenate(chunks), np.loadtxt(self.xyz)))
+
+        with open(self.path('bad.xyz'), 'w') as f:
+            f.write('1 2 3\n4 5\n')
+        self.assertRaises(ValueError, list, read_xyz(self.path('bad.xyz')))
+
+    def test_read_xyz_errors(self):
+        # Comments, headers and blank lines are skipped
+        with open(self.path('commented.xyz'), 'w') as f:
+            f.write('# x y z\n1 2 3  # first\n\n# more\n4 5 6\n')
+        self.assertEqual(np.concatenate(list(read_xyz(self.path('commented.xyz')))).tolist(),
+                         [[1, 2, 3], [4, 5, 6]])
+
+        # Bad lines are named by their number in the file, however the file is chunked
+        for text, line in (('1 2 3\n4 5\n6 7 8 9\n', 2), ('# header\n1 2 3\n4 5 6\n7 8 nine\n', 4),
+                           ('1 2 3\n'*50 + '1 2\n', 51)):
+            with open(self.path('bad.xyz'), 'w') as f:
+                f.write(text)
+            for chunk_size in (7, 1 << 22):
+                with self.assertRaises(ValueError) as context:
+                    list(read_xyz(self.path('bad.xyz'), chunk_size))
+                self.assertTrue(', line %d:' % line in str(context.exception))
+
+    def test_normalization(self):
+        center, scale = normalization(lambda: read_xyz(self.xyz, chunk_size=1000))
+        self.assertTrue(np.allclose(center, self.points.mean(0)))
+        self.assertAlmostEquals(scale, np.sqrt(((self.points - self.points.mean(0))**2).sum(1)).max())
+
+    def test_load_xyz(self):
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(8, storage=storage)
+            center, scale = load_xyz(tree, self.xyz, values='columns', chunk_size=1000)
+            reference = MSPTree(8, storage=storage)
+            points = (np.loadtxt(self.xyz)[:, :3] - center)/scale
+            for p, n in zip(points.tolist(), self.normals.tolist()):
+                reference.expand_to(p).value = tuple(n)
+            self.assertEquals(tree.node_count(), reference.node_count())
+            for p in points[:50].tolist():
+                self.assertTrue(np.allclose(tree.find_closest_node(p).value, reference.find_closest_node(p).value))
+
+            # A file that fits in one chunk is normalized the same, and a known normalization can be handed in
+            for normalize in (True, (center, scale)):
+                again = MSPTree(8, storage=storage)
+                self.assertTrue(np.allclose(load_xyz(again, self.xyz, normalize)[0], center))
+                self.assertEquals(again.node_count(), reference.node_count())
+        self.assertRaises(ValueError, load_xyz, tree, self.xyz, values='normals')
+
+    def test_export(self):
+        tree = MSPTree(8)
+        load_xyz(tree, self.xyz, values='columns')
+
+        # Limited to the unit cube, the bulk exporter writes the same vertices as the node by node one
+        export_obj(tree, self.path('bulk.obj'), lo=(-1, -1, -1), hi=(1, 1, 1))
+        export_obj_nodes(tree, self.path('nodes.obj'))
+        with open(self.path('bulk.obj')) as f:
+            bulk = sorted(line.split() for line in f)
+        with open(self.path('nodes.obj')) as f:
+            self.assertEquals(bulk, sorted(line.split() for line in f))
+
+        self.assertTrue(len(leaf_points(tree)[0]) > len(bulk))
+        positions, normals = leaf_points(tree, normals=True)
+        self.assertTrue(0 < len(positions) < len(bulk))
+        export_obj(tree, self.path('normals.obj'), normals=True)
+        with open(self.path('normals.obj')) as f:
+            lines = [line.split() for line in f]
+        self.assertEquals([line[0] for line in lines], ['v']*len(positions) + ['vn']*len(positions))
+        self.assertTrue(np.allclose(np.array([line[1:] for line in lines], dtype=float),
+                                    np.concatenate([positions, normals]), atol=1e-6))
+
+        export_xyz(tree, self.path('out.xyz'), normals=True)
+        self.assertTrue(np.allclose(np.concatenate(list(read_xyz(self.path('out.xyz')))),
+                                    np.concatenate([positions, normals], 1), atol=1e-6))
+
+        for binary in (True, False):
+            export_ply(tree, self.path('out.ply'), normals=True, binary=binary)
+            with open(self.path('out.ply'), 'rb') as f:
+                data = f.read()
+            header, body = data.split(b'end_header\n', 1)
+            self.assertTrue(('element vertex %d' % len(positions)).encode('ascii') in header)
+            if binary:
+                rows = np.frombuffer(body, dtype='<f4').reshape(-1, 6)
+            else:
+                rows = np.array(body.split(), dtype=float).reshape(-1, 6)
+            self.assertTrue(np.allclose(rows, np.concatenate([positions, normals], 1), atol=1e-5))
+
+        tree = MSPTree(3)
+        tree.expand_to((0.1, 0.2, 0.3)).value = 1.0
+        self.assertRaises(ValueError, leaf_points, tree, True)
+
+    def test_export_sparse(self):
+        # The points of a sparse tree aren't normalized, leaves far outside the unit cube are exported too
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(12, storage=storage, cell_size=1.0)
+            load_xyz(tree, self.xyz, normalize=False, values='columns')
+            positions, normals = leaf_points(tree, normals=True)
+            self.assertEquals(len(positions), len(self.points))
+            self.assertTrue((np.abs(positions) > 1).any(1).sum() > len(positions)//2)
+            distances = np.sqrt(((positions[:, None] - self.points[None])**2).sum(2))
+            self.assertTrue(distances.min(1).max() < 0.1)
+
+            export_xyz(tree, self.path('sparse.xyz'), normals=True)
+            rows = np.concatenate(list(read_xyz(self.path('sparse.xyz'))))
+            self.assertTrue(np.allclose(rows, np.concatenate([positions, normals], 1), atol=1e-6))
+
+            inside, _ = leaf_points(tree, True, lo=(0, 0, 0), hi=(4, 4, 4))
+            self.assertTrue(0 < len(inside) < len(positions))
+            self.assertTrue(((inside >= 0) & (inside <= 4)).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
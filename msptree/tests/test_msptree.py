@@ -1,7 +1,20 @@
 import unittest
-from .. msptree import MSPTree, _NodeType, _NodeColor
+from .. msptree import MSPTree, MSPTreeType, MSPStorageType, MSPSpillDirectory, _NodeType, _NodeColor, hat_kernel
+from .. msptree import CountAggregator, MeanAggregator, MinAggregator, MaxAggregator, MeanNormalAggregator
+from .. msptree import _shared_memory
+from .. importers import load_xyz
+from .. exporters import export_obj as export_points
+import itertools
 import random
 import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+
 
 def export_obj(tree, output):
     def traverse(node, filep):
@@ -44,6 +57,17 @@ def export_obj_normal(tree, output):
     fh.close()
 
 
+def query_shared(args):
+    """ Worker of test_shared_memory, queries a tree shared with MSPTree.share
+    """
+    name, queries = args
+    tree = MSPTree.attach(name)
+    nodes = [tree.find_closest_node(q) for q in queries]
+    many, _, _ = tree.find_closest_many(queries)
+    return [n.position for n in nodes], [getattr(n, 'value', None) for n in nodes], [n.position for n in many], \
+        sum(1 for _ in tree.iter_leaves()), tree._store.mapped is not None
+
+
 class TestMSPTree(unittest.TestCase):
 
     def test_init(self):
@@ -174,39 +198,11 @@ class TestMSPTree(unittest.TestCase):
         nd.expand_node()
         export_obj(tree, 'msp_c4_exp.obj')
 
+    @unittest.skipUnless(os.path.exists('horse.xyz'), "needs the horse.xyz point set in the working directory")
     def test_horse_expansion(self):
-        dist = lambda x, y: abs((x[0]-y[0])*(x[0] - y[0]) + (x[1]-y[1])*(x[1] - y[1]) + (x[2]-y[2])*(x[2]-y[2]))**0.5
-
-        f = open('horse.xyz')
         tree = MSPTree(24)
-
-        l = f.readline()
-        verts = []
-
-        while l != "":
-            verts += [map(float, l.split())]
-            l = f.readline()
-
-        c = [sum(map(lambda x: x[0], verts)),
-             sum(map(lambda x: x[1], verts)),
-             sum(map(lambda x: x[2], verts))]
-        c = map(lambda x: x/len(verts), c)
-
-        def cnter(p):
-            return [p[0]-c[0], p[1]-c[1], p[2]-c[2]]
-        verts = map(cnter, verts)
-
-        ds = [dist(p, [0,0,0]) for p in verts]
-
-        scale = max(ds)
-        print c, scale
-
-        verts = [(p[0]/scale, p[1]/scale, p[2]/scale) for p in verts]
-
-        for v in verts:
-            x,y,z = v
-            tree.expand_to((x,y,z)).value = (x,y,z)
-        export_obj_normal(tree, 'tree_horse.obj')
+        load_xyz(tree, 'horse.xyz', values='points')
+        export_points(tree, 'tree_horse.obj', normals=True)
 
     def test_sphere_expansion(self):
         samples = 1000
@@ -214,7 +210,7 @@ class TestMSPTree(unittest.TestCase):
 
         f = open('out.obj', 'w')
 
-        for _ in xrange(samples):
+        for _ in range(samples):
             z = 2*random.random() - 1
             theta = 2*math.pi*random.random() - math.pi
             x = math.sin(theta)*math.sqrt(1-z*z)
@@ -225,6 +221,1041 @@ class TestMSPTree(unittest.TestCase):
         f.close()
         export_obj_normal(tree, 'tree_sphere.obj')
 
+    def test_compact_expansion(self):
+        random.seed(0)
+        tree = MSPTree(15)
+        compact = MSPTree(15, storage=MSPStorageType.Compact)
+
+        for _ in range(200):
+            z = 2*random.random() - 1
+            theta = 2*math.pi*random.random() - math.pi
+            p = (math.sin(theta)*math.sqrt(1-z*z), math.cos(theta)*math.sqrt(1-z*z), z)
+
+            nd = compact.expand_to(p)
+            nd.value = p
+            self.assertEquals(tree.expand_to(p).position, nd.position)
+
+        for root, compact_root in zip(tree.roots, compact.roots):
+            stack = [(root, compact_root)]
+            while stack:
+                a, b = stack.pop()
+                self.assertEquals((a.position, a.color, a.lattice, a.scale), (b.position, b.color, b.lattice, b.scale))
+                self.assertEquals(len(a.children), len(b.children))
+                stack.extend(zip(a.children, b.children))
+
+        self.assertEquals(tree.node_count(), compact.node_count())
+
+        nd = compact.find_closest_node((0.5, 0.5, 0.5))
+        self.assertEquals(nd, compact.find_closest_node((0.5, 0.5, 0.5)))
+        self.assertFalse(hasattr(nd, 'value'))
+
+    def test_expand_to_many(self):
+        random.seed(1)
+        points = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(500)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(12, storage=storage)
+            batch = MSPTree(12, storage=storage)
+
+            leaves = batch.expand_to_many(points, values=points, chunk_size=128)
+            self.assertEquals(len(leaves), len(points))
+            for p, leaf in zip(points, leaves):
+                self.assertEquals(tree.expand_to(p).position, leaf.position)
+            self.assertEquals(tree.node_count(), batch.node_count())
+            self.assertEquals(batch.find_closest_node(points[0]).value, points[0])
+
+    def test_bulk_load(self):
+        random.seed(8)
+        points = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(300)]
+        shuffled = list(points)
+        random.shuffle(shuffled)
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(12, storage=storage)
+            bulk = MSPTree(12, storage=storage)
+
+            leaves = bulk.bulk_load(points, values=points, chunk_size=128)
+            for p, leaf in zip(points, leaves):
+                self.assertEquals(tree.expand_to(p).position, leaf.position)
+            self.assertEquals(tree.node_count(), bulk.node_count())
+            self.assertEquals(bulk.find_closest_node(points[3]).value, points[3])
+            self.assertEquals(bulk.bulk_load(points[:10]), leaves[:10])
+            self.assertEquals(tree.node_count(), bulk.node_count())
+
+        # The node order doesn't depend on the order of the points
+        compact = MSPTree(12, storage=MSPStorageType.Compact)
+        compact.bulk_load(points)
+        other = MSPTree(12, storage=MSPStorageType.Compact)
+        other.bulk_load(shuffled)
+        self.assertEquals(compact._store.x, other._store.x)
+        self.assertEquals(compact._store.parent, other._store.parent)
+
+    def test_build_parallel(self):
+        random.seed(10)
+        points = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(300)]
+
+        self.assertRaises(ValueError, MSPTree(10).build_parallel, points)
+        for storage in (MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(10, storage=storage, lazy=lazy)
+                parallel = MSPTree(10, storage=storage, lazy=lazy, indexed=True)
+                parallel.expand_to(points[0])
+
+                leaves = parallel.build_parallel(points, values=points, workers=2)
+                for p, leaf in zip(points, leaves):
+                    self.assertEquals(tree.expand_to(p).position, leaf.position)
+                    self.assertEquals(parallel.find_closest_node(p), leaf)
+                    self.assertEquals(leaf.value, p)
+                    self.assertTrue(leaf in parallel.get_nodes(10, parallel.node_key(leaf)))
+                self.assertEquals(tree.node_count(), parallel.node_count())
+
+                nd = parallel.find_closest_node((0.2, 0.4, 0.6), 2)
+                self.assertEquals([c.position for c in nd.children],
+                                  [c.position for c in tree.find_closest_node((0.2, 0.4, 0.6), 2).children])
+
+    def test_save_load(self):
+        random.seed(11)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(100)]
+        queries = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(50)]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'tree.msp')
+
+        try:
+            for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+                for lazy in (False, True):
+                    tree = MSPTree(10, storage=storage, lazy=lazy)
+                    tree.expand_to_many(points, values=points)
+                    tree.save(path)
+                    count = tree.node_count()
+
+                    for mmap in (False, True):
+                        loaded = MSPTree.load(path, mmap=mmap)
+                        self.assertEquals((loaded.max_depth, loaded.storage, loaded.lazy), (10, storage, lazy))
+                        self.assertEquals(loaded.node_count(), count)
+                        for p in points:
+                            self.assertEquals(loaded.find_closest_node(p).value, p)
+                        for q in queries:
+                            self.assertEquals(loaded.find_closest_node(q).position, tree.find_closest_node(q).position)
+                        nodes, _, _ = loaded.find_closest_many(queries)
+                        self.assertEquals([n.position for n in nodes],
+                                          [tree.find_closest_node(q).position for q in queries])
+
+                        # A loaded tree can still grow
+                        self.assertEquals(loaded.expand_to((0.7, -0.2, 0.1)).position,
+                                          tree.expand_to((0.7, -0.2, 0.1)).position)
+                        self.assertEquals(loaded.node_count(), tree.node_count())
+                        del loaded, nodes
+
+            tree.save(path, values=False)
+            self.assertFalse(hasattr(MSPTree.load(path).find_closest_node(points[0]), 'value'))
+            with open(path, 'wb') as f:
+                f.write(b'not a tree')
+            self.assertRaises(ValueError, MSPTree.load, path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_range_queries(self):
+        random.seed(12)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(300)]
+
+        def all_nodes(tree):
+            stack = list(tree.roots)
+            while stack:
+                node = stack.pop()
+                yield node
+                stack.extend(node.children)
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(12, storage=storage)
+            tree.expand_to_many(points, values=points)
+            nodes = list(all_nodes(tree))
+
+            for center, r in (((0.1, 0.2, 0.3), 0.4), ((1, 1, 1), 0.8), ((0, 0, 5), 1)):
+                for level in (None, 4):
+                    expected = [n for n in nodes if sum((a - b)**2 for a, b in zip(n.position, center)) <= r*r and
+                                (n.level == level if level is not None else hasattr(n, 'value'))]
+                    found = list(tree.query_ball(center, r, level))
+                    self.assertEquals(sorted(n.position for n in found), sorted(n.position for n in expected))
+
+            lo, hi = (-0.5, 0.0, -0.2), (0.3, 0.6, 0.9)
+            for level in (None, 4):
+                expected = [n for n in nodes if all(a <= c <= b for a, b, c in zip(lo, hi, n.position)) and
+                            (n.level == level if level is not None else hasattr(n, 'value'))]
+                found = list(tree.query_box(lo, hi, level))
+                self.assertEquals(sorted(n.position for n in found), sorted(n.position for n in expected))
+
+            positions, values = tree.query_box(lo, hi, arrays=True)
+            self.assertEquals(positions.shape, (len(values), 3))
+            for position, value in zip(positions.tolist(), values):
+                self.assertEquals(tree.find_closest_node(value).position, tuple(position))
+
+    def test_knn(self):
+        random.seed(13)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(200)]
+        queries = [(random.uniform(-1.5, 1.5), random.uniform(-1.5, 1.5), random.uniform(-1.5, 1.5))
+                   for _ in range(30)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            for lazy in (False, True):
+                tree = MSPTree(12, storage=storage, lazy=lazy)
+                leaves = tree.expand_to_many(points, values=points)
+                count = tree.node_count()
+
+                nodes, distances = tree.knn_many(queries, 5)
+                for q, found, d in zip(queries, nodes, distances.tolist()):
+                    expected = sorted(math.sqrt(sum((a - b)**2 for a, b in zip(q, leaf.position)))
+                                      for leaf in set(leaves))
+                    for a, b in zip(d, expected[:5]):
+                        self.assertAlmostEqual(a, b)
+                    for nd, dd in zip(found, d):
+                        self.assertAlmostEqual(dd, math.sqrt(sum((a - b)**2 for a, b in zip(q, nd.position))))
+                        self.assertTrue(hasattr(nd, 'value'))
+                self.assertEquals(tree.node_count(), count)
+
+                found, d = tree.knn(points[0], 1)
+                self.assertEquals(found[0].value, points[0])
+                self.assertEquals(len(tree.knn(points[0], 500)[0]), len(set(leaves)))
+
+                # Groups of any size find exactly what knn finds, point by point
+                for group_size in (1, 7, 100):
+                    nodes, distances = tree.knn_many(queries, 3, group_size)
+                    for q, found, d in zip(queries, nodes, distances.tolist()):
+                        expected, expected_d = tree.knn(q, 3)
+                        self.assertEqual(d, expected_d)
+                        self.assertEqual(sorted(n.position for n in found), sorted(n.position for n in expected))
+                nodes, distances = tree.knn_many(queries[:2], 500)
+                self.assertEqual([len(found) for found in nodes], [len(set(leaves))]*2)
+                self.assertEqual(np.isinf(distances).sum(1).tolist(), [500 - len(set(leaves))]*2)
+                self.assertEqual(tree.knn_many(queries, 0)[1].shape, (len(queries), 0))
+
+    def test_evaluate(self):
+        random.seed(14)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(50)]
+        queries = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(100)]
+
+        def path(tree, q):
+            nodes = [tree.find_closest_node(q, 0)]
+            while len(nodes[-1].children) > 0:
+                nodes.append(nodes[-1]._closest_child(q) if tree.storage == MSPStorageType.Objects else
+                             tree.find_closest_node(q, len(nodes)))
+            return nodes
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(8, storage=storage)
+            tree.expand_to_many(points)
+            for q in points[:20]:
+                for nd in path(tree, q):
+                    nd.value = nd.level + 1.0
+
+            evaluator = tree.evaluator()
+            values = evaluator.evaluate(queries)
+            for q, v in zip(queries, values):
+                self.assertAlmostEqual(v, sum(getattr(nd, 'value', 0) for nd in path(tree, q)))
+            for q, v in zip(queries, tree.evaluate(queries, level=2)):
+                self.assertAlmostEqual(v, sum(getattr(nd, 'value', 0) for nd in path(tree, q)[:3]))
+            for q, v in zip(queries, tree.evaluate(queries, kernel=hat_kernel)):
+                expected = sum(getattr(nd, 'value', 0)*max(0, 1 - math.sqrt(sum((a - b)**2 for a, b in
+                                                                                zip(q, nd.position)))/nd.scale)
+                               for nd in path(tree, q))
+                self.assertAlmostEqual(v, expected)
+
+            # The evaluator keeps the coefficients it was made with
+            tree.roots[0].value = 100.0
+            self.assertTrue((evaluator.evaluate(queries) == values).all())
+
+            # The tree keeps its evaluator and gathers the coefficients again, an object tree is only flattened again
+            # once nodes are added or removed
+            self.assertFalse((tree.evaluate(queries) == values).all())
+            cached = tree._evaluator[1]
+            tree.roots[0].value = 50.0
+            self.assertTrue(np.allclose(tree.evaluate(queries), tree.evaluator().evaluate(queries)))
+            self.assertIs(tree._evaluator[1], cached)
+            tree.expand_to(queries[0]).value = 7.0
+            self.assertTrue(np.allclose(tree.evaluate(queries), tree.evaluator().evaluate(queries)))
+            self.assertEquals(tree._evaluator[1] is cached, storage != MSPStorageType.Objects)
+
+            vector = MSPTree(8, storage=storage)
+            for nd in path(vector, (0.1, 0.1, 0.1)):
+                nd.value = (1.0, 2.0)
+            self.assertEquals(vector.evaluate([(0.1, 0.1, 0.1), (5, 5, 5)]).tolist(), [[1.0, 2.0], [0.0, 0.0]])
+
+        self.assertRaises(ValueError, MSPTree(8, MSPTreeType.SpacePartitioning).evaluate, queries)
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            self.assertEquals(MSPTree(8, storage=storage, cell_size=1.0).evaluate(queries).tolist(), [0.0]*100)
+
+    def test_space_partitioning(self):
+        random.seed(15)
+        dense = [(random.gauss(0.3, 0.01), random.gauss(0.3, 0.01), random.gauss(0.3, 0.01)) for _ in range(300)]
+        sparse = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(20)]
+        points = dense + sparse
+        random.shuffle(points)
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            for lazy in (False, True):
+                tree = MSPTree(12, MSPTreeType.SpacePartitioning, storage=storage, lazy=lazy, bucket_capacity=4)
+                leaves = tree.insert_many(points, values=range(len(points)))
+
+                for i, (p, leaf) in enumerate(zip(points, leaves)):
+                    self.assertEquals(len(leaf.children), 0)
+                    self.assertTrue((p, i) in leaf.value)
+                    self.assertEquals(tree.find_closest_node(p), leaf)
+
+                buckets = dict((leaf, leaf.value) for leaf in leaves)
+                self.assertEquals(sum(len(b) for b in buckets.values()), len(points))
+                for leaf, bucket in buckets.items():
+                    self.assertTrue(len(bucket) <= 4 or leaf.level == 12)
+
+                # Sparse points stop near the roots, dense ones go deeper
+                depths = dict((p, leaf.level) for p, leaf in zip(points, leaves))
+                self.assertLess(sum(depths[p] for p in sparse)/20.0, sum(depths[p] for p in dense)/300.0)
+                self.assertLess(tree.node_count(), 27 + 12*len(points)/2)
+
+        self.assertRaises(ValueError, MSPTree(12).insert, (0, 0, 0))
+
+    def test_path_keys(self):
+        random.seed(9)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(100)]
+        tree = MSPTree(15)
+
+        keys = tree.path_keys(points)
+        self.assertEquals(keys.shape, (100, 2))
+        for p, key in zip(points, keys.tolist()):
+            path = [(int(key[i//12]) >> 5*(11 - i % 12)) & 31 for i in range(16)]
+            node = tree.roots[path[0]]
+            self.assertEquals(node, tree.find_closest_node(p, 0))
+            for slot in path[1:]:
+                node.expand_node()
+                self.assertEquals(node._closest_child(p), node.children[slot])
+                node = node.children[slot]
+
+    def test_find_closest_level(self):
+        tree = MSPTree(12)
+        tree.expand_to((0.4, 0.1, 0.3))
+
+        self.assertEquals(tree.find_closest_node((0.4, 0.1, 0.3), 0), tree.roots[0])
+        self.assertEquals(tree.find_closest_node((0.4, 0.1, 0.3), 1).position, (0.5, 0.0, 0.5))
+        self.assertEquals(len(tree.find_closest_node((0.4, 0.1, 0.3), 12).children), 0)
+
+    def test_closest_child(self):
+        random.seed(3)
+        tree = MSPTree(12)
+
+        for _ in range(500):
+            p = tuple(random.choice([random.uniform(-1, 1), random.randint(-64, 64)/64.0]) for _ in range(3))
+            node = tree.find_closest_node(p, 0)
+            for _ in range(12):
+                node.expand_node()
+                closest = node._scan_children(p)
+                self.assertTrue(node._closest_child(p) is closest)
+                node = closest
+
+    def test_find_closest_many(self):
+        random.seed(2)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(200)]
+        queries = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(500)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(12, storage=storage)
+            tree.expand_to_many(points)
+            count = tree.node_count()
+
+            for level in (-1, 0, 5):
+                nodes, depth, dist = tree.find_closest_many(queries, level)
+                for q, nd, d, dd in zip(queries, nodes, depth, dist):
+                    self.assertEquals(tree.find_closest_node(q, level), nd)
+                    self.assertTrue(d <= 12 if level < 0 else d <= level)
+                    self.assertAlmostEqual(dd, sum((a - b)**2 for a, b in zip(q, nd.position)))
+            self.assertEquals(tree.node_count(), count)
+
+            # A sparse tree without roots finds nothing, like find_closest_node
+            empty = MSPTree(12, storage=storage, cell_size=1.0)
+            nodes, depth, dist = empty.find_closest_many(queries[:3])
+            self.assertEquals(nodes, [empty.find_closest_node(q) for q in queries[:3]])
+            self.assertEquals(nodes, [None]*3)
+            self.assertEquals((depth.tolist(), dist.tolist()), ([0]*3, [float('inf')]*3))
+
+    def test_lattice_index(self):
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(9, storage=storage, indexed=True)
+            self.assertTrue(tree.contains(0, tree.lattice_key((1, 1, -1), 0)))
+            self.assertFalse(tree.contains(1, tree.lattice_key((0.5, 0.5, 0), 1)))
+
+            nd = tree.expand_to((0.3, 0.2, 0.1))
+            key = tree.lattice_key(nd.position, nd.level)
+            self.assertEquals(nd.level, 9)
+            self.assertTrue(nd in tree.get_nodes(9, key))
+
+            tree.roots[0].expand_node()
+            self.assertEquals(tree.get_node(1, tree.lattice_key((0.5, 0.5, 0), 1)).position, (0.5, 0.5, 0))
+
+            # Ghosts of the origin overlap the ghosts of the green roots
+            tree.roots[1].expand_node()
+            self.assertEquals(len(tree.get_nodes(1, tree.lattice_key((0.5, 0.5, 0.5), 1))), 2)
+
+        # Object nodes don't store their level or their tree, they hold the same attributes as without the index
+        tree = MSPTree(9, cell_size=0.3)
+        nd = tree.expand_to((0.3, 0.2, 0.1))
+        self.assertEqual(sorted(vars(nd)), ['children', 'color', 'lattice', 'parent', 'position', 'scale'])
+        self.assertEqual([nd.level, tree.find_closest_node(nd.position, 4).level], [9, 4])
+
+    def test_lattice_index_on_first_use(self):
+        random.seed(4)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(50)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tree = MSPTree(9, storage=storage)
+            leaves = tree.expand_to_many(points)
+            for leaf in leaves:
+                self.assertTrue(leaf in tree.get_nodes(leaf.level, tree.lattice_key(leaf.position, leaf.level)))
+
+            leaf = tree.expand_to((0.1, 0.1, 0.1))
+            self.assertTrue(leaf in tree.get_nodes(9, tree.lattice_key(leaf.position, 9)))
+
+    def test_integer_storage(self):
+        random.seed(5)
+        points = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(200)]
+        compact = MSPTree(15, storage=MSPStorageType.Compact)
+        integer = MSPTree(15, storage=MSPStorageType.Integer, indexed=True)
+
+        for p in points[:100]:
+            nd = integer.expand_to(p)
+            self.assertEquals(compact.expand_to(p).position, nd.position)
+            self.assertEquals(integer.get_node(15, integer.node_key(nd)), nd)
+        integer.expand_to_many(points[100:])
+        compact.expand_to_many(points[100:])
+        self.assertEquals(compact.node_count(), integer.node_count())
+
+        for q in points:
+            self.assertEquals(compact.find_closest_node(q).position, integer.find_closest_node(q).position)
+        nodes, _, _ = integer.find_closest_many(points)
+        self.assertEquals(nodes, [integer.find_closest_node(q) for q in points])
+
+    def test_integer_storage_depth(self):
+        random.seed(6)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(5)]
+        tree = MSPTree(170, storage=MSPStorageType.Integer)
+        batch = MSPTree(170, storage=MSPStorageType.Integer)
+
+        leaves = batch.expand_to_many(points)
+        for p, leaf in zip(points, leaves):
+            nd = tree.expand_to(p)
+            key = tree.node_key(nd)
+            self.assertEquals(key, batch.node_key(leaf))
+            self.assertTrue(all(abs(k - c*2.0**58) <= 2 for k, c in zip(key, p)))
+        self.assertRaises(ValueError, MSPTree, 180, storage=MSPStorageType.Integer)
+
+    def test_lazy_expansion(self):
+        random.seed(7)
+        points = [(random.uniform(-1.2, 1.2), random.randint(-8, 8)/8.0, random.uniform(-1, 1)) for _ in range(200)]
+        queries = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(100)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(12, storage=storage)
+            lazy = MSPTree(12, storage=storage, lazy=True)
+            batch = MSPTree(12, storage=storage, lazy=True)
+
+            for p in points[:100]:
+                self.assertEquals(tree.expand_to(p).position, lazy.expand_to(p).position)
+            for p, leaf in zip(points[100:], batch.expand_to_many(points[100:])):
+                self.assertEquals(tree.expand_to(p).position, leaf.position)
+                self.assertEquals(lazy.expand_to(p).position, leaf.position)
+            # Only the nodes on the paths down to the points exist
+            self.assertLessEqual(lazy.node_count(), 27 + 12*len(points))
+            self.assertLessEqual(batch.node_count(), 27 + 12*100)
+            self.assertLess(5*lazy.node_count(), tree.node_count())
+
+            nodes, _, _ = lazy.find_closest_many(queries)
+            for q, nd in zip(queries, nodes):
+                self.assertEquals(tree.find_closest_node(q).position, nd.position)
+                self.assertEquals(lazy.find_closest_node(q), nd)
+
+            nd = lazy.find_closest_node((0.3, 0.3, 0.3), 1)
+            self.assertEquals(len(nd.children), len(tree.find_closest_node((0.3, 0.3, 0.3), 1).children))
+            self.assertEquals([c.position for c in nd.children],
+                              [c.position for c in tree.find_closest_node((0.3, 0.3, 0.3), 1).children])
+
+    def test_compact_node_size(self):
+        tree = MSPTree(15)
+        compact = MSPTree(15, storage=MSPStorageType.Compact)
+
+        for root in tree.roots + compact.roots:
+            root.expand_node()
+
+        nd = tree.roots[0].children[1]
+        object_size = sys.getsizeof(nd) + sys.getsizeof(nd.__dict__) + \
+            sys.getsizeof(nd.position) + sys.getsizeof(nd.children)
+        compact_size = compact._store.nbytes() / float(compact.node_count())
+        self.assertLess(compact_size, object_size)
+
+        # Peak memory of building a tree on the sphere workload, everything allocated along the way included
+        random.seed(12)
+        points = []
+        for _ in range(1000):
+            z = 2*random.random() - 1
+            theta = 2*math.pi*random.random() - math.pi
+            points.append((math.sin(theta)*math.sqrt(1 - z*z), math.cos(theta)*math.sqrt(1 - z*z), z))
+        peaks = []
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+            tracemalloc.start()
+            try:
+                tree = MSPTree(12, storage=storage)
+                for p in points:
+                    tree.expand_to(p)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            del tree
+        self.assertLess(peaks[1]*4, peaks[0])
+
+    def test_memory_budget(self):
+        random.seed(15)
+        # Points drift along x, so the subtrees touched early go cold
+        points = [(i/150.0 - 1, random.uniform(-0.3, 0.3), random.uniform(-0.3, 0.3)) for i in range(300)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(9, storage=storage, lazy=lazy)
+                reference = MSPTree(9, storage=storage, lazy=lazy)
+                budget = 500 if lazy else 3000
+                tree.set_budget(nodes=budget, level=3, aggregate=sum)
+                for p in points:
+                    leaf = tree.expand_to(p)
+                    leaf.value = getattr(leaf, 'value', 0) + 1
+                    reference.expand_to(p)
+                    self.assertTrue(tree.node_count() <= budget or len(tree._recent) == 1)
+
+                # Recent points still reach the bottom of the tree, old ones end at a collapsed subtree root
+                for p in points[-5:]:
+                    self.assertEquals(tree.find_closest_node(p).position, reference.find_closest_node(p).position)
+                old = tree.find_closest_node(points[0])
+                self.assertEquals(old.level, 3)
+                self.assertTrue(old.value >= 1)
+                total = sum(n.value for n in tree.query_box((-2, -2, -2), (2, 2, 2)))
+                self.assertEquals(total, len(points))
+
+                # Freed nodes are reused and the count stays exact
+                if not lazy:
+                    count, stack = 0, list(tree.roots)
+                    while stack:
+                        count += 1
+                        stack.extend(stack.pop().children)
+                    self.assertEquals(count, tree.node_count())
+                tree.expand_to(points[0])
+                self.assertEquals(tree.find_closest_node(points[0]).position,
+                                  reference.find_closest_node(points[0]).position)
+
+                tree.set_budget()
+                tree.expand_to_many(points)
+                self.assertEquals(tree.node_count(), reference.node_count())
+
+        # Removing the budget works on any tree, and readers don't wait for the lock with a budget set
+        MSPTree(2).set_budget()
+        tree = MSPTree(6)
+        tree.set_budget(nodes=10000, level=3)
+        leaf = tree.expand_to(points[0])
+        found = []
+        with tree._lock:
+            reader = threading.Thread(target=lambda: found.append(tree.find_closest_node(points[0])))
+            reader.start()
+            reader.join(5)
+            self.assertEqual(found, [leaf])
+
+    def test_memory_budget_spill(self):
+        random.seed(16)
+        points = [(i/100.0 - 1, random.uniform(-0.3, 0.3), 0.1) for i in range(200)]
+        directory = tempfile.mkdtemp()
+
+        try:
+            for storage in (MSPStorageType.Objects, MSPStorageType.Compact):
+                spill = MSPSpillDirectory(os.path.join(directory, str(storage)))
+                reference = MSPTree(8, storage=storage)
+                reference.expand_to_many(points, values=range(200))
+                tree = MSPTree(8, storage=storage)
+                tree.set_budget(nbytes=200*tree._node_bytes(), level=2, spill=spill)
+                tree.expand_to_many(points[:100], values=range(100))
+                tree.bulk_load(points[100:], values=range(100, 200))
+
+                spilled, seen = [], set()
+                for p in points:
+                    node = tree.find_closest_node(p)
+                    if node.level == 2 and node.position not in seen:
+                        seen.add(node.position)
+                        spilled.extend(spill.load(node)[1])
+                self.assertTrue(len(spilled) > 0)
+                kept = [n.value for n in tree.query_box((-2, -2, -2), (2, 2, 2))]
+                # Nothing is lost, though a value overwritten in the reference can survive in the spill
+                self.assertEquals(len(set(spilled + kept)), len(spilled + kept))
+                self.assertTrue(set(spilled + kept) >= set(n.value for n in reference.query_box((-2, -2, -2),
+                                                                                                 (2, 2, 2))))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stats(self):
+        random.seed(17)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(100)]
+
+        snapshots = []
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(7, storage=storage)
+            self.assertFalse('picks' in tree.stats())
+            timings = []
+            stats = tree.enable_stats(lambda name, seconds: timings.append(name))
+            leaves = set()
+            for p in points:
+                leaf = tree.expand_to(p)
+                leaf.value = 1
+                leaves.add(leaf)
+            tree.find_closest_many(points)
+
+            snapshot = tree.stats()
+            self.assertEquals(snapshot['nodes'], tree.node_count())
+            self.assertEquals(sum(snapshot['levels']), snapshot['nodes'])
+            self.assertEquals(sum(snapshot['colors'].values()), snapshot['nodes'])
+            self.assertEquals(sum(snapshot['lattices'].values()), snapshot['nodes'])
+            self.assertEquals(snapshot['ghosts'], snapshot['colors']['ghost'])
+            self.assertEquals(snapshot['values'], len(leaves))
+            self.assertEquals(snapshot['picks'], 2*7*len(points))
+            self.assertTrue(snapshot['distance_evaluations'] >= 2*27*len(points))
+            self.assertEquals(snapshot['timings']['expand_to']['calls'], len(points))
+            self.assertEquals(timings.count('find_closest_many'), 1)
+            self.assertTrue(stats.expansions > 0)
+            snapshots.append(dict((k, snapshot[k]) for k in ('nodes', 'levels', 'colors', 'lattices', 'expansions')))
+
+            tree.disable_stats()
+            self.assertFalse('picks' in tree.stats())
+        self.assertEquals(snapshots[0], snapshots[1])
+        self.assertEquals(snapshots[0], snapshots[2])
+
+    def test_traversal(self):
+        random.seed(18)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(150)]
+        lo, hi = (-0.5, -0.2, -1), (0.6, 0.9, 0.3)
+
+        # Each storage gives the same results, with lazy and eager trees apart
+        results = []
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(6, storage=storage, lazy=lazy)
+                tree.expand_to_many(points, values=[1.0]*len(points))
+                leaves = list(tree.iter_leaves())
+                if not lazy:
+                    self.assertTrue(all(len(n.children) == 0 for n in leaves))
+                self.assertEquals(len([n for n in leaves if n.level == 6]), tree.stats()['levels'][6])
+
+                for level in (0, 3):
+                    nodes = list(tree.iter_level(level))
+                    self.assertEquals(len(nodes), tree.stats()['levels'][level])
+                    self.assertTrue(all(n.level == level for n in nodes))
+
+                    positions, colors, values = tree.extract_level(level)
+                    cut = nodes + [n for n in leaves if n.level < level]
+                    self.assertEquals(sorted(map(tuple, positions.tolist())), sorted(n.position for n in cut))
+                    self.assertEquals(sorted(colors.tolist()), sorted(n.color for n in cut))
+
+                    positions, colors, values = tree.extract_level(level, lo, hi)
+                    inside = [n for n in cut if all(lo[i] <= n.position[i] <= hi[i] for i in range(3))]
+                    self.assertEquals(sorted(map(tuple, positions.tolist())), sorted(n.position for n in inside))
+
+                positions, colors, values = tree.extract_level(6, fill=-1.0)
+                self.assertEquals(len(positions), len(leaves))
+                self.assertEquals((values == 1).sum(), tree.stats()['values'])
+                self.assertEquals((values == -1).sum(), len(leaves) - tree.stats()['values'])
+                results.append((lazy, sorted(map(tuple, positions.tolist()))))
+        for lazy, result in results:
+            self.assertEquals(result, results[lazy][1])
+
+    def test_concurrent_expansion(self):
+        random.seed(20)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(300)]
+        queries = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(300)]
+        interval = sys.getswitchinterval() if hasattr(sys, 'getswitchinterval') else None
+        if interval is not None:
+            sys.setswitchinterval(1e-6)
+
+        errors = []
+
+        def guarded(f):
+            def wrapped():
+                try:
+                    f()
+                except Exception as e:
+                    errors.append(e)
+            return wrapped
+
+        def run(threads):
+            threads = [threading.Thread(target=guarded(f)) for f in threads]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals(errors, [])
+
+        try:
+            for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+                for lazy in (False, True):
+                    tree = MSPTree(8, storage=storage, lazy=lazy, indexed=True)
+                    reference = MSPTree(8, storage=storage, lazy=lazy)
+                    reference.expand_to_many(points)
+                    done = []
+
+                    def writer(order):
+                        def write():
+                            for i in order:
+                                tree.expand_to(points[i]).value = i
+                        return write
+
+                    def reader():
+                        while not done:
+                            for q in queries[:20]:
+                                self.assertTrue(tree.find_closest_node(q).level <= 8)
+                            tree.find_closest_many(queries[:20])
+
+                    # Every writer goes over the same points, in its own order, so they race for the same nodes
+                    orders = [random.sample(range(len(points)), len(points)) for _ in range(4)]
+                    readers = [threading.Thread(target=guarded(reader)) for _ in range(2)]
+                    for t in readers:
+                        t.start()
+                    run([writer(order) for order in orders] + [lambda: tree.expand_to_many(queries)])
+                    done.append(True)
+                    for t in readers:
+                        t.join()
+                    self.assertEquals(errors, [])
+
+                    reference.expand_to_many(queries)
+                    self.assertEquals(tree.node_count(), reference.node_count())
+                    self.assertEquals(tree.stats()['levels'], reference.stats()['levels'])
+                    self.assertEquals(len(tree._index), tree.node_count())
+                    for i, p in enumerate(points):
+                        leaf = tree.find_closest_node(p)
+                        self.assertEquals(leaf.position, reference.find_closest_node(p).position)
+                        self.assertEquals(tree.find_closest_node(points[leaf.value]), leaf)
+
+            # Concurrent inserts lose no points
+            tree = MSPTree(8, MSPTreeType.SpacePartitioning, bucket_capacity=4)
+            run([lambda part=part: [tree.insert(p, p) for p in points[part::4]] for part in range(4)])
+            entries = [e for leaf in tree.query_box((-2, -2, -2), (2, 2, 2)) for e in leaf.value]
+            self.assertEquals(sorted(p for p, _ in entries), sorted(points))
+        finally:
+            if interval is not None:
+                sys.setswitchinterval(interval)
+
+    def test_remove(self):
+        random.seed(21)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(300)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(7, storage=storage, lazy=lazy, indexed=True)
+                leaves = tree.expand_to_many(points, values=range(len(points)))
+                # Points sharing a leaf with an earlier one are dropped, so each value is one sample
+                points = [p for i, (p, leaf) in enumerate(zip(points, leaves)) if leaf.value == i]
+                kept, removed = points[::2], points[1::2]
+
+                for p in removed:
+                    self.assertTrue(tree.remove(p))
+                reference = MSPTree(7, storage=storage, lazy=lazy)
+                reference.expand_to_many(kept)
+                self.assertEquals(tree.node_count(), reference.node_count())
+                self.assertEquals(tree.stats()['levels'], reference.stats()['levels'])
+                self.assertEquals(len(tree._lattice_index()), tree.node_count())
+                self.assertFalse(tree.remove(removed[0]))
+
+                before = [(tree.find_closest_node(p).position, tree.find_closest_node(p).value) for p in kept]
+                reclaimed = tree.compact()
+                self.assertEquals(reclaimed > 0, storage != MSPStorageType.Objects)
+                self.assertEquals(tree.compact(), 0)
+                after = [(tree.find_closest_node(p).position, tree.find_closest_node(p).value) for p in kept]
+                self.assertEquals(after, before)
+                if storage != MSPStorageType.Objects:
+                    self.assertEquals(len(tree._store), tree.node_count())
+                for node in tree.iter_level(7):
+                    self.assertTrue(node in tree.get_nodes(7, tree.node_key(node)))
+
+                # Clearing an inner node keeps the values below it
+                node = tree.find_closest_node(kept[0], 3)
+                tree.clear_value(node)
+                self.assertEquals(tree.find_closest_node(kept[0]).level, 7)
+                for p in kept:
+                    tree.clear_value(tree.find_closest_node(p))
+                self.assertEquals(tree.node_count(), 27)
+
+                tree.expand_to_many(points)
+                reference.expand_to_many(points)
+                self.assertEquals(tree.node_count(), reference.node_count())
+
+        tree = MSPTree(8, MSPTreeType.SpacePartitioning, bucket_capacity=2)
+        tree.insert_many(points, range(len(points)))
+        for p in points:
+            self.assertTrue(tree.remove(p))
+        self.assertFalse(tree.remove(points[0]))
+        self.assertEquals(tree.node_count(), 27)
+
+    def test_aggregation(self):
+        random.seed(22)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(300)]
+        aggregators = {'count': CountAggregator(), 'mean': MeanAggregator(), 'min': MinAggregator(),
+                       'max': MaxAggregator()}
+
+        def check(tree):
+            # The incremental aggregates match a recomputation, and every sample is counted once at the roots
+            nodes = list(tree.iter_level(3))
+            incremental = [tree.aggregate(n) for n in nodes]
+            tree.update_aggregates()
+            for n, result in zip(nodes, incremental):
+                self.assertEquals(result is None, tree.aggregate(n) is None)
+                for name in aggregators if result is not None else []:
+                    self.assertTrue(np.allclose(result[name], tree.aggregate(n)[name]))
+            samples = [n.value for n in tree.iter_leaves() if hasattr(n, 'value')]
+            roots = [tree.aggregate(r) for r in tree.roots if tree.aggregate(r) is not None]
+            self.assertEquals(sum(r['count'] for r in roots), len(samples))
+            self.assertAlmostEquals(min(r['min'] for r in roots), min(samples))
+            self.assertAlmostEquals(max(r['max'] for r in roots), max(samples))
+            self.assertAlmostEquals(sum(r['mean']*r['count'] for r in roots), sum(samples))
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(6, storage=storage, lazy=lazy)
+                tree.set_aggregator(aggregators)
+                for i, p in enumerate(points):
+                    tree.add_sample(p, float(i % 17))
+                check(tree)
+
+                bulk = MSPTree(6, storage=storage, lazy=lazy)
+                bulk.expand_to_many(points, values=[float(i % 17) for i in range(len(points))])
+                bulk.set_aggregator(aggregators)
+                self.assertEquals([bulk.aggregate(r) is None for r in bulk.roots],
+                                  [tree.aggregate(r) is None for r in tree.roots])
+
+                for p in points[::3]:
+                    tree.remove(p)
+                check(tree)
+                tree.compact()
+                check(tree)
+
+                nodes, results = tree.aggregate_level(2, (-0.5,)*3, (0.5,)*3)
+                self.assertTrue(len(nodes) > 0)
+                for n, result in zip(nodes, results):
+                    self.assertTrue(n.level == 2 and result['count'] > 0)
+
+        tree = MSPTree(8, MSPTreeType.SpacePartitioning, bucket_capacity=2)
+        tree.set_aggregator(MeanNormalAggregator())
+        for p in points:
+            tree.insert(p, p)
+        for r in tree.roots:
+            normal = tree.aggregate(r)
+            if normal is not None:
+                self.assertAlmostEquals(np.sqrt((normal*normal).sum()), 1.)
+        before = [tree.aggregate(r) for r in tree.roots]
+        tree.update_aggregates()
+        for a, b in zip(before, [tree.aggregate(r) for r in tree.roots]):
+            self.assertTrue((a is None and b is None) or np.allclose(a, b))
+
+        tree.set_aggregator(CountAggregator())
+        self.assertEquals(sum(tree.aggregate(r) or 0 for r in tree.roots), len(points))
+        for p in points[:100]:
+            tree.remove(p)
+        self.assertEquals(sum(tree.aggregate(r) or 0 for r in tree.roots), len(points) - 100)
+
+    def test_root_ties(self):
+        # Points halfway between roots of the unit grid go to the first of the tied roots in roots
+        random.seed(31)
+        points = [(-0.5, -0.1875, 0.6875)] + [tuple(random.randint(-24, 24)/16.0 for _ in range(3)) for _ in range(300)]
+        dot = lambda x, y: (x[0] - y[0])*(x[0] - y[0]) + (x[1] - y[1])*(x[1] - y[1]) + (x[2] - y[2])*(x[2] - y[2])
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(6, MSPTreeType.FunctionSpace, storage=storage)
+            bulk = MSPTree(6, storage=storage)
+            roots = [min(tree.roots, key=lambda r: dot(p, r.position)).position for p in points]
+            self.assertEqual(roots[0], (-1, 0, 1))
+            for p, root, leaf in zip(points, roots, bulk.bulk_load(points)):
+                self.assertEquals(tree.expand_to(p).position, leaf.position)
+                self.assertEqual(tree.find_closest_node(p, 0).position, root)
+
+            for i, r in enumerate(tree.roots):
+                r.value = float(i)
+            found = tree.evaluate(points, level=0)
+            self.assertEqual([tree.roots[int(v)].position for v in found], roots)
+
+    def test_sparse_roots(self):
+        random.seed(23)
+        points = [(random.uniform(-1.4, 1.4), random.uniform(-1.4, 1.4), random.uniform(-1.4, 1.4))
+                  for _ in range(200)]
+        far = [(random.uniform(-60, 60), random.uniform(-60, 60), random.uniform(-60, 60)) for _ in range(100)]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'tree.msp')
+
+        try:
+            for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+                for lazy in (False, True):
+                    tree = MSPTree(8, storage=storage, lazy=lazy, indexed=True, cell_size=2.5)
+                    self.assertEquals(tree.roots, [])
+                    self.assertEquals(tree.find_closest_node((1, 2, 3)), None)
+                    self.assertFalse(tree.remove((1, 2, 3)))
+                    positions, colors, values = tree.extract_level(3)
+                    self.assertEqual((positions.shape, colors.shape, values.shape), ((0, 3), (0,), (0,)))
+
+                    # Inside the unit grid a sparse tree is the unit tree scaled by its cell size
+                    unit = MSPTree(8, storage=storage, lazy=lazy)
+                    for p in points:
+                        leaf = tree.expand_to([2.5*c for c in p])
+                        self.assertTrue(np.allclose(leaf.position, [2.5*c for c in unit.expand_to(p).position]))
+                        self.assertEqual(leaf.scale, 2.5*unit.find_closest_node(p).scale)
+                    self.assertEquals(tree.node_count(), unit.node_count() - 27 + len(tree.roots))
+
+                    # Roots are made for the cells points fall in, anywhere
+                    leaves = tree.expand_to_many(far, values=range(len(far)))
+                    bulk = MSPTree(8, storage=storage, lazy=lazy, cell_size=2.5)
+                    for i, (p, leaf) in enumerate(zip(far, bulk.bulk_load(far))):
+                        self.assertEquals(tree.expand_to(p).position, leaf.position)
+                        self.assertTrue(math.sqrt(sum((a - b)**2 for a, b in zip(p, leaf.position))) < 2.5/8)
+                    cells = set(tuple(int(math.floor(c/2.5 + 0.5)) for c in p) for p in far + [[2.5*c for c in q]
+                                                                                             for q in points])
+                    self.assertEquals(len(tree.roots), len(cells))
+                    self.assertEquals(len(bulk.roots), len(set(tuple(int(math.floor(c/2.5 + 0.5)) for c in p)
+                                                               for p in far)))
+                    for root in tree.roots:
+                        self.assertEquals(root.level, 0)
+                        self.assertEqual(root.scale, 2.5)
+                        self.assertTrue(all(abs(c/2.5 - round(c/2.5)) < 1e-12 for c in root.position))
+                    for leaf in leaves[:20]:
+                        self.assertTrue(leaf in tree.get_nodes(8, tree.node_key(leaf)))
+                        self.assertEquals(tree.node_key(leaf), tree.lattice_key(leaf.position, 8))
+
+                    tree.save(path)
+                    loaded = MSPTree.load(path, mmap=False)
+                    self.assertEquals((loaded.sparse, loaded.cell_size), (True, 2.5))
+                    self.assertEquals(len(loaded.roots), len(tree.roots))
+                    for i, p in enumerate(far):
+                        self.assertEquals(loaded.find_closest_node(p).value, i)
+                    loaded.expand_to(far[0])
+                    loaded.expand_to((500., 0., 0.))
+                    self.assertEquals(len(loaded.roots), len(tree.roots) + 1)
+
+            for storage in (MSPStorageType.Compact, MSPStorageType.Integer):
+                tree = MSPTree(8, storage=storage, cell_size=2.5)
+                tree.expand_to(far[0])
+                bulk = MSPTree(8, storage=storage, cell_size=2.5)
+                for leaf, other in zip(tree.build_parallel(far, workers=2), bulk.bulk_load(far)):
+                    self.assertEquals(leaf.position, other.position)
+                self.assertEquals(tree.node_count(), bulk.node_count())
+
+            tree = MSPTree(8, MSPTreeType.SpacePartitioning, bucket_capacity=2, cell_size=10.)
+            tree.insert_many(far, range(len(far)))
+            for i, p in enumerate(far):
+                self.assertTrue(((tuple(p), i)) in tree.find_closest_node(p).value)
+
+            keys = tree.path_keys(far[:10])
+            self.assertEquals(keys[:, 0].tolist(), [tree.roots.index(tree.find_closest_node(p, 0)) for p in far[:10]])
+            self.assertRaises(ValueError, MSPTree, 8, cell_size=0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cell_size_precision(self):
+        # Compact stores keep scales in full precision, so they match object trees exactly for any cell size
+        random.seed(37)
+        for cell_size in (0.1, 0.3, 1/3.):
+            points = [tuple(random.uniform(-4*cell_size, 4*cell_size) for _ in range(3)) for _ in range(100)]
+            trees = [MSPTree(9, storage=storage, cell_size=cell_size)
+                     for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer)]
+            for p in points:
+                nodes = [tree.expand_to(p) for tree in trees]
+                self.assertEqual(nodes[0].position, nodes[1].position)
+                self.assertEqual([n.scale for n in nodes], [nodes[0].scale]*3)
+                self.assertEqual([tree.node_key(n) for tree, n in zip(trees, nodes)], [trees[0].node_key(nodes[0])]*3)
+            self.assertEqual([r.scale for r in trees[1].roots], [cell_size]*len(trees[1].roots))
+
+    def test_neighbors(self):
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            tree = MSPTree(4, storage=storage, cell_size=0.5)
+            for p in itertools.product((-0.5, 0, 0.5), repeat=3):
+                tree.expand_to(p)
+            nodes = list(tree.roots)
+            for level in range(3):
+                for node in nodes:
+                    node.expand_node()
+                nodes = [c for node in nodes for c in node.children]
+
+            for level, (face, every) in enumerate([(6, 26), (12, 18), (14, 14), (6, 26)]):
+                self.assertEquals(len(tree.neighbor_offsets(level)), face)
+                self.assertEquals(len(tree.neighbor_offsets(level, 'all')), every)
+                nodes, table = tree.level_neighbors(level)
+                self.assertEquals(table.shape, (len(nodes), face))
+                positions = set(tuple(np.round(n.position, 9)) for n in nodes)
+                offsets = tree.neighbor_offsets(level)
+                for i, node in enumerate(nodes):
+                    # Every lattice point around the node that holds a node of the level is found
+                    expected = [tuple(np.round(np.add(node.position, o), 9)) for o in offsets]
+                    self.assertEquals([tuple(np.round(nodes[j].position, 9)) for j in table[i] if j >= 0],
+                                      [e for e in expected if e in positions])
+                    self.assertEquals([n.position for n in tree.neighbors(node)],
+                                      [nodes[j].position for j in table[i] if j >= 0])
+
+                # Averaging the face neighbours keeps a linear function where the stencil is complete
+                weights = [0.] + [1./face]*face
+                _, x = tree.apply_stencil(level, weights, values=[n.position[0] for n in nodes])
+                complete = (table >= 0).all(1)
+                self.assertTrue(complete.any())
+                self.assertTrue(np.allclose(x[complete], [n.position[0] for n, c in zip(nodes, complete) if c]))
+                _, laplacian = tree.apply_stencil(level, [-face] + [1.]*face, values=np.ones((len(nodes), 3)))
+                self.assertTrue(np.allclose(laplacian, 0))
+
+            root = tree.find_closest_node((0, 0, 0), 0)
+            self.assertEquals(len(tree.neighbors(root)), 6)
+            self.assertEquals(len(tree.neighbors(root, 'all')), 26)
+            self.assertRaises(ValueError, tree.neighbors, root, 'edge')
+            self.assertRaises(ValueError, tree.apply_stencil, 1, [1., 1.])
+
+        tree = MSPTree(4, lazy=True)
+        leaf = tree.expand_to((0.1, 0.2, 0.3))
+        self.assertEquals(tree.neighbors(leaf), [])
+        tree.expand_to((0.1 + 0.25, 0.2, 0.3))
+        self.assertEquals(len(tree.neighbors(leaf)), 1)
+
+    @unittest.skipUnless(_shared_memory is not None, "needs multiprocessing.shared_memory")
+    def test_shared_memory(self):
+        from concurrent.futures import ProcessPoolExecutor
+        random.seed(25)
+        points = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(200)]
+        queries = [(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)) for _ in range(40)]
+
+        for storage in (MSPStorageType.Objects, MSPStorageType.Compact, MSPStorageType.Integer):
+            for lazy in (False, True):
+                tree = MSPTree(8, storage=storage, lazy=lazy, cell_size=0.5 if lazy else None)
+                tree.expand_to_many(points, values=points)
+                expected = [tree.find_closest_node(q) for q in queries]
+                block = tree.share()
+                try:
+                    shared = MSPTree.attach(block.name)
+                    self.assertEquals(shared.storage, MSPStorageType.Integer if storage == MSPStorageType.Integer
+                                      else MSPStorageType.Compact)
+                    self.assertEquals((shared.lazy, shared.sparse, shared.node_count()),
+                                      (lazy, lazy, tree.node_count()))
+                    for p in points:
+                        self.assertEquals(shared.find_closest_node(p).value, tree.find_closest_node(p).value)
+                    self.assertEquals([n.position for n in shared.knn(queries[0], 3)[0]],
+                                      [n.position for n in tree.knn(queries[0], 3)[0]])
+                    self.assertTrue(shared._store.mapped is not None)
+
+                    # Workers query the shared nodes without copying them
+                    with ProcessPoolExecutor(2) as pool:
+                        results = list(pool.map(query_shared, [(block.name, queries[:20]), (block.name, queries[20:])]))
+                    positions = [p for result in results for p in result[0]]
+                    self.assertEquals(positions, [n.position for n in expected])
+                    self.assertEquals([v for result in results for v in result[1]],
+                                      [getattr(n, 'value', None) for n in expected])
+                    self.assertEquals([p for result in results for p in result[2]], positions)
+                    self.assertEquals(results[0][3], sum(1 for _ in tree.iter_leaves()))
+                    self.assertTrue(all(result[4] for result in results))
+
+                    # Changing an attached tree copies its arrays, the block stays as it was
+                    shared.expand_to((0.9, -0.9, 0.9))
+                    self.assertTrue(shared._store.mapped is None)
+                    self.assertEquals(MSPTree.attach(block.name).node_count(), tree.node_count())
+                    del shared
+                finally:
+                    block.close()
+                    block.unlink()
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
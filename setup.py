@@ -9,4 +9,8 @@ setup(name='Multi-resolution Sphere Packing Tree',
 #      author_email='',
 #      url='https://www.python.org/sigs/distutils-sig/',
       packages=['msptree', 'msptree.msptree'],
+      install_requires=['numpy'],
+      python_requires='>=3.8',
+      classifiers=['Programming Language :: Python :: 3',
+                   'Programming Language :: Python :: 3 :: Only'],
      )
\ No newline at end of file